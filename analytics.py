@@ -0,0 +1,180 @@
+"""
+Materialized sales rollups in the analytics collection.
+
+Each rollup document holds the sales_amount and units_sold totals and the
+record count for one value of one dimension (day, product, customer location,
+customer gender, plus an overall total). Write endpoints compute the change
+in those totals from the documents they replace and write, and apply it with
+$inc, so the dashboard reads small indexed documents instead of the whole
+sales collection. rebuild_rollups recomputes everything server-side.
+"""
+import os
+import uuid
+from datetime import date, datetime
+
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+
+from merge_engine import compile_field_getter
+
+# Field holding the sale date, used for the 'day' rollup
+ANALYTICS_DATE_FIELD = os.environ.get('ANALYTICS_DATE_FIELD', 'date')
+
+# Dimension name -> field it groups by ('total' has a single 'all' row)
+ANALYTICS_DIMENSIONS = {
+    'total': None,
+    'day': ANALYTICS_DATE_FIELD,
+    'product': 'product',
+    'location': 'customer.location',
+    'gender': 'customer.gender'
+}
+
+# Rollup value for documents without the dimension field. $merge refuses a
+# null 'on' value, so the rebuild and the incremental updates both use this.
+MISSING_VALUE = os.environ.get('ANALYTICS_MISSING_VALUE', '(none)')
+
+_getters = {dimension: compile_field_getter(field) for dimension, field in ANALYTICS_DIMENSIONS.items() if field}
+_initialized_databases = set()
+
+
+def ensure_analytics_indexes(analytics_collection):
+    key = (analytics_collection.database.name, analytics_collection.name)
+    if key in _initialized_databases:
+        return
+    analytics_collection.create_index([('dimension', ASCENDING), ('value', ASCENDING)], unique=True)
+    analytics_collection.create_index([('dimension', ASCENDING), ('sales_amount', DESCENDING)])
+    _initialized_databases.add(key)
+
+
+def day_value(value):
+    if isinstance(value, (datetime, date)):
+        return value.strftime('%Y-%m-%d')
+    if isinstance(value, str) and value:
+        return value[:10]
+    return None
+
+
+def metric_value(value):
+    # Same rule as $sum: anything that is not a number counts as 0
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return 0
+    return value
+
+
+class RollupDelta:
+    """Accumulates the change to every rollup row caused by a set of writes"""
+
+    def __init__(self):
+        self.rows = {}
+
+    def add(self, document, sign=1):
+        if not document:
+            return
+        sales_amount = metric_value(document.get('sales_amount')) * sign
+        units_sold = metric_value(document.get('units_sold')) * sign
+        for dimension in ANALYTICS_DIMENSIONS:
+            if dimension == 'total':
+                value = 'all'
+            elif dimension == 'day':
+                value = day_value(_getters[dimension](document))
+            else:
+                value = _getters[dimension](document)
+            if isinstance(value, (dict, list)):
+                continue
+            if value is None:
+                value = MISSING_VALUE
+            row = self.rows.get((dimension, value))
+            if row is None:
+                row = self.rows[(dimension, value)] = [0, 0, 0]
+            row[0] += sales_amount
+            row[1] += units_sold
+            row[2] += sign
+
+    def remove(self, document):
+        self.add(document, sign=-1)
+
+    def replace(self, old_document, new_document):
+        self.remove(old_document)
+        self.add(new_document)
+
+    def add_all(self, documents, sign=1):
+        for document in documents:
+            self.add(document, sign)
+
+    def apply(self, analytics_collection):
+        """Write the non-zero changes with one unordered bulk_write of $inc upserts"""
+        ensure_analytics_indexes(analytics_collection)
+        now = datetime.now()
+        operations = [
+            UpdateOne(
+                {'dimension': dimension, 'value': value},
+                {'$inc': {'sales_amount': sales_amount, 'units_sold': units_sold, 'count': count},
+                 '$set': {'updated_at': now}},
+                upsert=True
+            )
+            for (dimension, value), (sales_amount, units_sold, count) in self.rows.items()
+            if sales_amount or units_sold or count
+        ]
+        if operations:
+            analytics_collection.bulk_write(operations, ordered=False)
+        # Rows that lost all their records are no longer useful
+        analytics_collection.delete_many({'count': {'$lte': 0}})
+        self.rows = {}
+        return len(operations)
+
+
+def day_expression(field):
+    path = f'${field}'
+    return {'$switch': {
+        'branches': [
+            {'case': {'$eq': [{'$type': path}, 'date']}, 'then': {'$dateToString': {'format': '%Y-%m-%d', 'date': path}}},
+            {'case': {'$and': [{'$eq': [{'$type': path}, 'string']}, {'$ne': [path, '']}]},
+             'then': {'$substrCP': [path, 0, 10]}}
+        ],
+        'default': MISSING_VALUE
+    }}
+
+
+def rebuild_rollups(sales_collection, analytics_collection):
+    """Recompute every rollup from sales inside the database"""
+    ensure_analytics_indexes(analytics_collection)
+    generation = uuid.uuid4().hex
+    for dimension, field in ANALYTICS_DIMENSIONS.items():
+        if dimension == 'total':
+            group_key = 'all'
+        elif dimension == 'day':
+            group_key = day_expression(field)
+        else:
+            group_key = {'$ifNull': [f'${field}', MISSING_VALUE]}
+        sales_collection.aggregate([
+            {'$group': {
+                '_id': group_key,
+                'sales_amount': {'$sum': '$sales_amount'},
+                'units_sold': {'$sum': '$units_sold'},
+                'count': {'$sum': 1}
+            }},
+            {'$project': {
+                '_id': 0,
+                'dimension': {'$literal': dimension},
+                'value': '$_id',
+                'sales_amount': 1,
+                'units_sold': 1,
+                'count': 1,
+                'generation': {'$literal': generation},
+                'updated_at': '$$NOW'
+            }},
+            {'$merge': {'into': analytics_collection.name, 'on': ['dimension', 'value'],
+                        'whenMatched': 'replace', 'whenNotMatched': 'insert'}}
+        ])
+    # Anything not produced by this rebuild is stale
+    analytics_collection.delete_many({'generation': {'$ne': generation}})
+
+
+def clear_rollups(analytics_collection):
+    analytics_collection.delete_many({})
+
+
+def get_rollups(analytics_collection, dimension, sort='sales_amount', limit=100):
+    ensure_analytics_indexes(analytics_collection)
+    direction = ASCENDING if sort == 'value' else DESCENDING
+    projection = {'_id': 0, 'value': 1, 'sales_amount': 1, 'units_sold': 1, 'count': 1}
+    return list(analytics_collection.find({'dimension': dimension}, projection).sort(sort, direction).limit(limit))
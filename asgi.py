@@ -0,0 +1,195 @@
+"""
+ASGI entry point.
+
+The hot read endpoints (GET /api/sales, /api/sales-schema and
+/api/list-backups) are served natively on the event loop with PyMongo's
+async client, so requests waiting on MongoDB run concurrently without
+holding a thread each. Every other route is passed through to the Flask app
+in main.py, which a2wsgi runs on a pool of WSGI_THREADS threads. Responses are serialized
+with the Flask app's JSON provider, so both paths answer the same bytes, and
+go through the same response cache (see response_cache.py). Both resolve
+the tenant of a request the same way (see tenants.py).
+
+    uvicorn asgi:app --workers 4
+    SERVER_MODE=asgi gunicorn -c gunicorn.conf.py
+"""
+import asyncio
+import functools
+import os
+import time
+from contextlib import asynccontextmanager
+
+from a2wsgi import WSGIMiddleware
+from pymongo import AsyncMongoClient
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.datastructures import MultiDict
+from werkzeug.http import parse_etags
+
+import backups
+import main
+import metrics
+import response_cache
+import schema_registry
+import tenants
+
+# Connections the async client may open per worker process
+ASYNC_MONGO_POOL_SIZE = int(os.environ.get('ASYNC_MONGO_POOL_SIZE', 100))
+# Threads per worker process serving the routes passed through to Flask
+WSGI_THREADS = int(os.environ.get('WSGI_THREADS', 8))
+
+
+def json_response(data, status_code=200):
+    # Same body as Flask's jsonify
+    return Response(main.app.json.dumps(data) + '\n', status_code=status_code, media_type='application/json')
+
+
+def cached(handler):
+    """Async counterpart of ResponseCache.cached, sharing main.sales_cache"""
+    @functools.wraps(handler)
+    async def wrapper(request):
+        cache = main.sales_cache
+        if not cache.enabled:
+            return await handler(request)
+
+        key = cache.key(request.url.path, request.query_params.multi_items(), request.state.db)
+        version = await cache.current_version_async(request.state.db)
+        etag = response_cache.make_etag(key, version)
+        if parse_etags(request.headers.get('if-none-match')).contains(etag):
+            cache.not_modified()
+            response = Response(status_code=304)
+        else:
+            # Redis lookups block, keep them off the event loop
+            entry = await asyncio.to_thread(cache.get, key, version) if cache.shared else cache.get(key, version)
+            if entry is not None:
+                response = Response(entry[0], media_type=entry[1])
+            else:
+                response = await handler(request)
+                if response.status_code != 200:
+                    return response
+                if not isinstance(response, StreamingResponse):
+                    if cache.shared:
+                        await asyncio.to_thread(cache.put, key, version, response.body, response.media_type)
+                    else:
+                        cache.put(key, version, response.body, response.media_type)
+
+        response.headers['ETag'] = f'"{etag}"'
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    return wrapper
+
+
+def tenant_scoped(handler):
+    """Resolve the tenant like main.select_tenant and put its database and sales collection on request.state"""
+    @functools.wraps(handler)
+    async def wrapper(request):
+        try:
+            tenant = tenants.parse_tenant(request.headers, request.query_params)
+        except ValueError as e:
+            return json_response({'message': str(e)}, 400)
+        base_db = request.app.state.db
+        request.state.tenant = tenant
+        request.state.db = request.app.state.client[tenants.database_name(base_db.name, tenant)]
+        request.state.sales = request.state.db['sales']
+        with tenants.use_tenant(tenant):
+            return await handler(request)
+
+    return wrapper
+
+
+def instrumented(route, handler):
+    """Record the request metrics the Flask hooks record for the routes served here"""
+    @functools.wraps(handler)
+    async def wrapper(request):
+        start = time.perf_counter()
+        response = await handler(request)
+        metrics.observe_request(request.method, route, response.status_code, time.perf_counter() - start,
+                                None, None if isinstance(response, StreamingResponse) else len(response.body))
+        return response
+
+    return wrapper
+
+
+async def stream_sales(cursor, output_format):
+    """Async counterpart of main.stream_sales"""
+    dumps = main.app.json.dumps
+    if output_format == 'ndjson':
+        async for sale in cursor:
+            sale['_id'] = str(sale['_id'])
+            yield dumps(sale) + '\n'
+        return
+
+    yield '['
+    first = True
+    async for sale in cursor:
+        sale['_id'] = str(sale['_id'])
+        yield ('' if first else ',') + dumps(sale)
+        first = False
+    yield ']'
+
+
+async def get_sales_data(request):
+    args = MultiDict(request.query_params.multi_items())
+    try:
+        query, projection, limit, output_format = main.parse_sales_request(args)
+    except ValueError as e:
+        return json_response({'message': str(e)}, 400)
+
+    sales = main.find_sales(request.state.sales, query, projection, limit, 'after' in args)
+
+    if output_format != 'json':
+        return StreamingResponse(stream_sales(sales, output_format),
+                                 media_type=main.SALES_FORMAT_MIMETYPES[output_format])
+
+    sales_list = []
+    async for sale in sales:
+        sale['_id'] = str(sale['_id'])
+        sales_list.append(sale)
+
+    if limit is None:
+        return json_response(sales_list)
+
+    next_after = sales_list[-1]['_id'] if len(sales_list) == limit else None
+    return json_response({'sales': sales_list, 'next_after': next_after})
+
+
+async def get_sales_schema(request):
+    schema = await schema_registry.get_schema_async(request.state.db, request.state.sales)
+    return json_response(main.sales_schema_response(schema))
+
+
+async def list_backups(request):
+    # Index creation and legacy backup registration run once per process with the sync client
+    await asyncio.to_thread(backups.ensure_initialized, tenants.tenant_database(main.mongo.db, request.state.tenant))
+    details = await backups.list_backups_async(request.state.db)
+    return json_response(main.backup_list_response(details))
+
+
+@asynccontextmanager
+async def lifespan(app):
+    client = AsyncMongoClient(main.app.config['MONGO_URI'], maxPoolSize=ASYNC_MONGO_POOL_SIZE)
+    app.state.client = client
+    # Database of the default tenant, the others are resolved per request
+    app.state.db = client.get_default_database()
+    try:
+        yield
+    finally:
+        await client.close()
+
+
+app = Starlette(
+    routes=[
+        Route('/api/sales', instrumented('/api/sales', tenant_scoped(cached(get_sales_data))), methods=['GET']),
+        Route('/api/sales-schema', instrumented('/api/sales-schema', tenant_scoped(cached(get_sales_schema))),
+              methods=['GET']),
+        Route('/api/list-backups', instrumented('/api/list-backups', tenant_scoped(cached(list_backups))),
+              methods=['GET']),
+        Mount('/', app=WSGIMiddleware(main.app, workers=WSGI_THREADS))
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])],
+    lifespan=lifespan
+)
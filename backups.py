@@ -0,0 +1,311 @@
+"""
+Backup subsystem for the sales collection.
+
+Every merge starts with a backup point that describes the state of sales just
+before the merge. Backup points are either:
+
+- full: a server-side $out copy of sales into a sales_backup_* collection
+- delta: a reference to the latest full snapshot; the state is rebuilt by
+  replaying the changesets recorded by the merges since that snapshot
+
+After a merge writes its changes it records a changeset (the documents it
+inserted or replaced and the ids it deleted), so storage grows with the
+amount of change instead of the number of merges. Backup points are indexed
+in the backup metadata collection, and old snapshots together with their
+deltas are pruned by the retention policy.
+"""
+import os
+import traceback
+from datetime import datetime, timedelta
+
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING
+
+BACKUP_METADATA_COLLECTION = 'backup_metadata'
+BACKUP_CHANGESET_COLLECTION = 'backup_changesets'
+
+# Take a full snapshot after this many delta backups
+BACKUP_FULL_EVERY = int(os.environ.get('BACKUP_FULL_EVERY', 10))
+# Number of full snapshots (with their deltas) to keep
+BACKUP_KEEP_SNAPSHOTS = int(os.environ.get('BACKUP_KEEP_SNAPSHOTS', 3))
+# Also prune snapshots older than this many days, 0 keeps them regardless of age
+BACKUP_MAX_AGE_DAYS = int(os.environ.get('BACKUP_MAX_AGE_DAYS', 0))
+
+_initialized_databases = set()
+
+
+def metadata_collection(db):
+    return db[BACKUP_METADATA_COLLECTION]
+
+
+def changeset_collection(db):
+    return db[BACKUP_CHANGESET_COLLECTION]
+
+
+def ensure_backup_indexes(db):
+    metadata = metadata_collection(db)
+    metadata.create_index([('name', ASCENDING)], unique=True)
+    metadata.create_index([('created_at', DESCENDING)])
+    metadata.create_index([('base', ASCENDING), ('created_at', ASCENDING)])
+    changeset_collection(db).create_index([('backup', ASCENDING), ('op', ASCENDING)])
+
+
+def ensure_initialized(db):
+    """Create the indexes and register legacy backups once per database"""
+    if db.name in _initialized_databases:
+        return
+    ensure_backup_indexes(db)
+    register_legacy_backups(db)
+    _initialized_databases.add(db.name)
+
+
+def register_legacy_backups(db):
+    """Add metadata for sales_backup_* collections created before the metadata collection existed"""
+    metadata = metadata_collection(db)
+    known = set(metadata.distinct('name'))
+    for name in db.list_collection_names(filter={'name': {'$regex': '^sales_backup'}}):
+        if name in known:
+            continue
+        try:
+            created_at = datetime.strptime(name[len('sales_backup_'):][:15], '%Y%m%d_%H%M%S')
+        except ValueError:
+            created_at = datetime.now()
+        metadata.insert_one({
+            'name': name,
+            'type': 'full',
+            'base': name,
+            'collection': name,
+            'created_at': created_at,
+            'document_count': db[name].estimated_document_count(),
+            'changeset_recorded': False,
+            'chain_closed': True
+        })
+
+
+def create_backup(db, sales_collection):
+    """
+    Create a backup point for the current state of sales and return its name.
+    A delta is used when the previous backup point recorded its changeset and
+    the chain since the last full snapshot is shorter than BACKUP_FULL_EVERY.
+    """
+    ensure_initialized(db)
+    metadata = metadata_collection(db)
+    latest = metadata.find_one(sort=[('created_at', DESCENDING)])
+
+    # Dates are stored with millisecond precision, keep them strictly increasing
+    # so backup points taken within the same millisecond still chain in order
+    now = datetime.now()
+    created_at = now.replace(microsecond=now.microsecond // 1000 * 1000)
+    if latest is not None and created_at <= latest['created_at']:
+        created_at = latest['created_at'] + timedelta(milliseconds=1)
+    name = f"sales_backup_{created_at.strftime('%Y%m%d_%H%M%S_%f')}"
+
+    use_delta = (
+        latest is not None
+        and latest.get('changeset_recorded')
+        and not latest.get('chain_closed')
+        and metadata.count_documents({'base': latest['base']}) < BACKUP_FULL_EVERY
+    )
+
+    if use_delta:
+        record = {
+            'name': name,
+            'type': 'delta',
+            'base': latest['base'],
+            'collection': None
+        }
+    else:
+        # Copy inside the database with $out, no documents pass through the worker
+        sales_collection.aggregate([{'$match': {}}, {'$out': name}])
+        record = {
+            'name': name,
+            'type': 'full',
+            'base': name,
+            'collection': name
+        }
+
+    record.update({
+        'created_at': created_at,
+        'document_count': sales_collection.estimated_document_count(),
+        'changeset_recorded': False,
+        'chain_closed': False
+    })
+    metadata.insert_one(record)
+
+    try:
+        prune_backups(db)
+    except Exception:
+        # Retention problems should never fail the merge itself
+        traceback.print_exc()
+
+    return name
+
+
+def record_changeset(db, sales_collection, backup_name, changed_ids, deleted_ids):
+    """
+    Record the changes a merge made after backup_name was taken. The current
+    versions of changed_ids are copied server-side into the changeset collection.
+    """
+    changesets = changeset_collection(db)
+    changed_ids = list(changed_ids)
+    deleted_ids = list(deleted_ids)
+
+    if changed_ids:
+        sales_collection.aggregate([
+            {'$match': {'_id': {'$in': changed_ids}}},
+            {'$project': {'_id': 0, 'backup': {'$literal': backup_name}, 'op': {'$literal': 'upsert'}, 'doc': '$$ROOT'}},
+            {'$merge': {'into': BACKUP_CHANGESET_COLLECTION, 'whenMatched': 'fail', 'whenNotMatched': 'insert'}}
+        ])
+    if deleted_ids:
+        changesets.insert_many([{'backup': backup_name, 'op': 'delete', 'doc_id': doc_id} for doc_id in deleted_ids])
+
+    metadata_collection(db).update_one({'name': backup_name}, {'$set': {
+        'changeset_recorded': True,
+        'changed_count': len(changed_ids),
+        'deleted_count': len(deleted_ids)
+    }})
+
+
+def invalidate_backup_chain(db):
+    """
+    Called after writes that do not record a changeset (single inserts, clears,
+    restores) so the next backup point is a full snapshot.
+    """
+    latest = metadata_collection(db).find_one(sort=[('created_at', DESCENDING)], projection={'_id': 1})
+    if latest:
+        metadata_collection(db).update_one({'_id': latest['_id']}, {'$set': {'chain_closed': True}})
+
+
+def changed_document_ids(before, after):
+    """
+    Compare documents before and after a merge by _id and return the ids that
+    were inserted or replaced, and the ids that were removed.
+    """
+    before_by_id = {str(doc['_id']): doc for doc in before}
+    changed_ids = []
+    seen = set()
+    for doc in after:
+        doc_id = str(doc['_id'])
+        seen.add(doc_id)
+        old = before_by_id.get(doc_id)
+        if old is doc:
+            continue
+        if old is None or strip_id(old) != strip_id(doc):
+            changed_ids.append(doc['_id'])
+    deleted_ids = [to_object_id(doc_id) for doc_id in before_by_id if doc_id not in seen]
+    return changed_ids, deleted_ids
+
+
+def strip_id(doc):
+    return {key: value for key, value in doc.items() if key != '_id'}
+
+
+def to_object_id(value):
+    try:
+        return ObjectId(value)
+    except (InvalidId, TypeError):
+        return value
+
+
+BACKUP_LIST_PROJECTION = {'_id': 0, 'name': 1, 'type': 1, 'base': 1, 'created_at': 1,
+                          'document_count': 1, 'changed_count': 1, 'deleted_count': 1}
+
+
+def list_backups(db):
+    """Return backup metadata, newest first, with a single indexed query"""
+    ensure_initialized(db)
+    return list(metadata_collection(db).find({}, BACKUP_LIST_PROJECTION).sort('created_at', DESCENDING))
+
+
+async def list_backups_async(db):
+    """list_backups for an AsyncMongoClient database, ensure_initialized must have run with a sync client"""
+    cursor = metadata_collection(db).find({}, BACKUP_LIST_PROJECTION).sort('created_at', DESCENDING)
+    return await cursor.to_list()
+
+
+def restore_backup(db, sales_collection, backup_name):
+    ensure_initialized(db)
+    metadata = metadata_collection(db)
+    backup = metadata.find_one({'name': backup_name})
+    if backup is None:
+        raise ValueError(f'Backup not found: {backup_name}')
+
+    if backup['type'] == 'full':
+        # $out writes into a temporary collection and renames it over sales, so
+        # readers never see an empty collection and the sales indexes are kept
+        db[backup['collection']].aggregate([{'$match': {}}, {'$out': sales_collection.name}])
+    else:
+        restore_delta(db, sales_collection, backup)
+
+    invalidate_backup_chain(db)
+
+
+def restore_delta(db, sales_collection, backup):
+    """Rebuild a delta backup point from its snapshot and changesets, then swap it in"""
+    metadata = metadata_collection(db)
+    changesets = changeset_collection(db)
+    base = metadata.find_one({'name': backup['base']})
+    if base is None:
+        raise ValueError(f"Snapshot {backup['base']} for backup {backup['name']} was pruned")
+
+    chain = list(metadata.find({'base': backup['base'], 'created_at': {'$lt': backup['created_at']}})
+                 .sort('created_at', ASCENDING))
+    if not all(entry.get('changeset_recorded') for entry in chain):
+        raise ValueError(f"Backup {backup['name']} can not be rebuilt, a merge before it did not complete")
+
+    staging_name = f'{sales_collection.name}_restore_{backup["name"]}'
+    staging = db[staging_name]
+    db[base['collection']].aggregate([{'$match': {}}, {'$out': staging_name}])
+
+    try:
+        for entry in chain:
+            changesets.aggregate([
+                {'$match': {'backup': entry['name'], 'op': 'upsert'}},
+                {'$replaceRoot': {'newRoot': '$doc'}},
+                {'$merge': {'into': staging_name, 'on': '_id', 'whenMatched': 'replace', 'whenNotMatched': 'insert'}}
+            ])
+            deleted_ids = [change['doc_id'] for change in
+                           changesets.find({'backup': entry['name'], 'op': 'delete'}, {'doc_id': 1})]
+            if deleted_ids:
+                staging.delete_many({'_id': {'$in': deleted_ids}})
+
+        copy_indexes(sales_collection, staging)
+        # Renaming over sales swaps the rebuilt data in atomically
+        staging.rename(sales_collection.name, dropTarget=True)
+    except Exception:
+        staging.drop()
+        raise
+
+
+def copy_indexes(source, target):
+    for name, info in source.index_information().items():
+        if name == '_id_':
+            continue
+        options = {key: value for key, value in info.items() if key not in ('key', 'v', 'ns')}
+        target.create_index(info['key'], name=name, **options)
+
+
+def prune_backups(db):
+    """
+    Apply the retention policy: keep the newest BACKUP_KEEP_SNAPSHOTS snapshots
+    and drop older ones (or ones past BACKUP_MAX_AGE_DAYS) along with their deltas.
+    """
+    metadata = metadata_collection(db)
+    snapshots = list(metadata.find({'type': 'full'}, {'name': 1, 'collection': 1, 'created_at': 1})
+                     .sort('created_at', DESCENDING))
+
+    expired = snapshots[max(BACKUP_KEEP_SNAPSHOTS, 1):]
+    if BACKUP_MAX_AGE_DAYS:
+        cutoff = datetime.now() - timedelta(days=BACKUP_MAX_AGE_DAYS)
+        # The newest snapshot is always kept so there is something to restore
+        expired += [snapshot for snapshot in snapshots[1:max(BACKUP_KEEP_SNAPSHOTS, 1)]
+                    if snapshot['created_at'] < cutoff]
+
+    for snapshot in expired:
+        chain = metadata.distinct('name', {'base': snapshot['name']})
+        changeset_collection(db).delete_many({'backup': {'$in': chain}})
+        metadata.delete_many({'base': snapshot['name']})
+        db.drop_collection(snapshot['collection'])
+
+    return [snapshot['name'] for snapshot in expired]
@@ -0,0 +1,386 @@
+"""
+End-to-end benchmark of the API.
+
+Drives the Flask app through its test client, against mongomock by default
+(which measures the app's own cost) or a throwaway MongoDB database given
+with --mongo-uri (every collection in it is dropped). Every scenario runs in
+a fresh process, so the peak RSS reported is the scenario's own.
+
+Scenarios:
+  upload_preview:<format>  POST /api/upload-preview of --rows records, every upload format
+  merge_mappings:<mode>    POST /api/process-merge-mappings of --rows records, half of them new,
+                           into --rows existing documents, replace and upsert modes
+  get_sales                GET /api/sales pages of --page-size, response cache off
+  get_sales:cached         the same with the response cache on
+  backup                   backups.create_backup of --rows documents, a full snapshot each time
+  restore                  POST /api/restore-backup of a full snapshot of --rows documents
+
+Each scenario reports throughput (records per second), requests per second,
+latency percentiles and peak RSS. --output saves the run as JSON; with
+--baseline the run is compared with a saved one and scenarios whose median
+latency grew by more than --tolerance are flagged (exit status 1).
+
+mongomock has no $merge stage and no $type or $substrCP expressions (restore
+rebuilds the analytics rollups with them), so for mongomock runs they are emulated client
+side. Only the MongoDB client is replaced, the requests still go through the
+tenant scoped collections of the default tenant.
+
+    python benchmarks/bench_app.py --rows 5000 --output results.json
+    python benchmarks/bench_app.py --baseline benchmarks/baseline.json
+    python benchmarks/bench_app.py --mongo-uri mongodb://localhost:27017/rocketboard_bench --scenarios get_sales restore
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import get_context
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from datagen import FORMATS, make_sales, make_upload  # noqa: E402
+
+SCENARIOS = ([f'upload_preview:{upload_format}' for upload_format in FORMATS]
+             + ['merge_mappings:replace', 'merge_mappings:upsert', 'get_sales', 'get_sales:cached',
+                'backup', 'restore'])
+
+
+class ScenarioFailed(Exception):
+    pass
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def emulate_merge_stage():
+    """Run a final $merge stage of a mongomock aggregation client side"""
+    from mongomock.collection import Collection
+    from pymongo.errors import DuplicateKeyError
+    aggregate = Collection.aggregate
+
+    def aggregate_with_merge(self, pipeline, *args, **kwargs):
+        if not pipeline or '$merge' not in pipeline[-1]:
+            return aggregate(self, pipeline, *args, **kwargs)
+        spec = pipeline[-1]['$merge']
+        target = self.database[spec['into']]
+        on = spec.get('on', '_id')
+        on = [on] if isinstance(on, str) else on
+        for doc in aggregate(self, pipeline[:-1], *args, **kwargs):
+            existing = target.find_one({field: doc.get(field) for field in on}) if all(
+                field in doc for field in on) else None
+            if existing is None:
+                if spec.get('whenNotMatched', 'insert') == 'insert':
+                    target.insert_one(doc)
+            elif spec.get('whenMatched', 'merge') == 'replace':
+                target.replace_one({'_id': existing['_id']}, {**doc, '_id': existing['_id']})
+            elif spec.get('whenMatched', 'merge') == 'merge':
+                target.update_one({'_id': existing['_id']}, {'$set': {k: v for k, v in doc.items() if k != '_id'}})
+            elif spec.get('whenMatched') == 'fail':
+                raise DuplicateKeyError(f"$merge found a matching document in {spec['into']}")
+        return iter([])
+
+    Collection.aggregate = aggregate_with_merge
+
+
+def emulate_missing_expressions():
+    """Add the $type and $substrCP aggregation expressions, which mongomock lacks (used by the day rollup)"""
+    from bson.objectid import ObjectId
+    from mongomock import aggregate
+
+    if '$type' in aggregate.type_operators:
+        return
+    handle_type_operator = aggregate._Parser._handle_type_operator
+    handle_string_operator = aggregate._Parser._handle_string_operator
+
+    def bson_type(value):
+        if value is None:
+            return 'null'
+        if isinstance(value, bool):
+            return 'bool'
+        if isinstance(value, int):
+            return 'int' if -2 ** 31 <= value < 2 ** 31 else 'long'
+        names = ((float, 'double'), (str, 'string'), (datetime, 'date'), (dict, 'object'),
+                 ((list, tuple), 'array'), (ObjectId, 'objectId'))
+        return next((name for kinds, name in names if isinstance(value, kinds)), type(value).__name__)
+
+    def type_operator(self, operator, values):
+        if operator != '$type':
+            return handle_type_operator(self, operator, values)
+        try:
+            return bson_type(self.parse(values))
+        except KeyError:
+            return 'missing'
+
+    def string_operator(self, operator, values):
+        if operator != '$substrCP':
+            return handle_string_operator(self, operator, values)
+        string, start, length = self.parse_many(values)
+        return (string or '')[start:start + length]
+
+    aggregate.type_operators.append('$type')
+    aggregate._Parser._handle_type_operator = type_operator
+    aggregate._Parser._handle_string_operator = string_operator
+
+
+def setup_app(mongo_uri):
+    """Import the app against mongomock or the given database, and return (main, db)"""
+    os.environ['MONGO_URI'] = mongo_uri or 'mongodb://127.0.0.1:27017/bench'
+    os.chdir(ROOT)
+    import main
+
+    if mongo_uri:
+        db = main.mongo.db
+        for name in db.list_collection_names():
+            db.drop_collection(name)
+        return main, db
+
+    import mongomock
+    emulate_merge_stage()
+    emulate_missing_expressions()
+    db = mongomock.MongoClient().bench
+
+    # Only the client is replaced, requests still go through the tenant scoped collections
+    class Mongo:
+        pass
+    main.mongo = Mongo()
+    main.mongo.db = db
+    main.job_queue.tasks = db.tasks
+    main.job_queue.recovered = True
+    return main, db
+
+
+def seed(main, sales):
+    main.sales_collection.delete_many({})
+    main.sales_collection.insert_many([dict(sale) for sale in sales])
+
+
+def check(response):
+    if response.status_code != 200:
+        body = response.get_json(silent=True) or response.get_data(as_text=True)[:500]
+        raise ScenarioFailed(f'{response.status_code}: {body}')
+    return response
+
+
+def run_upload_preview(main, db, client, args, upload_format):
+    filename, content = make_upload(make_sales(args.rows, extra_fields=args.extra_fields), upload_format)
+    latencies = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        check(client.post('/api/upload-preview', data={'file': (io.BytesIO(content), filename)},
+                          content_type='multipart/form-data'))
+        latencies.append(time.perf_counter() - start)
+    return latencies, args.rows, {'upload_bytes': len(content)}
+
+
+def run_merge_mappings(main, db, client, args, mode):
+    existing = make_sales(args.rows, extra_fields=args.extra_fields)
+    # Half of the upload updates existing transactions, half of it is new
+    upload = make_sales(args.rows, seed=7, extra_fields=args.extra_fields, first_id=args.rows // 2)
+    new_data = [{f'source_{field}': value for field, value in sale.items()} for sale in upload]
+    payload = {
+        'new_data': new_data,
+        'field_mappings': {'mappings': [{'existing': field, 'new': f'source_{field}'} for field in upload[0]]},
+        'matching_fields': ['transaction_id'],
+        'mode': mode
+    }
+    latencies = []
+    for _ in range(args.repeat):
+        seed(main, existing)
+        start = time.perf_counter()
+        check(client.post('/api/process-merge-mappings', json=payload))
+        latencies.append(time.perf_counter() - start)
+    return latencies, args.rows, {'existing_documents': args.rows}
+
+
+def run_get_sales(main, db, client, args, cached=False):
+    seed(main, make_sales(args.rows, extra_fields=args.extra_fields))
+    main.sales_cache.enabled = cached
+    latencies = []
+    records = 0
+    after = None
+    for _ in range(args.requests):
+        url = f'/api/sales?limit={args.page_size}' + (f'&after={after}' if after else '')
+        start = time.perf_counter()
+        page = check(client.get(url)).get_json()
+        latencies.append(time.perf_counter() - start)
+        records += len(page['sales'])
+        after = page['next_after']  # back to the first page after the last one
+    return latencies, records / len(latencies), {'page_size': args.page_size}
+
+
+def run_backup(main, db, client, args):
+    import backups
+    seed(main, make_sales(args.rows, extra_fields=args.extra_fields))
+    latencies = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        backups.create_backup(db, main.sales_collection)
+        latencies.append(time.perf_counter() - start)
+    return latencies, args.rows, {}
+
+
+def run_restore(main, db, client, args):
+    import backups
+    seed(main, make_sales(args.rows, extra_fields=args.extra_fields))
+    backup_name = backups.create_backup(db, main.sales_collection)
+    latencies = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        check(client.post('/api/restore-backup', json={'backup_name': backup_name}))
+        latencies.append(time.perf_counter() - start)
+    return latencies, args.rows, {}
+
+
+def run_scenario(scenario, args):
+    """Run one scenario in this (fresh) process and return its result"""
+    name, _, variant = scenario.partition(':')
+    result = {'scenario': scenario}
+    try:
+        main, db = setup_app(args.mongo_uri)
+        client = main.app.test_client()
+        result['rss_before_mb'] = round(peak_rss_mb(), 1)
+        if name == 'upload_preview':
+            latencies, records, details = run_upload_preview(main, db, client, args, variant)
+        elif name == 'merge_mappings':
+            latencies, records, details = run_merge_mappings(main, db, client, args, variant)
+        elif name == 'get_sales':
+            latencies, records, details = run_get_sales(main, db, client, args, cached=variant == 'cached')
+        elif name == 'backup':
+            latencies, records, details = run_backup(main, db, client, args)
+        elif name == 'restore':
+            latencies, records, details = run_restore(main, db, client, args)
+        else:
+            raise ScenarioFailed(f'Unknown scenario: {scenario}')
+    except Exception as e:
+        result.update({'status': 'failed', 'detail': f'{type(e).__name__}: {str(e)[:500]}'})
+        return result
+
+    total = sum(latencies)
+    result.update({
+        'status': 'ok',
+        'requests': len(latencies),
+        'records_per_request': records,
+        'throughput': round(records * len(latencies) / total, 1),
+        'requests_per_second': round(len(latencies) / total, 2),
+        'latency_ms': latency_percentiles(latencies),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        **details
+    })
+    return result
+
+
+def latency_percentiles(latencies):
+    ordered = sorted(latencies)
+    if len(ordered) > 1:
+        cuts = statistics.quantiles(ordered, n=100, method='inclusive')
+        p50, p95, p99 = cuts[49], cuts[94], cuts[98]
+    else:
+        p50 = p95 = p99 = ordered[0]
+    return {'p50': round(p50 * 1000, 2), 'p95': round(p95 * 1000, 2), 'p99': round(p99 * 1000, 2),
+            'max': round(ordered[-1] * 1000, 2)}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    """Print the change against the baseline, return the scenarios that got slower"""
+    previous = {result['scenario']: result for result in baseline['results'] if result['status'] == 'ok'}
+    regressions = []
+    print(f"\nagainst baseline {baseline.get('git_commit') or ''} ({baseline['created_at']}), "
+          f'tolerance {tolerance:.0%}')
+    print(f"{'scenario':>24} {'p50 ms':>10} {'was':>10} {'change':>8} {'records/s':>10} {'was':>10}")
+    for result in results:
+        before = previous.get(result['scenario'])
+        if result['status'] != 'ok' or before is None:
+            continue
+        p50, was = result['latency_ms']['p50'], before['latency_ms']['p50']
+        change = p50 / was - 1 if was else 0
+        flag = ' slower' if change > tolerance else ''
+        if flag:
+            regressions.append(result['scenario'])
+        print(f"{result['scenario']:>24} {p50:10.2f} {was:10.2f} {change:+8.1%} "
+              f"{result['throughput']:10.0f} {before['throughput']:10.0f}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mongo-uri', help='throwaway database, all of its collections are dropped')
+    parser.add_argument('--scenarios', nargs='+', default=SCENARIOS,
+                        help='scenario names, a name without :variant runs all its variants')
+    parser.add_argument('--rows', type=int, default=5_000)
+    parser.add_argument('--extra-fields', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5, help='requests per upload, merge, backup and restore')
+    parser.add_argument('--requests', type=int, default=200, help='requests per GET /api/sales scenario')
+    parser.add_argument('--page-size', type=int, default=500)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='compare with the results saved in this file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed growth of the median latency')
+    args = parser.parse_args()
+
+    scenarios = [scenario for scenario in SCENARIOS
+                 if scenario in args.scenarios or scenario.partition(':')[0] in args.scenarios]
+    backend = 'MongoDB' if args.mongo_uri else 'mongomock'
+    print(f'{args.rows} rows, {backend}, {os.cpu_count()} cores')
+    print(f"{'scenario':>24} {'records/s':>10} {'req/s':>8} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} "
+          f"{'peak MB':>8}")
+
+    results = []
+    context = get_context('spawn')
+    for scenario in scenarios:
+        # A fresh process per scenario keeps the peak RSS of one from hiding the next
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            result = executor.submit(run_scenario, scenario, args).result()
+        results.append(result)
+        if result['status'] != 'ok':
+            print(f"{scenario:>24} failed: {result['detail'][:200]}")
+            continue
+        latency = result['latency_ms']
+        print(f"{scenario:>24} {result['throughput']:10.0f} {result['requests_per_second']:8.2f} "
+              f"{latency['p50']:10.2f} {latency['p95']:10.2f} {latency['p99']:10.2f} {result['peak_rss_mb']:8.1f}")
+
+    run = {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'git_commit': git_commit(),
+        'backend': backend,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'settings': {'rows': args.rows, 'extra_fields': args.extra_fields, 'repeat': args.repeat,
+                     'requests': args.requests, 'page_size': args.page_size},
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(run, f, indent=2)
+        print(f'\nResults written to {args.output}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('settings') != run['settings'] or baseline.get('backend') != backend:
+            print('\nWarning: the baseline was recorded with different settings or backend')
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\nSlower than the baseline: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Benchmark for bulk ingestion.
+
+Inserts the same documents one insert_one at a time, with a single
+insert_many, and with bulk_ingest.insert_in_batches at several batch sizes
+and in-flight limits, and reports records per second. Point --mongo-uri at a
+throwaway database for real numbers; without it the benchmark runs against
+mongomock, which only measures the client-side cost.
+
+    python benchmarks/bench_bulk_insert.py --mongo-uri mongodb://localhost:27017/bench
+    python benchmarks/bench_bulk_insert.py --rows 100000 --batch-sizes 500 1000 5000 --in-flight 1 4 8
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bulk_ingest  # noqa: E402
+from bench_normalize import make_rows  # noqa: E402
+
+
+def get_collection(mongo_uri):
+    if mongo_uri:
+        from pymongo import MongoClient
+        return MongoClient(mongo_uri).get_default_database()['bench_bulk_insert']
+    import mongomock
+    return mongomock.MongoClient().db['bench_bulk_insert']
+
+
+def make_documents(count):
+    return [
+        {**{k: v for k, v in row.items() if k not in ('location', 'gender')},
+         'sales_amount': float(row['sales_amount']), 'units_sold': int(row['units_sold']),
+         'customer': {'location': row['location'], 'gender': row['gender']}}
+        for row in make_rows(count)
+    ]
+
+
+def timed_run(collection, documents, insert):
+    collection.drop()
+    # Fresh copies, insert_many adds _id to the documents it is given
+    documents = [dict(doc) for doc in documents]
+    start = time.perf_counter()
+    insert(collection, documents)
+    elapsed = time.perf_counter() - start
+    assert collection.count_documents({}) == len(documents)
+    return elapsed
+
+
+def insert_one_each(collection, documents):
+    for doc in documents:
+        collection.insert_one(doc)
+
+
+def insert_many_once(collection, documents):
+    collection.insert_many(documents, ordered=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mongo-uri')
+    parser.add_argument('--rows', type=int, default=50_000)
+    parser.add_argument('--single-rows', type=int, default=5_000, help='rows used for the insert_one run')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[100, 1000, 5000])
+    parser.add_argument('--in-flight', type=int, nargs='+', default=[1, 4])
+    args = parser.parse_args()
+
+    collection = get_collection(args.mongo_uri)
+    documents = make_documents(args.rows)
+    print(f"{args.rows} documents, {'MongoDB' if args.mongo_uri else 'mongomock'}")
+    print(f"{'method':>28} {'time (s)':>9} {'records/s':>10}")
+
+    single = documents[:args.single_rows]
+    elapsed = timed_run(collection, single, insert_one_each)
+    print(f"{'insert_one per document':>28} {elapsed:9.3f} {len(single) / elapsed:10.0f}")
+
+    elapsed = timed_run(collection, documents, insert_many_once)
+    print(f"{'insert_many, one call':>28} {elapsed:9.3f} {len(documents) / elapsed:10.0f}")
+
+    for batch_size in args.batch_sizes:
+        for in_flight in args.in_flight:
+            elapsed = timed_run(collection, documents, lambda c, d: bulk_ingest.insert_in_batches(
+                c, d, batch_size=batch_size, max_in_flight=in_flight))
+            label = f'batches of {batch_size}, {in_flight} in flight'
+            print(f'{label:>28} {elapsed:9.3f} {len(documents) / elapsed:10.0f}')
+
+    collection.drop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""
+Benchmark for merge_with_existing_data.
+
+Times the hash-indexed merge engine against the old pairwise scan on
+synthetic sales data. The pairwise scan is O(N x M), so it is only run up to
+--scan-limit records.
+
+    python benchmarks/bench_merge.py
+    python benchmarks/bench_merge.py --sizes 1000 10000 --scan-limit 10000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from merge_engine import merge_records, merge_with_existing_data, records_match  # noqa: E402
+
+PRODUCTS = ['Widget', 'Gadget', 'Doohickey', 'Gizmo', 'Thingamajig']
+LOCATIONS = ['New York', 'Chicago', 'Houston', 'Phoenix', 'Seattle']
+GENDERS = ['Male', 'Female', 'Other']
+
+
+def make_records(count, seed):
+    rng = random.Random(seed)
+    return [
+        {
+            'transaction_id': f'T{i:08d}',
+            'product': rng.choice(PRODUCTS),
+            'sales_amount': round(rng.uniform(5, 500), 2),
+            'units_sold': rng.randint(1, 20),
+            'customer': {'location': rng.choice(LOCATIONS), 'gender': rng.choice(GENDERS)},
+        }
+        for i in range(count)
+    ]
+
+
+def make_upload(existing, count, seed):
+    """Half of the upload updates existing records, the other half is new"""
+    rng = random.Random(seed)
+    upload = []
+    for i in range(count):
+        if i % 2 == 0 and existing:
+            source = existing[rng.randrange(len(existing))]
+            upload.append({'transaction_id': source['transaction_id'],
+                           'customer': {'location': source['customer']['location']},
+                           'units_sold': rng.randint(1, 20)})
+        else:
+            upload.append({'transaction_id': f'N{i:08d}',
+                           'customer': {'location': rng.choice(LOCATIONS)},
+                           'units_sold': rng.randint(1, 20)})
+    return upload
+
+
+def merge_with_existing_data_scan(existing_data, new_data, matching_fields):
+    """The previous pairwise implementation, kept here for comparison"""
+    merged_data = []
+    processed_existing_data = set()
+    for new_record in new_data:
+        match_found = False
+        for i, existing_record in enumerate(existing_data):
+            if i in processed_existing_data:
+                continue
+            if records_match(existing_record, new_record, matching_fields):
+                match_found = True
+                processed_existing_data.add(i)
+                merged_data.append(merge_records(existing_record, new_record))
+                break
+        if not match_found:
+            merged_data.append(new_record)
+    for i, existing_record in enumerate(existing_data):
+        if i not in processed_existing_data:
+            merged_data.append(existing_record)
+    return merged_data
+
+
+def time_call(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 10_000, 100_000, 1_000_000],
+                        help='number of existing records per run')
+    parser.add_argument('--upload-ratio', type=float, default=0.05,
+                        help='size of the upload relative to the existing records')
+    parser.add_argument('--scan-limit', type=int, default=10_000,
+                        help='largest size the old pairwise scan is run for')
+    parser.add_argument('--matching-fields', nargs='+', default=['transaction_id', 'customer.location'])
+    args = parser.parse_args()
+
+    print(f"{'existing':>10} {'upload':>8} {'indexed (s)':>12} {'scan (s)':>10} {'speedup':>8}")
+    for size in args.sizes:
+        existing = make_records(size, seed=size)
+        upload = make_upload(existing, max(1, int(size * args.upload_ratio)), seed=size + 1)
+
+        indexed_time, indexed_result = time_call(merge_with_existing_data, existing, upload, args.matching_fields)
+
+        if size <= args.scan_limit:
+            scan_time, scan_result = time_call(merge_with_existing_data_scan, existing, upload, args.matching_fields)
+            if scan_result != indexed_result:
+                raise SystemExit(f'Results differ for {size} records')
+            scan_col = f'{scan_time:10.3f}'
+            speedup_col = f'{scan_time / indexed_time:7.1f}x'
+        else:
+            scan_col = f"{'-':>10}"
+            speedup_col = f"{'-':>8}"
+
+        print(f'{size:>10} {len(upload):>8} {indexed_time:12.3f} {scan_col} {speedup_col}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""
+Benchmark for upload normalization.
+
+Compares the old per-row CSV/JSON coercion loops with the normalization
+stage: vectorized normalize_frame for CSV, including turning rows into
+documents at the end, and the in-place normalize_records for JSON, which
+also counts coercion errors. JSON is not columnar (see normalize_records), so
+it is only expected to be level with the old loop, not faster.
+
+    python benchmarks/bench_normalize.py
+    python benchmarks/bench_normalize.py --rows 100000 1000000
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ingestion import frame_to_records, normalize_frame, normalize_records, read_csv_frames  # noqa: E402
+
+PRODUCTS = ['Widget', 'Gadget', 'Doohickey', 'Gizmo', 'Thingamajig']
+LOCATIONS = ['New York', 'Chicago', 'Houston', 'Phoenix', 'Seattle']
+GENDERS = ['Male', 'Female', 'Other']
+
+
+def make_rows(count, seed=42):
+    rng = random.Random(seed)
+    return [
+        {
+            'transaction_id': f'T{i:08d}',
+            'product': rng.choice(PRODUCTS),
+            'sales_amount': f'{rng.uniform(5, 500):.2f}',
+            'units_sold': str(rng.randint(1, 20)),
+            'location': rng.choice(LOCATIONS),
+            'gender': rng.choice(GENDERS),
+        }
+        for i in range(count)
+    ]
+
+
+def make_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=list(rows[0]))
+    writer.writeheader()
+    writer.writerows(rows)
+    return buffer.getvalue().encode()
+
+
+def make_json(rows):
+    return json.dumps([
+        {**{k: v for k, v in row.items() if k not in ('location', 'gender')},
+         'customer': {'location': row['location'], 'gender': row['gender']}}
+        for row in rows
+    ]).encode()
+
+
+def legacy_csv(content):
+    """The previous process_csv loop"""
+    decoded_file = io.StringIO(content.decode('utf-8', errors='ignore'))
+    data = []
+    for row in csv.DictReader(decoded_file):
+        try:
+            row['sales_amount'] = float(row.get('sales_amount', 0))
+        except ValueError:
+            row['sales_amount'] = 0.0
+        try:
+            row['units_sold'] = int(row.get('units_sold', 0))
+        except ValueError:
+            row['units_sold'] = 0
+        row['customer'] = {'location': row.pop('location', None), 'gender': row.pop('gender', None)}
+        data.append(row)
+    return data
+
+
+def columnar_csv(content):
+    frame, _ = normalize_frame(read_csv_frames(io.BytesIO(content)), nest_customer=True)
+    return frame_to_records(frame)
+
+
+def legacy_json(content):
+    """The previous process_json loop"""
+    data = json.loads(content)
+    for record in data:
+        record['sales_amount'] = float(record.get('sales_amount', 0))
+        record['units_sold'] = int(record.get('units_sold', 0))
+    return data
+
+
+def columnar_json(content):
+    data = json.loads(content)
+    normalize_records(data)
+    return data
+
+
+def best_of(func, content, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(content)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'format':>6} {'rows':>9} {'per-row (s)':>12} {'normalized (s)':>15} {'speedup':>8}")
+    for count in args.rows:
+        rows = make_rows(count)
+        for name, content, legacy, columnar in (
+            ('csv', make_csv(rows), legacy_csv, columnar_csv),
+            ('json', make_json(rows), legacy_json, columnar_json),
+        ):
+            legacy_time = best_of(legacy, content, args.repeat)
+            columnar_time = best_of(columnar, content, args.repeat)
+            print(f'{name:>6} {count:>9} {legacy_time:12.3f} {columnar_time:15.3f} {legacy_time / columnar_time:7.2f}x')
+
+
+if __name__ == '__main__':
+    main()
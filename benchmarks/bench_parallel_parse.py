@@ -0,0 +1,71 @@
+"""
+Benchmark for parallel upload parsing.
+
+Parses the same CSV and NDJSON upload with 1, 2, 4 and 8 parse workers
+(1 parses in this process, chunk by chunk) and reports throughput and the
+speedup over one worker. The pools are warmed up first, so worker start-up
+is not counted. Speedup is bounded by the number of cores of the machine.
+
+    python benchmarks/bench_parallel_parse.py
+    python benchmarks/bench_parallel_parse.py --rows 2000000 --workers 1 2 4
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import parallel_parse  # noqa: E402
+from bench_normalize import make_csv, make_rows  # noqa: E402
+
+
+def make_ndjson(rows):
+    return b''.join(json.dumps(row).encode() + b'\n' for row in rows)
+
+
+def parse(filename, content, workers, chunk_bytes):
+    errors = {}
+    count = 0
+    for batch in parallel_parse.iter_parallel_batches(filename, io.BytesIO(content), errors,
+                                                      workers=workers, chunk_bytes=chunk_bytes):
+        count += len(batch)
+    return count
+
+
+def best_of(filename, content, workers, chunk_bytes, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        parse(filename, content, workers, chunk_bytes)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--chunk-bytes', type=int, default=parallel_parse.PARSE_CHUNK_BYTES)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows)
+    print(f'{args.rows} rows, {os.cpu_count()} cores, {args.chunk_bytes} byte chunks')
+    print(f"{'format':>7} {'workers':>8} {'time (s)':>9} {'rows/s':>10} {'speedup':>8}")
+    for filename, content in (('a.csv', make_csv(rows)), ('a.ndjson', make_ndjson(rows))):
+        baseline = None
+        for workers in args.workers:
+            # Start the pool and import the parsers in every worker before timing
+            warmup = content[:content.rfind(b'\n', 0, args.chunk_bytes * workers) + 1]
+            parse(filename, warmup, workers, args.chunk_bytes)
+            elapsed = best_of(filename, content, workers, args.chunk_bytes, args.repeat)
+            baseline = baseline or elapsed
+            print(f'{filename[2:]:>7} {workers:>8} {elapsed:9.3f} {args.rows / elapsed:10.0f} {baseline / elapsed:7.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""
+Synthetic sales data for the benchmarks.
+
+make_sales generates documents shaped like the ones the app stores: a
+transaction_id, an ISO date, product, numeric sales_amount and units_sold,
+a nested customer {location, gender} and optionally extra_fields more
+columns, alternating numbers and strings. make_upload serializes them in
+any upload format; tabular formats flatten customer into location and
+gender columns, which is how the app reads them back.
+
+    python benchmarks/datagen.py --rows 100000 --out /tmp/sales
+    python benchmarks/datagen.py --rows 1000000 --formats csv ndjson --extra-fields 10 --out /tmp/sales
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import random
+import sys
+from datetime import date, timedelta
+from xml.sax.saxutils import escape
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_normalize import GENDERS, LOCATIONS, PRODUCTS  # noqa: E402
+
+FORMATS = ('json', 'ndjson', 'csv', 'xlsx', 'xml')
+
+
+def make_sales(count, seed=42, extra_fields=0, first_id=0, start=date(2024, 1, 1), days=365):
+    rng = random.Random(seed)
+    sales = []
+    for i in range(first_id, first_id + count):
+        sale = {
+            'transaction_id': f'T{i:08d}',
+            'date': (start + timedelta(days=rng.randrange(days))).isoformat(),
+            'product': rng.choice(PRODUCTS),
+            'sales_amount': round(rng.uniform(5, 500), 2),
+            'units_sold': rng.randint(1, 20),
+            'customer': {'location': rng.choice(LOCATIONS), 'gender': rng.choice(GENDERS)}
+        }
+        for n in range(extra_fields):
+            sale[f'attribute_{n}'] = rng.randint(0, 1000) if n % 2 else f'value_{rng.randrange(100)}'
+        sales.append(sale)
+    return sales
+
+
+def flatten(sale):
+    row = {field: value for field, value in sale.items() if field != 'customer'}
+    row.update(sale.get('customer', {}))
+    return row
+
+
+def to_csv(sales):
+    rows = [flatten(sale) for sale in sales]
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=list(rows[0]))
+    writer.writeheader()
+    writer.writerows(rows)
+    return buffer.getvalue().encode()
+
+
+def to_xlsx(sales):
+    buffer = io.BytesIO()
+    pd.DataFrame([flatten(sale) for sale in sales]).to_excel(buffer, index=False)
+    return buffer.getvalue()
+
+
+def xml_element(name, value):
+    if isinstance(value, dict):
+        return f'<{name}>' + ''.join(xml_element(key, item) for key, item in value.items()) + f'</{name}>'
+    return f'<{name}>{escape(str(value))}</{name}>'
+
+
+def to_xml(sales):
+    return ('<?xml version="1.0" encoding="UTF-8"?><sales>'
+            + ''.join(xml_element('sale', sale) for sale in sales) + '</sales>').encode()
+
+
+def make_upload(sales, upload_format):
+    """Return (filename, content) of the sales in one of FORMATS"""
+    if upload_format == 'json':
+        content = json.dumps(sales).encode()
+    elif upload_format == 'ndjson':
+        content = b''.join(json.dumps(sale).encode() + b'\n' for sale in sales)
+    elif upload_format == 'csv':
+        content = to_csv(sales)
+    elif upload_format == 'xlsx':
+        content = to_xlsx(sales)
+    elif upload_format == 'xml':
+        content = to_xml(sales)
+    else:
+        raise ValueError(f'Unknown upload format: {upload_format}')
+    return f'sales.{upload_format}', content
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10_000)
+    parser.add_argument('--formats', nargs='+', choices=FORMATS, default=list(FORMATS))
+    parser.add_argument('--extra-fields', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--out', required=True, help='directory the files are written to')
+    args = parser.parse_args()
+
+    sales = make_sales(args.rows, args.seed, args.extra_fields)
+    os.makedirs(args.out, exist_ok=True)
+    for upload_format in args.formats:
+        filename, content = make_upload(sales, upload_format)
+        path = os.path.join(args.out, filename)
+        with open(path, 'wb') as f:
+            f.write(content)
+        print(f'{path}: {len(content)} bytes')
+
+
+if __name__ == '__main__':
+    main()
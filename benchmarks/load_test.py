@@ -0,0 +1,147 @@
+"""
+Load test for the read endpoints.
+
+Runs --concurrency closed-loop clients, each with its own keep-alive
+connection, against the given paths for --duration seconds and reports
+requests per second and p50/p95/p99 latency. With --compare it starts the
+Flask dev server, Gunicorn in WSGI mode and Gunicorn in ASGI mode one after
+the other on --port against the same MONGO_URI and prints one row per server.
+
+    python benchmarks/load_test.py --url http://127.0.0.1:5000 --concurrency 32
+    MONGO_URI=mongodb://localhost:27017/rocketboard python benchmarks/load_test.py --compare --workers 4
+"""
+import argparse
+import http.client
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+DEFAULT_PATHS = ['/api/sales?limit=100', '/api/sales-schema', '/api/list-backups']
+
+# Server modes started by --compare, the command and its SERVER_MODE
+SERVERS = {
+    'dev server': ([sys.executable, 'main.py'], 'wsgi'),
+    'gunicorn wsgi': (['gunicorn', '-c', 'gunicorn.conf.py'], 'wsgi'),
+    'gunicorn asgi': (['gunicorn', '-c', 'gunicorn.conf.py'], 'asgi')
+}
+
+
+def client(host, port, paths, deadline, latencies, errors):
+    connection = http.client.HTTPConnection(host, port, timeout=30)
+    index = 0
+    while time.perf_counter() < deadline:
+        path = paths[index % len(paths)]
+        index += 1
+        start = time.perf_counter()
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            response.read()
+            if response.status >= 400:
+                errors.append(response.status)
+                continue
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(type(e).__name__)
+            connection.close()
+            connection = http.client.HTTPConnection(host, port, timeout=30)
+            continue
+        latencies.append(time.perf_counter() - start)
+    connection.close()
+
+
+def run_load(url, paths, concurrency, duration):
+    parts = urlsplit(url)
+    latencies = []
+    errors = []
+    deadline = time.perf_counter() + duration
+    threads = [threading.Thread(target=client, args=(parts.hostname, parts.port or 80, paths, deadline,
+                                                     latencies, errors))
+               for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return summarize(latencies, errors, elapsed)
+
+
+def summarize(latencies, errors, elapsed):
+    if len(latencies) > 1:
+        cuts = statistics.quantiles(latencies, n=100)
+        p50, p95, p99 = cuts[49], cuts[94], cuts[98]
+    else:
+        p50 = p95 = p99 = latencies[0] if latencies else 0
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'rps': len(latencies) / elapsed,
+        'p50_ms': p50 * 1000,
+        'p95_ms': p95 * 1000,
+        'p99_ms': p99 * 1000
+    }
+
+
+def wait_until_up(url, timeout=30):
+    parts = urlsplit(url)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=2)
+            connection.request('GET', '/api/health')
+            connection.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.25)
+    raise RuntimeError(f'server at {url} did not come up')
+
+
+def start_server(name, port, workers):
+    command, mode = SERVERS[name]
+    env = dict(os.environ, PORT=str(port), WEB_CONCURRENCY=str(workers), FLASK_DEBUG='false',
+               SERVER_MODE=mode, GUNICORN_LOG_LEVEL='warning')
+    return subprocess.Popen(command, cwd=ROOT, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def print_row(label, result):
+    print(f"{label:>14} {result['requests']:>9} {result['errors']:>7} {result['rps']:>9.1f} "
+          f"{result['p50_ms']:>8.1f} {result['p95_ms']:>8.1f} {result['p99_ms']:>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='server to load, ignored with --compare')
+    parser.add_argument('--paths', nargs='+', default=DEFAULT_PATHS)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--compare', action='store_true', help='start and load each server mode in turn')
+    parser.add_argument('--port', type=int, default=5099, help='port of the servers started by --compare')
+    parser.add_argument('--workers', type=int, default=2, help='Gunicorn workers for --compare')
+    args = parser.parse_args()
+
+    print(f"{args.concurrency} clients, {args.duration:g}s, paths {' '.join(args.paths)}")
+    print(f"{'server':>14} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    if not args.compare:
+        print_row(urlsplit(args.url).netloc, run_load(args.url, args.paths, args.concurrency, args.duration))
+        return
+
+    url = f'http://127.0.0.1:{args.port}'
+    for name in SERVERS:
+        process = start_server(name, args.port, args.workers)
+        try:
+            wait_until_up(url)
+            print_row(name, run_load(url, args.paths, args.concurrency, args.duration))
+        finally:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Local stand-in for the remote merge service, for trying /api/upload and
+merge_client.py without the real service.
+
+Accepts the same POST /merge payload ({'local_data', 'new_data'} and, in
+delta mode, 'matching_fields'), gzip request bodies included, merges with
+merge_engine.merge_with_existing_data and answers {'merged_data': [...]}.
+--fail-first answers the first N requests with 503 to exercise the retries.
+
+    python benchmarks/merge_stub_server.py --port 5055 --matching-fields transaction_id
+    MERGE_SERVICE_URL=http://127.0.0.1:5055/merge MERGE_GZIP=true python main.py
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from merge_engine import merge_with_existing_data  # noqa: E402
+
+
+def make_handler(matching_fields, fail_first):
+    state = {'requests': 0}
+    lock = threading.Lock()
+
+    class MergeHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            with lock:
+                state['requests'] += 1
+                number = state['requests']
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if number <= fail_first:
+                self.reply(503, {'error': 'stub failure'})
+                return
+            if self.headers.get('Content-Encoding') == 'gzip':
+                body = gzip.decompress(body)
+            payload = json.loads(body)
+            fields = payload.get('matching_fields') or matching_fields
+            merged = merge_with_existing_data(payload['local_data'], payload['new_data'], fields)
+            self.log_message('merged %d local and %d new records on %s, %d request bytes',
+                             len(payload['local_data']), len(payload['new_data']), fields,
+                             int(self.headers.get('Content-Length', 0)))
+            self.reply(200, {'merged_data': merged})
+
+        def reply(self, status, data):
+            content = json.dumps(data, default=str).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+    return MergeHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--matching-fields', default='transaction_id',
+                        help='comma separated, used when the request does not name them')
+    parser.add_argument('--fail-first', type=int, default=0)
+    args = parser.parse_args()
+
+    matching_fields = [field.strip() for field in args.matching_fields.split(',') if field.strip()]
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(matching_fields, args.fail_first))
+    print(f'Merge stub listening on http://{args.host}:{args.port}/merge')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
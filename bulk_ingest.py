@@ -0,0 +1,88 @@
+"""
+Batched inserts with bounded concurrency.
+
+Records (any iterable, e.g. a request stream) are grouped into batches of
+BULK_BATCH_SIZE and written with unordered insert_many calls, up to
+BULK_MAX_IN_FLIGHT at a time on a small thread pool. Reading the next batch
+waits while that many are in flight, so a fast producer is slowed down to
+the speed of the database instead of piling records up in memory. Failed
+documents are reported per batch instead of failing the whole load.
+"""
+import contextvars
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo.errors import BulkWriteError
+
+from ingestion import iter_batches
+
+BULK_BATCH_SIZE = int(os.environ.get('BULK_BATCH_SIZE', 1000))
+# insert_many calls running at the same time for one load
+BULK_MAX_IN_FLIGHT = int(os.environ.get('BULK_MAX_IN_FLIGHT', 4))
+# Write errors kept per batch in the summary, the rest are only counted
+BULK_MAX_ERRORS_PER_BATCH = int(os.environ.get('BULK_MAX_ERRORS_PER_BATCH', 20))
+
+
+def insert_batch(collection, batch):
+    """Insert one batch unordered, returns (inserted count, write errors)"""
+    try:
+        result = collection.insert_many(batch, ordered=False)
+        return len(result.inserted_ids), []
+    except BulkWriteError as e:
+        return e.details.get('nInserted', 0), e.details.get('writeErrors', [])
+
+
+def insert_in_batches(collection, records, batch_size=BULK_BATCH_SIZE, max_in_flight=BULK_MAX_IN_FLIGHT,
+                      on_batch=None, summary=None):
+    """
+    Insert records batch by batch. on_batch(batch, failed_indexes) is called
+    in order for every finished batch, e.g. to collect the inserted ids.
+    Returns a summary with the inserted and failed counts, the errors of the
+    batches that had any, and the throughput in records per second. The
+    summary is filled in place when given, so when reading records fails
+    partway it still counts the batches that were written before the error.
+    """
+    summary = {} if summary is None else summary
+    summary.update({'inserted_count': 0, 'failed_count': 0, 'batch_count': 0, 'errors': []})
+    start = time.perf_counter()
+
+    def collect(number, batch, future):
+        inserted, write_errors = future.result()
+        failed_indexes = {error['index'] for error in write_errors}
+        summary['batch_count'] += 1
+        summary['inserted_count'] += inserted
+        summary['failed_count'] += len(batch) - inserted
+        if write_errors:
+            summary['errors'].append({
+                'batch': number,
+                'offset': number * batch_size,
+                'inserted_count': inserted,
+                'failed_count': len(batch) - inserted,
+                'errors': [
+                    {'index': number * batch_size + error['index'], 'code': error.get('code'),
+                     'message': error.get('errmsg')}
+                    for error in write_errors[:BULK_MAX_ERRORS_PER_BATCH]
+                ]
+            })
+        if on_batch:
+            on_batch(batch, failed_indexes)
+
+    with ThreadPoolExecutor(max_workers=max(max_in_flight, 1), thread_name_prefix='bulk-insert') as executor:
+        pending = deque()
+        try:
+            for number, batch in enumerate(iter_batches(records, batch_size)):
+                # Run with the caller's context variables, e.g. the current tenant
+                future = executor.submit(contextvars.copy_context().run, insert_batch, collection, batch)
+                pending.append((number, batch, future))
+                if len(pending) >= max_in_flight:
+                    collect(*pending.popleft())
+        finally:
+            # Batches already sent are written either way, count them
+            while pending:
+                collect(*pending.popleft())
+            elapsed = time.perf_counter() - start
+            summary['duration'] = round(elapsed, 4)
+            summary['throughput'] = round(summary['inserted_count'] / elapsed, 1) if elapsed else None
+    return summary
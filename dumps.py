@@ -0,0 +1,264 @@
+"""
+Streaming export and import of the sales collection.
+
+Formats:
+
+- ndjson.gz: gzip compressed MongoDB relaxed Extended JSON, one document per
+  line (the mongoexport format), so ObjectIds and dates survive a round trip
+- bson, bson.gz: concatenated BSON documents (the mongodump format). The
+  cursor returns raw BSON, which is written out as it is, without decoding
+- parquet: one row group per batch, nested objects become struct columns.
+  The schema is built by a first pass over the exported documents, before
+  any bytes are sent: it has every field path found in them, and a field
+  whose values have more than one type (or none but null) becomes a string
+  column. _id, ObjectIds and such mixed values are written as text, objects
+  and arrays in a string column as relaxed Extended JSON
+
+Exports read the cursor in batches of EXPORT_BATCH_SIZE and yield each batch
+as soon as it is encoded, so memory use does not grow with the collection.
+Imports decode the same formats into batches of documents for
+bulk_ingest.insert_in_batches. pyarrow is only needed for Parquet.
+"""
+import gzip
+import os
+import zlib
+from datetime import datetime
+
+import bson
+from bson import json_util
+from bson.codec_options import CodecOptions
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from bson.raw_bson import RawBSONDocument
+
+from ingestion import iter_batches, iter_ndjson_records
+
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 10000))
+EXPORT_GZIP_LEVEL = int(os.environ.get('EXPORT_GZIP_LEVEL', 6))
+# snappy, zstd, gzip, brotli, lz4 or none
+PARQUET_COMPRESSION = os.environ.get('PARQUET_COMPRESSION', 'zstd')
+
+FORMATS = {
+    'ndjson.gz': 'application/gzip',
+    'bson': 'application/octet-stream',
+    'bson.gz': 'application/gzip',
+    'parquet': 'application/vnd.apache.parquet'
+}
+
+
+def detect_format(filename):
+    """Format of an import file from its name, None when it is not one of FORMATS"""
+    filename = (filename or '').lower()
+    for dump_format in sorted(FORMATS, key=len, reverse=True):
+        if filename.endswith('.' + dump_format):
+            return dump_format
+    if filename.endswith(('.jsonl.gz', '.json.gz')):
+        return 'ndjson.gz'
+    return None
+
+
+def gzip_chunks(chunks, level=EXPORT_GZIP_LEVEL):
+    """Compress a stream of byte chunks into one gzip member"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # 31: gzip header and trailer
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def ndjson_chunks(cursor, batch_size):
+    for batch in iter_batches(cursor, batch_size):
+        yield ''.join(json_util.dumps(document, json_options=json_util.RELAXED_JSON_OPTIONS) + '\n'
+                      for document in batch).encode()
+
+
+def bson_chunks(cursor, batch_size):
+    for batch in iter_batches(cursor, batch_size):
+        yield b''.join(document.raw for document in batch)
+
+
+def new_type_node():
+    return {'kinds': set(), 'fields': {}, 'items': None}
+
+
+def observe_value(node, value):
+    """Record the type of one value (and of its fields or items) in a type node"""
+    if value is None:
+        node['kinds'].add('null')
+        return
+    if isinstance(value, bool):
+        kind = 'bool'
+    elif isinstance(value, int):
+        kind = 'int'
+    elif isinstance(value, float):
+        kind = 'float'
+    elif isinstance(value, datetime):
+        kind = 'datetime'
+    elif isinstance(value, dict):
+        kind = 'object'
+        for key, item in value.items():
+            observe_value(node['fields'].setdefault(key, new_type_node()), item)
+    elif isinstance(value, list):
+        kind = 'list'
+        node['items'] = node['items'] or new_type_node()
+        for item in value:
+            observe_value(node['items'], item)
+    else:
+        # Strings, ObjectIds, Decimal128 and anything else Arrow has no type for
+        kind = 'string'
+    node['kinds'].add(kind)
+
+
+def arrow_type(node, pa):
+    """Arrow type of a type node, fields seen with more than one type become strings"""
+    kinds = node['kinds'] - {'null'}
+    if kinds == {'int'}:
+        return pa.int64()
+    if kinds == {'float'} or kinds == {'int', 'float'}:
+        return pa.float64()
+    if kinds == {'bool'}:
+        return pa.bool_()
+    if kinds == {'datetime'}:
+        return pa.timestamp('ms')
+    if kinds == {'object'} and node['fields']:
+        return pa.struct([pa.field(key, arrow_type(child, pa)) for key, child in node['fields'].items()])
+    if kinds == {'list'} and node['items']['kinds'] - {'null'}:
+        return pa.list_(arrow_type(node['items'], pa))
+    return pa.string()
+
+
+def parquet_schema(cursor):
+    """
+    Arrow schema covering every document of the cursor: the union of all
+    field paths, each with the type of its values, or string when the
+    documents disagree on it.
+    """
+    import pyarrow as pa
+
+    root = new_type_node()
+    for document in cursor:
+        observe_value(root, document)
+    return pa.schema([pa.field(key, arrow_type(child, pa)) for key, child in root['fields'].items()])
+
+
+def arrow_value(value, value_type, pa):
+    """Convert a BSON value to fit its column type, values of a string column are written as text"""
+    if value is None:
+        return None
+    if pa.types.is_string(value_type):
+        if isinstance(value, str):
+            return value
+        if isinstance(value, (dict, list)):
+            return json_util.dumps(value, json_options=json_util.RELAXED_JSON_OPTIONS)
+        return str(value)
+    if pa.types.is_struct(value_type):
+        return {field.name: arrow_value(value.get(field.name), field.type, pa) for field in value_type}
+    if pa.types.is_list(value_type):
+        return [arrow_value(item, value_type.value_type, pa) for item in value]
+    if pa.types.is_floating(value_type):
+        return float(value)
+    return value
+
+
+class ChunkSink:
+    """Write-only file object for ParquetWriter, the written bytes are collected with take()"""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def parquet_chunks(cursor, batch_size, schema, compression=PARQUET_COMPRESSION):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    sink = ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression=compression)
+    for batch in iter_batches(cursor, batch_size):
+        columns = {field.name: [arrow_value(document.get(field.name), field.type, pa) for document in batch]
+                   for field in schema}
+        writer.write_table(pa.Table.from_pydict(columns, schema=schema))
+        yield sink.take()
+    writer.close()
+    yield sink.take()
+
+
+def raw_cursor(collection, query=None, projection=None, batch_size=EXPORT_BATCH_SIZE):
+    """Cursor over collection that returns undecoded BSON documents"""
+    raw = collection.with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+    return raw.find(query or {}, projection, batch_size=batch_size)
+
+
+def export_chunks(collection, dump_format, query=None, projection=None, batch_size=EXPORT_BATCH_SIZE):
+    """Yield the documents matching query in dump_format, one encoded batch at a time"""
+    if dump_format in ('bson', 'bson.gz'):
+        chunks = bson_chunks(raw_cursor(collection, query, projection, batch_size), batch_size)
+        return gzip_chunks(chunks) if dump_format == 'bson.gz' else chunks
+
+    cursor = collection.find(query or {}, projection, batch_size=batch_size)
+    if dump_format == 'ndjson.gz':
+        return gzip_chunks(ndjson_chunks(cursor, batch_size))
+    if dump_format == 'parquet':
+        # A first pass over the documents fixes the schema before any bytes are written
+        schema = parquet_schema(collection.find(query or {}, projection, batch_size=batch_size))
+        return parquet_chunks(cursor, batch_size, schema)
+    raise ValueError(f'Unknown export format: {dump_format}')
+
+
+def restore_object_id(document):
+    """Parquet stores _id as a string, turn it back into an ObjectId when it is one"""
+    if isinstance(document.get('_id'), str):
+        try:
+            document['_id'] = ObjectId(document['_id'])
+        except InvalidId:
+            pass
+    return document
+
+
+def without_nulls(value):
+    # Parquet has no missing values, fields a document did not have come back as null
+    return {key: without_nulls(item) if isinstance(item, dict) else item
+            for key, item in value.items() if item is not None}
+
+
+def iter_parquet_records(stream, batch_size=EXPORT_BATCH_SIZE):
+    """Documents of a Parquet file, read one row group batch at a time. The stream must be seekable."""
+    import pyarrow.parquet as pq
+
+    for batch in pq.ParquetFile(stream).iter_batches(batch_size=batch_size):
+        for row in batch.to_pylist():
+            yield restore_object_id(without_nulls(row))
+
+
+def import_records(stream, dump_format, parse_errors=None):
+    """Documents of a dump in one of FORMATS. Lines of ndjson.gz that are not JSON objects go to parse_errors."""
+    if dump_format == 'ndjson.gz':
+        return iter_ndjson_records(gzip.GzipFile(fileobj=stream), parse_errors, loads=json_util.loads)
+    if dump_format == 'bson':
+        return bson.decode_file_iter(stream)
+    if dump_format == 'bson.gz':
+        return bson.decode_file_iter(gzip.GzipFile(fileobj=stream))
+    if dump_format == 'parquet':
+        return iter_parquet_records(stream)
+    raise ValueError(f'Unknown import format: {dump_format}')
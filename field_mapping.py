@@ -0,0 +1,274 @@
+"""
+Field mappings for /api/process-merge-mappings.
+
+A mapping list ({'existing': target field, 'new': source field} entries, with
+an optional 'type' cast and 'default' value) is compiled once into a
+FieldMapping. For row input, compilation generates one straight-line
+function for the whole mapping: source keys and target paths are constants,
+and nested targets are created with setdefault chains, so nothing is split
+or looked up per record. A dotted source ('customer.location', as the staged
+upload schema lists nested fields) is read from a field of that exact name
+when the record has one and from the nested object otherwise. Paths can be
+nested up to SCHEMA_MAX_DEPTH levels, as deep as the sales schema lists them. For columnar input (a dict of equal-length column
+lists) the columns are renamed, cast and defaulted a whole column at a time,
+numbers with the same vectorized coercion uploads use, and zipped into
+documents at the end.
+
+Casts: int and float follow the upload rules (missing or blank values get
+the default, fractions are not truncated), string, bool and datetime (ISO
+8601). Values that can not be cast become null and are counted per target
+field. A default fills in null values (and blank ones for typed fields) and
+targets whose source field is absent, though a row where no source field is
+present at all is still skipped.
+"""
+from datetime import datetime
+
+import pandas as pd
+
+from ingestion import coerce_numeric, column_values
+from merge_engine import compile_field_getter
+from schema_registry import SCHEMA_MAX_DEPTH
+
+BOOL_VALUES = {'true': True, '1': True, 'yes': True, 'y': True, 't': True,
+               'false': False, '0': False, 'no': False, 'n': False, 'f': False}
+
+
+def to_int(value):
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    number = float(value)
+    if not number.is_integer():
+        raise ValueError(f'{value!r} is not a whole number')
+    return int(number)
+
+
+def to_bool(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)) and value in (0, 1):
+        return bool(value)
+    return BOOL_VALUES[str(value).strip().lower()]
+
+
+def to_datetime(value):
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(value.strip())
+
+
+CASTS = {
+    'int': to_int,
+    'float': float,
+    'string': str,
+    'bool': to_bool,
+    'datetime': to_datetime
+}
+
+
+# Returned by source getters for fields a record does not have
+MISSING = object()
+
+
+def compile_source_getter(source):
+    """Getter for a dotted source: the field of that exact name if present, else the nested one, else MISSING"""
+    parent, *parts = source.split('.')
+
+    def get_source(record):
+        if source in record:
+            return record[source]
+        value = record.get(parent, MISSING)
+        for part in parts:
+            if not isinstance(value, dict) or part not in value:
+                return MISSING
+            value = value[part]
+        return value
+    return get_source
+
+
+def is_missing(value):
+    # None, NaN and blank strings
+    return value is None or value != value or (isinstance(value, str) and not value.strip())
+
+
+class FieldMapping:
+    def __init__(self, mappings):
+        self.fields = []
+        for mapping in mappings:
+            cast = mapping.get('type') or None
+            if cast is not None and cast not in CASTS:
+                raise ValueError(f"Unknown type for {mapping['existing']}: {cast}")
+            if mapping.get('new') or 'default' in mapping:
+                self.fields.append({
+                    'target': mapping['existing'],
+                    'source': mapping.get('new') or None,
+                    'type': cast,
+                    'has_default': 'default' in mapping,
+                    'default': mapping.get('default')
+                })
+        for field in self.fields:
+            for path in (field['target'], field['source'] or ''):
+                if path.count('.') >= SCHEMA_MAX_DEPTH:
+                    raise ValueError(f'{path} is nested deeper than {SCHEMA_MAX_DEPTH} levels')
+        targets = {field['target'] for field in self.fields}
+        for target in targets:
+            parts = target.split('.')
+            for depth in range(1, len(parts)):
+                if '.'.join(parts[:depth]) in targets:
+                    raise ValueError(f"{'.'.join(parts[:depth])} is mapped both as a field and as the parent of {target}")
+        self.cast_targets = [field['target'] for field in self.fields if field['type']]
+        self.transform = self.compile_rows()
+
+    def compile_rows(self):
+        """Generate the function that maps one record, returns None for records to skip"""
+        namespace = {'is_missing': is_missing, 'MISSING': MISSING,
+                     'CastErrors': (TypeError, ValueError, KeyError, AttributeError)}
+        track_presence = any(field['has_default'] for field in self.fields)
+        lines = ['def transform(record, errors):', '    out = {}']
+        if track_presence:
+            lines.append('    present = False')
+
+        for i, field in enumerate(self.fields):
+            parts = field['target'].split('.')
+            target = 'out' + ''.join(f'.setdefault({part!r}, {{}})' for part in parts[:-1]) + f'[{parts[-1]!r}]'
+            namespace[f'default_{i}'] = field['default']
+            namespace[f'cast_{i}'] = CASTS.get(field['type'])
+
+            if field['source'] is None:
+                lines.append(f'    {target} = default_{i}')
+                continue
+            if '.' in field['source']:
+                namespace[f'get_{i}'] = compile_source_getter(field['source'])
+                lines += [f'    value = get_{i}(record)', '    if value is not MISSING:']
+            else:
+                lines.append(f"    if {field['source']!r} in record:")
+                lines.append(f"        value = record[{field['source']!r}]")
+            if field['type']:
+                lines += [
+                    '        if is_missing(value):',
+                    f'            value = default_{i}',
+                    '        else:',
+                    '            try:',
+                    f'                value = cast_{i}(value)',
+                    '            except CastErrors:',
+                    '                value = None',
+                    f"                errors[{field['target']!r}] = errors.get({field['target']!r}, 0) + 1"
+                ]
+            elif field['has_default']:
+                lines += ['        if value is None:', f'            value = default_{i}']
+            lines.append(f'        {target} = value')
+            if track_presence:
+                lines.append('        present = True')
+            if field['has_default']:
+                lines += ['    else:', f'        {target} = default_{i}']
+
+        lines.append('    return out if present else None' if track_presence else '    return out or None')
+        exec('\n'.join(lines), namespace)
+        return namespace['transform']
+
+    def start_errors(self, errors):
+        errors = {} if errors is None else errors
+        for target in self.cast_targets:
+            errors.setdefault(target, 0)
+        return errors
+
+    def transform_records(self, records, errors=None):
+        """Map records one at a time, skipping records without any mapped value"""
+        errors = self.start_errors(errors)
+        transform = self.transform
+        for record in records:
+            transformed = transform(record, errors)
+            if transformed is not None:
+                yield transformed
+
+    def transform_columns(self, columns, errors=None):
+        """Map columnar input ({field: [values]}) and return the documents"""
+        errors = self.start_errors(errors)
+        for name, values in columns.items():
+            if not isinstance(values, list):
+                raise ValueError(f'Column {name} must be a list of values')
+        lengths = {len(values) for values in columns.values()}
+        if len(lengths) > 1:
+            raise ValueError('Columns must all have the same length')
+        length = lengths.pop() if lengths else 0
+
+        targets = {}
+        for field in self.fields:
+            source = self.source_column(field['source'], columns)
+            present = source is not None
+            if not present and not field['has_default']:
+                continue
+            target = field['target']
+            if not present:
+                targets[target] = [field['default']] * length
+            elif field['type'] in ('int', 'float'):
+                frame = pd.DataFrame({target: pd.Series(source, dtype=object)})
+                coerce_numeric(frame, target, field['type'], field['default'], errors)
+                targets[target] = column_values(frame[target])
+            elif field['type']:
+                values = pd.Series(source, dtype=object)
+                targets[target] = column_values(self.cast_column(field, values, errors))
+            elif field['has_default']:
+                default = field['default']
+                targets[target] = [default if value is None else value for value in source]
+            else:
+                # Renamed only, the column is used as it is
+                targets[target] = list(source)
+        if not targets:
+            return []
+        return list(map(compile_document_builder(list(targets)), *targets.values()))
+
+    @staticmethod
+    def source_column(source, columns):
+        """Values of a source in columnar input, a dotted source is read from the objects of its parent column"""
+        if source is None:
+            return None
+        if source in columns:
+            return columns[source]
+        parent, _, path = source.partition('.')
+        if path and parent in columns:
+            getter = compile_field_getter(path)
+            return [getter(value) for value in columns[parent]]
+        return None
+
+    def cast_column(self, field, values, errors):
+        missing = values.map(is_missing, na_action=None).astype(bool)
+        if field['type'] == 'datetime':
+            strings = values.where(~missing).map(lambda value: value if isinstance(value, datetime) else str(value),
+                                                 na_action='ignore')
+            cast = pd.to_datetime(strings, errors='coerce', format='ISO8601').astype(object)
+            cast = cast.where(cast.notna(), None)
+        else:
+            cast_value = CASTS[field['type']]
+
+            def cast_or_none(value):
+                try:
+                    return cast_value(value)
+                except (TypeError, ValueError, KeyError, AttributeError):
+                    return None
+            cast = values.where(~missing).map(cast_or_none, na_action='ignore')
+
+        errors[field['target']] = errors.get(field['target'], 0) + int((cast.isna() & ~missing).sum())
+        return cast.astype(object).where(~missing, field['default'])
+
+
+def compile_document_builder(targets):
+    """
+    Generate a function taking one value per target that returns the document
+    as a single nested dict literal, dotted targets nested at any depth.
+    """
+    tree = {}
+    for i, target in enumerate(targets):
+        *parents, name = target.split('.')
+        node = tree
+        for parent in parents:
+            node = node.setdefault(parent, {})
+        node[name] = f'v{i}'
+
+    def literal(node):
+        return '{' + ', '.join(f'{key!r}: ' + (literal(value) if isinstance(value, dict) else value)
+                               for key, value in node.items()) + '}'
+
+    namespace = {}
+    arguments = ', '.join(f'v{i}' for i in range(len(targets)))
+    exec(f'def build({arguments}):\n    return {literal(tree)}', namespace)
+    return namespace['build']
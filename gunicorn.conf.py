@@ -0,0 +1,63 @@
+"""
+Gunicorn configuration, used by the Dockerfile:
+
+    gunicorn -c gunicorn.conf.py
+
+SERVER_MODE=wsgi (the default) serves main:app with threaded workers.
+SERVER_MODE=asgi serves asgi:app with uvicorn workers: the hot read
+endpoints run on the event loop with the async MongoDB client and every
+other route goes to the same Flask app.
+
+Each worker is a separate process with its own MongoDB connection pool, job
+queue (JOB_WORKERS threads) and parse pool (PARSE_WORKERS processes, by
+default the CPUs divided by the number of workers but at least two on a
+multi-core host), size WEB_CONCURRENCY with that in mind.
+"""
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+SERVER_MODE = os.environ.get('SERVER_MODE', 'wsgi')
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+# Workers split the CPUs between their parse pools by this (see parallel_parse.py)
+os.environ['WEB_CONCURRENCY'] = str(workers)
+
+if SERVER_MODE == 'asgi':
+    wsgi_app = 'asgi:app'
+    worker_class = 'uvicorn_worker.UvicornWorker'
+else:
+    wsgi_app = 'main:app'
+    worker_class = 'gthread'
+    # Requests per worker served concurrently while others wait on MongoDB
+    threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+# Synchronous uploads and merges of large files can take minutes
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 600))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+
+# Recycle workers after this many requests, 0 never does
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+
+# Workers write their metrics here so /api/metrics adds up all of them (see metrics.py)
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'rocketboard-metrics'))
+
+
+def on_starting(server):
+    # Samples left by a previous run would be added to the new ones
+    shutil.rmtree(os.environ['PROMETHEUS_MULTIPROC_DIR'], ignore_errors=True)
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'])
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
+accesslog = '-'
+errorlog = '-'
+loglevel = os.environ.get('GUNICORN_LOG_LEVEL', 'info')
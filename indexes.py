@@ -0,0 +1,198 @@
+"""
+Index management for the sales collection.
+
+ensure_sales_indexes creates single-field indexes on SALES_INDEX_FIELDS, the
+fields dashboards filter on and merges usually match on, once per process.
+ensure_matching_index backs the matching fields passed to the merge
+endpoints with a compound index, unique when the data allows it, replacing
+a plain index on the same fields. It is created on demand and a unique
+index is remembered per process, so repeated merges on the same fields do
+not go back to the server. When duplicate keys rule out a unique index the
+check is repeated after MATCHING_INDEX_RETRY_SECONDS, so the index becomes
+unique once the duplicates are cleaned up. At most SALES_MAX_INDEXES indexes
+are created on sales, each one slows down every write.
+
+index_report and explain_query back GET /api/indexes: index usage from
+$indexStats and a summary of the plan MongoDB picks for a query.
+"""
+import contextvars
+import logging
+import os
+import threading
+import time
+
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure, PyMongoError
+
+from analytics import ANALYTICS_DIMENSIONS
+
+# Defaults to the usual merge key and the fields analytics groups by
+SALES_INDEX_FIELDS = [field.strip() for field in os.environ.get(
+    'SALES_INDEX_FIELDS', ','.join(['transaction_id', *filter(None, ANALYTICS_DIMENSIONS.values())])
+).split(',') if field.strip()]
+SALES_MAX_INDEXES = int(os.environ.get('SALES_MAX_INDEXES', 32))
+# How long a matching index that could not be unique is left alone before checking again
+MATCHING_INDEX_RETRY_SECONDS = int(os.environ.get('MATCHING_INDEX_RETRY_SECONDS', 300))
+
+logger = logging.getLogger(__name__)
+
+_ensured = {}
+# Matching fields with duplicate keys -> time.monotonic() of the next check
+_retry_unique_at = {}
+_lock = threading.Lock()
+
+
+def index_keys(fields):
+    return [(field, ASCENDING) for field in fields]
+
+
+def ensure_sales_indexes(collection, fields=None):
+    """Create the single-field indexes on sales once per process, in a background thread"""
+    key = (collection.database.name, collection.name, 'startup')
+    with _lock:
+        if key in _ensured:
+            return
+        _ensured[key] = True
+    # Index builds on a large collection take a while, do not hold up the request
+    # The thread keeps the caller's context variables, e.g. the current tenant
+    threading.Thread(target=contextvars.copy_context().run, args=(create_sales_indexes, collection, fields, key),
+                     daemon=True).start()
+
+
+def create_sales_indexes(collection, fields, key):
+    try:
+        for field in SALES_INDEX_FIELDS if fields is None else fields:
+            try:
+                collection.create_index(index_keys([field]))
+            except OperationFailure:
+                logger.exception('Could not index %s on %s', field, collection.name)
+    except PyMongoError:
+        # Server unreachable, try again on the next request
+        logger.exception('Could not create the indexes of %s', collection.name)
+        with _lock:
+            _ensured.pop(key, None)
+
+
+def ensure_matching_index(collection, matching_fields):
+    """
+    Make sure the matching fields are backed by a compound index. Returns True
+    when the index is unique.
+    """
+    key = (collection.database.name, collection.name, tuple(matching_fields))
+    if key in _ensured:
+        return True
+    if time.monotonic() < _retry_unique_at.get(key, 0):
+        return False
+
+    keys = index_keys(matching_fields)
+    existing = collection.index_information()
+    for name, info in existing.items():
+        if info['key'] == keys:
+            # A plain index on the same keys, e.g. the startup one on
+            # transaction_id, is upgraded when the data allows a unique one
+            unique = bool(info.get('unique')) or replace_with_unique(collection, name, matching_fields)
+            break
+    else:
+        if len(existing) >= SALES_MAX_INDEXES:
+            logger.warning('Not indexing %s: %s already has %d indexes', matching_fields, collection.name,
+                           len(existing))
+            return False
+        try:
+            collection.create_index(keys, unique=True)
+            unique = True
+        except OperationFailure:
+            # Duplicate keys already in the collection prevent a unique index, use a plain one
+            logger.warning('No unique index on %s of %s, it has duplicate keys', matching_fields, collection.name)
+            collection.create_index(keys)
+            unique = False
+
+    with _lock:
+        if unique:
+            _ensured[key] = True
+            _retry_unique_at.pop(key, None)
+        else:
+            _retry_unique_at[key] = time.monotonic() + MATCHING_INDEX_RETRY_SECONDS
+    return unique
+
+
+def has_duplicate_keys(collection, fields):
+    pipeline = [
+        {'$group': {'_id': {f'k{i}': f'${field}' for i, field in enumerate(fields)}, 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}},
+        {'$limit': 1}
+    ]
+    return next(iter(collection.aggregate(pipeline, allowDiskUse=True)), None) is not None
+
+
+def replace_with_unique(collection, name, fields):
+    """Replace the plain index name on fields with a unique one, returns True when it is unique now"""
+    if has_duplicate_keys(collection, fields):
+        return False
+    # MongoDB does not allow a second index on the same keys that only differs in uniqueness
+    collection.drop_index(name)
+    try:
+        collection.create_index(index_keys(fields), unique=True)
+        return True
+    except OperationFailure:
+        # Duplicates written since the check
+        logger.warning('No unique index on %s of %s, duplicates were written meanwhile', fields, collection.name)
+        collection.create_index(index_keys(fields))
+        return False
+
+
+def index_report(collection):
+    """Every index of the collection with its definition and usage since the server started"""
+    information = collection.index_information()
+    report = []
+    for stats in collection.aggregate([{'$indexStats': {}}]):
+        info = information.get(stats['name'], {})
+        report.append({
+            'name': stats['name'],
+            'key': [[field, direction] for field, direction in info.get('key', stats['key'].items())],
+            'unique': bool(info.get('unique')),
+            'ops': stats['accesses']['ops'],
+            'since': stats['accesses']['since']
+        })
+    return sorted(report, key=lambda index: index['ops'], reverse=True)
+
+
+def plan_stages(plan, stages=None):
+    """Flatten a query plan into its stages, outermost first"""
+    stages = [] if stages is None else stages
+    stage = {'stage': plan.get('stage')}
+    if 'indexName' in plan:
+        stage['index'] = plan['indexName']
+    stages.append(stage)
+    children = [plan['inputStage']] if 'inputStage' in plan else plan.get('inputStages', [])
+    for child in children:
+        plan_stages(child, stages)
+    return stages
+
+
+def explain_query(collection, query, projection=None, sort=None, limit=None):
+    """Run explain with executionStats for a find and summarize the winning plan"""
+    command = {'find': collection.name, 'filter': query}
+    if projection:
+        command['projection'] = projection
+    if sort:
+        command['sort'] = dict(sort)
+    if limit:
+        command['limit'] = limit
+    explain = collection.database.command('explain', command, verbosity='executionStats')
+
+    planner = explain['queryPlanner']
+    stats = explain['executionStats']
+    # Classic plans sit at winningPlan, slot based engine plans one level down
+    winning_plan = planner['winningPlan'].get('queryPlan', planner['winningPlan'])
+    stages = plan_stages(winning_plan)
+    return {
+        'filter': planner.get('parsedQuery', query),
+        'stages': stages,
+        'indexes_used': sorted({stage['index'] for stage in stages if 'index' in stage}),
+        'collection_scan': any(stage['stage'] == 'COLLSCAN' for stage in stages),
+        'returned': stats['nReturned'],
+        'keys_examined': stats['totalKeysExamined'],
+        'docs_examined': stats['totalDocsExamined'],
+        'execution_ms': stats['executionTimeMillis'],
+        'rejected_plans': len(planner.get('rejectedPlans', []))
+    }
@@ -0,0 +1,344 @@
+import json
+import pandas as pd
+from itertools import islice
+from xml.etree import ElementTree
+
+# Number of parsed records handed to the database per batch
+INGEST_BATCH_SIZE = 1000
+
+# Columns coerced during normalization and the value used when they are missing
+NUMERIC_COLUMNS = {
+    'sales_amount': ('float', 0.0),
+    'units_sold': ('int', 0)
+}
+
+# Flat columns that are nested under 'customer'
+CUSTOMER_COLUMNS = ('location', 'gender')
+
+
+def iter_batches(records, batch_size=INGEST_BATCH_SIZE):
+    """Group any iterable of records into lists of at most batch_size"""
+    iterator = iter(records)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def coerce_numeric(frame, column, kind, default, errors):
+    """
+    Convert a column to numbers in one vectorized pass. Missing or blank values
+    get the default, values that can not be converted become null and are
+    counted in errors[column].
+    """
+    if column not in frame.columns:
+        frame[column] = default
+        errors[column] = 0
+        return
+
+    raw = frame[column]
+    try:
+        # Fast path: every value is a number, a numeric string or null
+        values = raw.astype('float64')
+    except (TypeError, ValueError):
+        values = pd.to_numeric(raw, errors='coerce')
+    missing = raw.isna()
+    failed = values.isna() & ~missing
+    if failed.any() and raw.dtype == object:
+        # Only the values that failed to convert need the (slow) blank check
+        blank = raw[failed].astype(str).str.strip().eq('')
+        missing[blank[blank].index] = True
+    invalid = values.isna() & ~missing
+    if kind == 'int':
+        # Fractions are not silently truncated
+        invalid |= values.notna() & values.ne(values.round())
+        values = values.where(~invalid).mask(missing, default)
+        values = values.astype('int64' if not values.hasnans else 'Int64')
+    else:
+        values = values.where(~invalid).mask(missing, default).astype('float64')
+
+    frame[column] = values
+    errors[column] = int(invalid.sum())
+
+
+def normalize_frame(frame, nest_customer=None):
+    """
+    Shared normalization stage for every upload format. Coerces the numeric
+    columns and moves flat customer columns to 'customer.<field>' so they are
+    nested when the rows are turned into documents. nest_customer=None nests
+    only when one of the customer columns is present.
+    Returns the frame and the number of coercion errors per column.
+    """
+    errors = {}
+    for column, (kind, default) in NUMERIC_COLUMNS.items():
+        coerce_numeric(frame, column, kind, default, errors)
+
+    if nest_customer is None:
+        nest_customer = any(column in frame.columns for column in CUSTOMER_COLUMNS)
+    if nest_customer:
+        for column in CUSTOMER_COLUMNS:
+            values = frame.pop(column) if column in frame.columns else None
+            frame[f'customer.{column}'] = values
+        if 'customer' in frame.columns:
+            # Flat customer columns replace a 'customer' column, as they always have for CSV
+            frame.drop(columns='customer', inplace=True)
+
+    return frame, errors
+
+
+def column_values(series):
+    """Native Python values of a column, with nulls as None"""
+    values = series.tolist()
+    if series.hasnans:
+        values = [None if is_null else value for value, is_null in zip(values, series.isna().tolist())]
+    return values
+
+
+def frame_to_records(frame):
+    """
+    Turn a normalized frame into MongoDB documents. This is the only place rows
+    become dicts: nulls become None, and 'a.b' columns become nested objects.
+    """
+    return columns_to_records(*frame_columns(frame))
+
+
+def frame_columns(frame):
+    """Column names and native value lists of a frame, a compact form to pass between processes"""
+    return [str(column) for column in frame.columns], [column_values(frame[column]) for column in frame.columns]
+
+
+def columns_to_records(column_names, column_lists):
+    names = []
+    columns = []
+    nested = {}
+    for name, values in zip(column_names, column_lists):
+        if '.' in name:
+            parent, child = name.split('.', 1)
+            nested.setdefault(parent, ([], []))
+            nested[parent][0].append(child)
+            nested[parent][1].append(values)
+        else:
+            names.append(name)
+            columns.append(values)
+
+    # Build nested objects column-wise, at any depth, then zip every column into documents
+    for parent, (children, child_columns) in nested.items():
+        names.append(parent)
+        columns.append(columns_to_records(children, child_columns))
+
+    if not names:
+        return [{} for _ in range(len(column_lists[0]) if column_lists else 0)]
+    return [dict(zip(names, row)) for row in zip(*columns)]
+
+
+def coerce_number(value, is_int, default):
+    """Coerce one value by the rules of coerce_numeric, returns (value, whether it failed)"""
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        if value is None or (isinstance(value, str) and not value.strip()):
+            return default, False
+        return None, True
+    if number != number:
+        # NaN itself counts as missing, like null, but a 'nan' string does not convert
+        return (default, False) if value != value else (None, True)
+    if not is_int:
+        return number, False
+    if number.is_integer():
+        return int(number), False
+    return None, True
+
+
+def normalize_records(records):
+    """
+    Normalization stage for formats that are already parsed into documents
+    (JSON, XML). The numeric columns are coerced in place with a plain loop
+    over the records, by the same rules as coerce_numeric: missing or blank
+    values get the default, values that can not be converted (or fractions
+    for int columns) become None and are counted.
+
+    JSON and XML are deliberately left out of the columnar stage: the
+    documents exist already, so every value has to be read out of its dict
+    and written back either way, and the frame in between made the stage
+    about 2x slower. tests/test_ingestion.py pins the rules both stages share.
+    Returns the coercion error count per column.
+    """
+    errors = {}
+    for column, (kind, default) in NUMERIC_COLUMNS.items():
+        is_int = kind == 'int'
+        convert = int if is_int else float
+        failed = 0
+        for record in records:
+            value = record.get(column)
+            if value.__class__ is str:
+                # Fast path for the common case, a well formed number string
+                try:
+                    number = convert(value)
+                    if number == number:
+                        record[column] = number
+                        continue
+                except ValueError:
+                    pass
+            record[column], error = coerce_number(value, is_int, default)
+            failed += error
+        errors[column] = failed
+    return errors
+
+
+def iter_frame_records(frames, errors, nest_customer=None):
+    """Normalize frames one at a time (e.g. CSV chunks), yielding documents and summing errors"""
+    for frame in frames:
+        frame, frame_errors = normalize_frame(frame, nest_customer)
+        for column, count in frame_errors.items():
+            errors[column] = errors.get(column, 0) + count
+        yield from frame_to_records(frame)
+
+
+def read_csv_frames(stream, encoding='utf-8', chunksize=None):
+    """Read CSV as text columns; with chunksize the stream is decoded incrementally"""
+    return pd.read_csv(stream, dtype=str, keep_default_na=False, encoding=encoding,
+                       encoding_errors='ignore', chunksize=chunksize)
+
+
+def iter_csv_records(stream, errors=None, encoding='utf-8', chunksize=INGEST_BATCH_SIZE):
+    """
+    Read CSV records from a binary stream chunk by chunk, so only the current
+    chunk is held in memory regardless of the file size.
+    """
+    if errors is None:
+        errors = {}
+    with read_csv_frames(stream, encoding, chunksize) as reader:
+        yield from iter_frame_records(reader, errors, nest_customer=True)
+
+
+def iter_ndjson_records(stream, parse_errors=None, loads=json.loads):
+    """
+    Yield one document per non-blank line of an NDJSON (JSON lines) stream.
+    When parse_errors is a list, lines that are not JSON objects are reported
+    there by line number and skipped instead of raising ValueError. loads can
+    be e.g. bson.json_util.loads for Extended JSON.
+    """
+    for number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            record = loads(line)
+            if not isinstance(record, dict):
+                raise ValueError('Expected a JSON object')
+        except ValueError as e:
+            if parse_errors is None:
+                raise
+            parse_errors.append({'line': number, 'message': str(e)})
+            continue
+        yield record
+
+
+def iter_normalized_records(records, errors, batch_size=INGEST_BATCH_SIZE):
+    """Run normalize_records over a record stream one batch at a time, summing errors"""
+    for batch in iter_batches(records, batch_size):
+        for column, count in normalize_records(batch).items():
+            errors[column] = errors.get(column, 0) + count
+        yield from batch
+
+
+def local_name(tag):
+    """Drop the namespace from an ElementTree tag, '{uri}sale' -> 'sale'"""
+    return tag.rsplit('}', 1)[-1]
+
+
+def element_to_record(element):
+    """
+    Convert an element into plain dicts the same way xmltodict does: attributes
+    become '@name' keys, repeated children become lists and leaf elements
+    become their text.
+    """
+    record = {f'@{local_name(name)}': value for name, value in element.attrib.items()}
+    for child in element:
+        key = local_name(child.tag)
+        value = element_to_record(child)
+        if key not in record:
+            record[key] = value
+        elif isinstance(record[key], list):
+            record[key].append(value)
+        else:
+            record[key] = [record[key], value]
+
+    text = element.text.strip() if element.text else ''
+    if not record:
+        return text or None
+    if text:
+        record['#text'] = text
+    return record
+
+
+def find_xml_record_path(stream):
+    """
+    Scan the document once, without keeping any elements, and return the path
+    of the repeating record element: the shallowest element that occurs more
+    than once under the same parent, in document order.
+    """
+    path = []
+    parents = []
+    sibling_counts = [{}]
+    best = None
+    for event, element in ElementTree.iterparse(stream, events=('start', 'end')):
+        if event == 'start':
+            tag = local_name(element.tag)
+            counts = sibling_counts[-1]
+            counts[tag] = counts.get(tag, 0) + 1
+            path.append(tag)
+            parents.append(element)
+            sibling_counts.append({})
+            if counts[tag] == 2 and (best is None or len(path) < len(best)):
+                best = list(path)
+        else:
+            path.pop()
+            parents.pop()
+            sibling_counts.pop()
+            if parents:
+                parents[-1].remove(element)
+    return '/'.join(best) if best else None
+
+
+def path_matches(path, record_path):
+    """record_path matches a full path from the root or any trailing part of it"""
+    return path[-len(record_path):] == record_path
+
+
+def iter_xml_records(stream, record_path=None):
+    """
+    Stream records out of an XML document with iterparse. Each record element
+    is converted and then removed from the tree, so memory stays flat. Without
+    record_path, find_xml_record_path scans the document first to detect it.
+    """
+    if not record_path:
+        record_path = find_xml_record_path(stream)
+        if record_path is None:
+            raise ValueError("Could not find records in XML file")
+        stream.seek(0)
+    record_path = [part for part in record_path.strip('/').split('/') if part]
+
+    path = []
+    parents = []
+    # Depth of the record being read, so nested elements with the same name are not records
+    record_depth = None
+    for event, element in ElementTree.iterparse(stream, events=('start', 'end')):
+        if event == 'start':
+            path.append(local_name(element.tag))
+            if record_depth is None and path_matches(path, record_path):
+                record_depth = len(path)
+            parents.append(element)
+            continue
+
+        parents.pop()
+        if record_depth == len(path):
+            record = element_to_record(element)
+            yield record if isinstance(record, dict) else {'#text': record}
+            record_depth = None
+            if parents:
+                parents[-1].remove(element)
+        elif record_depth is None and parents:
+            # Elements outside any record are not needed either
+            parents[-1].remove(element)
+        path.pop()
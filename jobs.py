@@ -0,0 +1,242 @@
+"""
+Background jobs for uploads and merges.
+
+Submitting a job stores it in the tasks collection and runs it on a local
+thread pool, so the request returns right away with a job id. Status,
+progress, timings and the result are written back to the task document and
+can be polled. Job input (the uploaded file or request body) is saved to
+JOB_UPLOAD_DIR so queued jobs can be picked up again after a restart; jobs
+that were running when their worker died are marked failed. Every process
+sweeps for such jobs periodically, not just at startup.
+"""
+import os
+import socket
+import tempfile
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import DocumentTooLarge
+
+# Number of jobs run at the same time by each app process
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+# Running jobs refresh heartbeat_at this often
+JOB_HEARTBEAT_SECONDS = int(os.environ.get('JOB_HEARTBEAT_SECONDS', 15))
+# A running job without a heartbeat for this long belongs to a dead worker
+JOB_STALE_SECONDS = int(os.environ.get('JOB_STALE_SECONDS', 120))
+# How often each process looks for jobs left behind by dead workers
+JOB_SWEEP_SECONDS = int(os.environ.get('JOB_SWEEP_SECONDS', 60))
+# Where uploaded files and request bodies are kept until their job finishes
+JOB_UPLOAD_DIR = os.environ.get('JOB_UPLOAD_DIR', os.path.join(tempfile.gettempdir(), 'rocketboard-jobs'))
+
+
+class JobQueue:
+    def __init__(self, tasks_collection, app, workers=JOB_WORKERS):
+        self.tasks = tasks_collection
+        self.app = app
+        self.handlers = {}
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self.host = socket.gethostname()
+        self.worker_id = f'{self.host}:{os.getpid()}'
+        self.running = set()
+        # Submitted to the executor and not finished yet, sweep leaves these alone
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.recovered = False
+        self.heartbeat_thread = None
+
+    def register(self, job_type, handler):
+        """handler(job, progress) returns (result, status_code) like the endpoint would"""
+        self.handlers[job_type] = handler
+
+    def input_path(self, suffix=''):
+        os.makedirs(JOB_UPLOAD_DIR, exist_ok=True)
+        handle, path = tempfile.mkstemp(dir=JOB_UPLOAD_DIR, suffix=suffix)
+        os.close(handle)
+        return path
+
+    def submit(self, job_type, params, input_path=None):
+        if job_type not in self.handlers:
+            raise ValueError(f'Unknown job type: {job_type}')
+        now = datetime.now()
+        job_id = self.tasks.insert_one({
+            'type': job_type,
+            'status': 'queued',
+            'params': params,
+            'input_path': input_path,
+            'host': self.host,
+            'progress': {},
+            'attempts': 0,
+            'created_at': now,
+            'updated_at': now
+        }).inserted_id
+        self.enqueue(job_id)
+        return job_id
+
+    def enqueue(self, job_id):
+        with self.lock:
+            if job_id in self.pending:
+                return
+            self.pending.add(job_id)
+        self.executor.submit(self.run, job_id)
+
+    def get(self, job_id, query=None):
+        return self.tasks.find_one({**(query or {}), '_id': job_id}, {'params': 0, 'input_path': 0, 'host': 0})
+
+    def list(self, status=None, limit=50, query=None):
+        query = dict(query or {})
+        if status:
+            query['status'] = status
+        projection = {'params': 0, 'input_path': 0, 'host': 0, 'result': 0}
+        return list(self.tasks.find(query, projection).sort('created_at', DESCENDING).limit(limit))
+
+    def run(self, job_id):
+        try:
+            self.claim_and_run(job_id)
+        finally:
+            with self.lock:
+                self.pending.discard(job_id)
+
+    def claim_and_run(self, job_id):
+        # Registered before the claim so a sweep never sees our job without us running it
+        with self.lock:
+            if job_id in self.running:
+                return
+            self.running.add(job_id)
+        now = datetime.now()
+        job = self.tasks.find_one_and_update(
+            {'_id': job_id, 'status': 'queued'},
+            {'$set': {'status': 'running', 'worker_id': self.worker_id, 'started_at': now,
+                      'heartbeat_at': now, 'updated_at': now},
+             '$inc': {'attempts': 1}},
+            return_document=ReturnDocument.AFTER
+        )
+        if job is None:
+            # Another worker picked it up first
+            with self.lock:
+                self.running.discard(job_id)
+            return
+        self.start_heartbeat()
+
+        def progress(**fields):
+            updates = {f'progress.{key}': value for key, value in fields.items()}
+            updates['heartbeat_at'] = updates['updated_at'] = datetime.now()
+            self.tasks.update_one({'_id': job_id}, {'$set': updates})
+
+        start = time.perf_counter()
+        try:
+            with self.app.app_context():
+                result, status_code = self.handlers[job['type']](job, progress)
+            self.finish(job_id, 'succeeded' if status_code < 400 else 'failed', start,
+                        result=result, status_code=status_code)
+        except Exception as e:
+            traceback.print_exc()
+            self.finish(job_id, 'failed', start, error=str(e))
+        finally:
+            with self.lock:
+                self.running.discard(job_id)
+            if job.get('input_path') and os.path.exists(job['input_path']):
+                os.remove(job['input_path'])
+
+    def finish(self, job_id, status, start, **fields):
+        now = datetime.now()
+        update = {'status': status, 'finished_at': now, 'updated_at': now,
+                  'duration': round(time.perf_counter() - start, 4), **fields}
+        try:
+            self.tasks.update_one({'_id': job_id}, {'$set': update})
+        except DocumentTooLarge:
+            update.pop('result', None)
+            update.update({'status': 'failed', 'error': 'Job result is too large to store'})
+            self.tasks.update_one({'_id': job_id}, {'$set': update})
+
+    def start_heartbeat(self):
+        with self.lock:
+            if self.heartbeat_thread is not None:
+                return
+            self.heartbeat_thread = threading.Thread(target=self.heartbeat, name='job-heartbeat', daemon=True)
+            self.heartbeat_thread.start()
+
+    def heartbeat(self):
+        swept_at = time.monotonic()
+        while True:
+            time.sleep(JOB_HEARTBEAT_SECONDS)
+            with self.lock:
+                running = list(self.running)
+            try:
+                if running:
+                    self.tasks.update_many({'_id': {'$in': running}}, {'$set': {'heartbeat_at': datetime.now()}})
+                if time.monotonic() - swept_at >= JOB_SWEEP_SECONDS:
+                    swept_at = time.monotonic()
+                    self.sweep()
+            except Exception:
+                traceback.print_exc()
+
+    def recover(self):
+        """
+        Run once per process: creates the indexes and starts the heartbeat
+        thread, which also runs sweep every JOB_SWEEP_SECONDS. Jobs left behind
+        by a worker that died shortly before this process started are only
+        stale a while later, so one sweep at startup is not enough.
+        """
+        if self.recovered:
+            return
+        self.recovered = True
+
+        self.tasks.create_index([('created_at', DESCENDING)])
+        self.tasks.create_index([('status', ASCENDING), ('heartbeat_at', ASCENDING)])
+        self.start_heartbeat()
+        self.sweep()
+
+    def worker_is_dead(self, worker_id):
+        """True when worker_id is a process on this host that no longer runs the job"""
+        host, _, pid = (worker_id or '').rpartition(':')
+        if host != self.host or not pid.isdigit():
+            return False
+        if worker_id == self.worker_id:
+            return False  # ours, checked against self.running by the caller
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except OSError:
+            pass
+        return False
+
+    def sweep(self):
+        """
+        Running jobs whose worker stopped sending heartbeats, or whose worker
+        process on this host is gone, are marked failed, since they may have
+        stopped halfway through a write (their backup_name in progress can be
+        restored). Stale queued jobs saved on this host are resubmitted.
+        """
+        now = datetime.now()
+        cutoff = now - timedelta(seconds=JOB_STALE_SECONDS)
+        with self.lock:
+            running = list(self.running)
+        dead = [job['_id'] for job in self.tasks.find({'status': 'running', 'heartbeat_at': {'$gte': cutoff}},
+                                                     {'worker_id': 1})
+                if self.worker_is_dead(job.get('worker_id'))
+                or (job.get('worker_id') == self.worker_id and job['_id'] not in running)]
+        self.tasks.update_many(
+            {'status': 'running', '$or': [{'heartbeat_at': {'$lt': cutoff}}, {'_id': {'$in': dead}}]},
+            {'$set': {'status': 'failed', 'finished_at': now, 'updated_at': now,
+                      'error': 'Worker restarted while the job was running'}}
+        )
+
+        with self.lock:
+            pending = set(self.pending)
+        for job in self.tasks.find({'status': 'queued', 'host': self.host, 'updated_at': {'$lt': cutoff}},
+                                   {'input_path': 1}):
+            if job['_id'] in pending:
+                # Still waiting in our own executor
+                continue
+            if job.get('input_path') and not os.path.exists(job['input_path']):
+                self.tasks.update_one({'_id': job['_id']}, {'$set': {
+                    'status': 'failed', 'updated_at': datetime.now(),
+                    'error': 'Job input was lost when the worker restarted'}})
+                continue
+            self.tasks.update_one({'_id': job['_id']}, {'$set': {'updated_at': datetime.now()}})
+            self.enqueue(job['_id'])
@@ -1,31 +1,93 @@
-import csv
 import json
 import os
-from datetime import datetime
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_pymongo import PyMongo
 from flask_cors import CORS
+from bson.errors import InvalidId
 from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+from werkzeug.datastructures import FileStorage
+from werkzeug.local import LocalProxy
 from dotenv import load_dotenv
-import io
 import pandas as pd
-import xmltodict
-import requests
+import shutil
+import tempfile
+import time
 import traceback
+from datetime import datetime
+from contextlib import contextmanager
+from itertools import chain
+import analytics
+import backups
+import bulk_ingest
+import dumps
+import indexes
+import merge_client
+import metrics
+import parallel_parse
+import response_cache
+import schema_registry
+import staging
+import tenants
+from field_mapping import FieldMapping
+from jobs import JobQueue
+from ingestion import (frame_to_records, iter_batches, iter_csv_records, iter_ndjson_records,
+                       iter_normalized_records, iter_xml_records, normalize_frame, normalize_records,
+                       read_csv_frames)
+from merge_engine import (compile_key_extractor, compile_key_filter, diff_update, merge_records,
+                          merge_with_existing_data)
 
 load_dotenv()  # Load environment variables from .env
 
 app = Flask(__name__)
 CORS(app)
+metrics.init_app(app)
 
 app.config["MONGO_URI"] = os.environ.get("MONGO_URI")
 mongo = PyMongo(app)
 
-# Access collections
-sales_collection = mongo.db.sales
-analytics_collection = mongo.db.analytics
+# Access collections. Each tenant has a database of its own (see tenants.py),
+# these resolve to the collections of the current tenant on every use.
+tenant_db = LocalProxy(lambda: tenants.tenant_database(mongo.db))
+sales_collection = LocalProxy(lambda: tenant_db.sales)
+analytics_collection = LocalProxy(lambda: tenant_db.analytics)
+# One job queue for all tenants, jobs keep their tenant in their params
 tasks_collection = mongo.db.tasks
 
+# Read endpoints are cached until the next write bumps the data version (see response_cache.py)
+sales_cache = response_cache.ResponseCache(tenant_db)
+
+# Endpoints that are not scoped to a tenant
+TENANT_UNSCOPED_ENDPOINTS = {'health', 'get_metrics', 'static'}
+
+@app.before_request
+def select_tenant():
+    if request.endpoint in TENANT_UNSCOPED_ENDPOINTS:
+        return None
+    try:
+        tenants.set_tenant(tenants.parse_tenant(request.headers, request.args))
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    return None
+
+@app.teardown_request
+def reset_tenant(exc):
+    tenants.set_tenant(None)
+
+# Number of records sent to MongoDB per bulk_write in upsert merges
+UPSERT_BATCH_SIZE = int(os.environ.get('UPSERT_BATCH_SIZE', 1000))
+
+# GET /api/sales paging and cursor settings
+SALES_PAGE_MAX_LIMIT = int(os.environ.get('SALES_PAGE_MAX_LIMIT', 10000))
+SALES_CURSOR_BATCH_SIZE = int(os.environ.get('SALES_CURSOR_BATCH_SIZE', 1000))
+SALES_RESERVED_PARAMS = {'limit', 'after', 'fields', 'format', 'tenant'}
+
+# Path of the repeating record element in XML uploads, e.g. 'root/sales/sale' or
+# just 'sale'. Detected from the document when neither this nor the
+# 'record_path' form field is set.
+XML_RECORD_PATH = os.environ.get('XML_RECORD_PATH')
+
 @app.route('/api/health', methods=['GET'])
 def health():
     return jsonify({"status": "OK"}), 200
@@ -35,41 +97,213 @@ def health():
 def insert_sales_data():
     data = request.json
     sales_id = sales_collection.insert_one(data).inserted_id
+    backups.invalidate_backup_chain(tenant_db)
+    delta = analytics.RollupDelta()
+    delta.add(data)
+    sales_changed(delta)
     return jsonify({"message": "Sales data inserted", "id": str(sales_id)}), 201
 
 # 2. Get Sales Data
+# Query parameters:
+#   limit   - page size, enables cursor pagination (response includes next_after)
+#   after   - _id of the last document of the previous page
+#   fields  - comma separated list of fields to return, e.g. product,customer.location
+#   format  - json (default), ndjson or json-stream; the last two stream documents
+#             as the cursor yields them instead of building the whole list
+# Any other parameter is an equality filter on that field, e.g. customer.location=Chicago,
+# and can take a __gt, __gte, __lt, __lte, __ne or __in (comma separated) suffix.
 @app.route('/api/sales', methods=['GET'])
+@sales_cache.cached
 def get_sales_data():
-    sales = sales_collection.find()
+    try:
+        query, projection, limit, output_format = parse_sales_request(request.args)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+
+    sales = find_sales(sales_collection, query, projection, limit, 'after' in request.args)
+
+    if output_format != 'json':
+        return Response(stream_with_context(stream_sales(sales, output_format)),
+                        mimetype=SALES_FORMAT_MIMETYPES[output_format])
+
     sales_list = []
     for sale in sales:
         sale['_id'] = str(sale['_id'])  # Convert ObjectId to string
         sales_list.append(sale)
-    return jsonify(sales_list), 200
+
+    if limit is None:
+        return jsonify(sales_list), 200
+
+    next_after = sales_list[-1]['_id'] if len(sales_list) == limit else None
+    return jsonify({'sales': sales_list, 'next_after': next_after}), 200
+
+SALES_FORMAT_MIMETYPES = {'ndjson': 'application/x-ndjson', 'json-stream': 'application/json'}
+
+def parse_sales_request(args):
+    """
+    Validate the GET /api/sales parameters and return (query, projection,
+    limit, output_format). Raises ValueError with the message for the client.
+    """
+    try:
+        query = build_sales_query(args)
+        projection = build_projection(args.get('fields'))
+        output_format = args.get('format', 'json')
+    except (InvalidId, ValueError) as e:
+        raise ValueError(f'Invalid query: {str(e)}')
+    try:
+        limit = int(args['limit']) if 'limit' in args else None
+    except ValueError:
+        raise ValueError(f"limit must be an integer, got {args['limit']}")
+
+    if output_format not in ('json', 'ndjson', 'json-stream'):
+        raise ValueError(f'Invalid format: {output_format}')
+    if limit is not None and not 0 < limit <= SALES_PAGE_MAX_LIMIT:
+        raise ValueError(f'limit must be between 1 and {SALES_PAGE_MAX_LIMIT}')
+    return query, projection, limit, output_format
+
+def find_sales(collection, query, projection, limit, paginate):
+    """Build the sales cursor, works for both the sync and the async driver"""
+    sales = collection.find(query, projection, batch_size=SALES_CURSOR_BATCH_SIZE)
+    if limit is not None or paginate:
+        # Paginate on _id so each page is an index range scan
+        sales = sales.sort('_id', 1)
+    if limit is not None:
+        sales = sales.limit(limit)
+    return sales
+
+def stream_sales(cursor, output_format):
+    """Serialize documents one at a time as NDJSON lines or as a JSON array"""
+    if output_format == 'ndjson':
+        for sale in cursor:
+            sale['_id'] = str(sale['_id'])
+            yield app.json.dumps(sale) + '\n'
+        return
+
+    yield '['
+    first = True
+    for sale in cursor:
+        sale['_id'] = str(sale['_id'])
+        yield ('' if first else ',') + app.json.dumps(sale)
+        first = False
+    yield ']'
+
+def parse_filter_value(value):
+    """Match a query string value both as a string and as a number"""
+    for cast in (int, float):
+        try:
+            return [value, cast(value)]
+        except ValueError:
+            continue
+    return [value]
+
+def check_field_name(field):
+    """Field names come from the query string, operators and empty path parts are not field names"""
+    if not field or any(not part or part.startswith('$') for part in field.split('.')):
+        raise ValueError(f'Invalid field name: {field}')
+    return field
+
+def build_sales_query(args):
+    """Build a MongoDB query from the GET /api/sales filter parameters"""
+    query = {}
+    for param, value in args.items():
+        if param in SALES_RESERVED_PARAMS:
+            continue
+        field, _, operator = param.partition('__')
+        if field == '_id':
+            raise ValueError('_id can not be used as a filter, use after instead')
+        check_field_name(field)
+        if not operator:
+            query.setdefault(field, {})['$in'] = parse_filter_value(value)
+        elif operator == 'in':
+            query.setdefault(field, {})['$in'] = [v for item in value.split(',') for v in parse_filter_value(item)]
+        elif operator == 'ne':
+            query.setdefault(field, {})['$nin'] = parse_filter_value(value)
+        elif operator in ('gt', 'gte', 'lt', 'lte'):
+            # Range filters compare numbers when the value is numeric
+            query.setdefault(field, {})[f'${operator}'] = parse_filter_value(value)[-1]
+        else:
+            raise ValueError(f'Unknown filter operator: {operator}')
+
+    if 'after' in args:
+        query['_id'] = {'$gt': ObjectId(args['after'])}
+    return query
+
+def build_projection(fields):
+    if not fields:
+        return None
+    return {check_field_name(field.strip()): 1 for field in fields.split(',') if field.strip()}
 
 # 3. List Backups Endpoint
 @app.route('/api/list-backups', methods=['GET'])
+@sales_cache.cached
 def list_backups():
-    collections = mongo.db.list_collection_names()
-    backup_collections = [col for col in collections if col.startswith('sales_backup')]
-    return jsonify({'backups': backup_collections}), 200
+    details = backups.list_backups(tenant_db)
+    return jsonify(backup_list_response(details)), 200
+
+def backup_list_response(details):
+    return {'backups': [backup['name'] for backup in details], 'details': details}
+
+# Helper to record how long each step of a request takes, in seconds.
+# When the work runs as a background job, progress reports the current step.
+# Every step is also recorded in the stage metrics (see metrics.py).
+@contextmanager
+def timed(timings, step, progress=None):
+    if progress:
+        progress(stage=step)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        timings[step] = round(elapsed, 4)
+        metrics.observe_stage(step, elapsed)
 
-# Backup function
+# Backup function, returns the name of a full or delta backup point (see backups.py)
 def backup_sales_collection():
-    backup_collection_name = f"sales_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-    backup_collection = mongo.db[backup_collection_name]
-    sales_data = list(sales_collection.find({}))
-    if sales_data:
-        backup_collection.insert_many(sales_data)
-    return backup_collection_name
-
-# Restore function
+    backup_name = backups.create_backup(tenant_db, sales_collection)
+    sales_cache.bump()
+    return backup_name
+
+# Record what a merge changed after the backup was taken
+def record_backup_changeset(backup_name, changed_ids, deleted_ids=()):
+    backups.record_changeset(tenant_db, sales_collection, backup_name, changed_ids, deleted_ids)
+
+# Restore function. Once the data is swapped the restore has happened, so a
+# failed rollup rebuild is only logged (POST /api/analytics/rebuild retries it)
+# and the schema and cached responses are invalidated either way.
 def restore_sales_collection(backup_collection_name):
-    backup_collection = mongo.db[backup_collection_name]
-    sales_collection.delete_many({})  # Clear the current sales data
-    backup_data = list(backup_collection.find({}))
-    if backup_data:
-        sales_collection.insert_many(backup_data)
+    backups.restore_backup(tenant_db, sales_collection, backup_collection_name)
+    try:
+        analytics.rebuild_rollups(sales_collection, analytics_collection)
+    except Exception:
+        traceback.print_exc()
+    finally:
+        sales_changed()
+
+# Called after every write to sales: invalidates the cached schema, applies
+# the change the write made to the analytics rollups (see analytics.py) and
+# makes the cached responses stale. A failed rollup update should not fail the
+# write, POST /api/analytics/rebuild fixes the rollups.
+def sales_changed(delta=None):
+    schema_registry.invalidate(tenant_db, sales_collection)
+    if delta is not None:
+        try:
+            delta.apply(analytics_collection)
+        except Exception:
+            traceback.print_exc()
+    sales_cache.bump()
+
+# Insert documents into sales in fixed-size unordered batches (see bulk_ingest.py)
+# instead of one insert_many with everything. Returns the insert summary and the
+# documents that were actually written.
+def insert_sales_batches(documents):
+    written = []
+
+    def collect_written(batch, failed_indexes):
+        written.extend(doc for i, doc in enumerate(batch) if i not in failed_indexes)
+
+    summary = bulk_ingest.insert_in_batches(sales_collection, documents, on_batch=collect_written)
+    return summary, written
 
 # 4. Upload and Preview Endpoint
 @app.route('/api/upload-preview', methods=['POST'])
@@ -79,22 +313,96 @@ def upload_preview():
     file = request.files['file']
     if file.filename == '':
         return jsonify({'message': 'No file selected for uploading'}), 400
+    if run_as_job():
+        return submit_upload_job('upload_preview', file)
     try:
-        filename = file.filename.lower()
+        result, status_code = preview_upload(file, request.form)
+        return jsonify(result), status_code
+    except Exception as e:
+        return jsonify({'message': f'Error processing file: {str(e)}'}), 500
+
+# With the 'stage' form field set, the parsed records are written to the
+# staging collection instead of being returned. The response only carries a
+# staging_id, the inferred schema and a sample of 'sample_size' rows; pass the
+# staging_id to /api/process-merge-mappings instead of new_data.
+@metrics.track_operation('upload_preview')
+def preview_upload(file, options, progress=None):
+    metrics.observe_payload('file', parallel_parse.stream_size(file.stream))
+    timings = {}
+    if str(options.get('stage', '')).lower() in ('1', 'true', 'yes'):
+        with timed(timings, 'stage', progress):
+            records, coercion_errors = read_upload(file, options, stream=True)
+            if records is None:
+                return {'message': 'Invalid file type. Please upload a JSON, NDJSON, CSV, XLSX, XLS, or XML file.'}, 400
+            sample_size = int(options.get('sample_size') or staging.PREVIEW_SAMPLE_SIZE)
+            summary = staging.stage_records(tenant_db, records, file.filename, coercion_errors, sample_size)
+        return {'message': 'File staged for preview', **summary, 'timings': timings}, 200
+
+    new_data, coercion_errors = read_upload(file, options, timings=timings, progress=progress)
+    if new_data is None:
+        return {'message': 'Invalid file type. Please upload a JSON, NDJSON, CSV, XLSX, XLS, or XML file.'}, 400
+    # Return the new data for preview without merging
+    return {'message': 'File uploaded for preview', 'new_data': new_data, 'record_count': len(new_data),
+            'coercion_errors': coercion_errors}, 200
+
+# Helper function to parse an uploaded file based on its extension.
+# Tabular formats are loaded into a DataFrame, normalized column by column and
+# only turned into dicts at the end; JSON and XML documents get the same
+# vectorized coercion through normalize_records. With stream=True, CSV, NDJSON
+# and XML records are yielded batch by batch instead of being collected into a list.
+# Large CSV, NDJSON and Excel uploads are parsed on a process pool (see
+# parallel_parse.py); the 'parallel' option forces this on or off.
+# Options: record_path (XML), sheets (Excel: comma separated names or 'all',
+# default the first sheet) and parallel.
+# Returns the records and the coercion error count per column, or (None, None)
+# for unsupported file types. Without stream, the parse and normalize steps are
+# added to timings; formats that are normalized while they are parsed report
+# both as parse.
+def read_upload(file, options=None, stream=False, timings=None, progress=None):
+    options = options or {}
+    timings = {} if timings is None else timings
+    filename = file.filename.lower()
+    errors = {}
+    record_path = options.get('record_path') or XML_RECORD_PATH
+    sheets = options.get('sheets')
+
+    if parallel_parse.use_parallel(filename, file.stream, options.get('parallel')):
+        batches = parallel_parse.iter_parallel_batches(filename, file.stream, errors, sheets=sheets)
+        records = chain.from_iterable(batches)
+        if stream:
+            return records, errors
+        with timed(timings, 'parse', progress):
+            return list(records), errors
+
+    if filename.endswith('.csv') and stream:
+        return iter_csv_records(file.stream, errors), errors
+    if filename.endswith('.xml') and stream:
+        return iter_normalized_records(iter_xml_records(file.stream, record_path), errors), errors
+    if filename.endswith(('.ndjson', '.jsonl')):
+        records = iter_normalized_records(iter_ndjson_records(file.stream), errors)
+        if stream:
+            return records, errors
+        with timed(timings, 'parse', progress):
+            return list(records), errors
+
+    if not filename.endswith(('.json', '.xml', '.csv', '.xlsx', '.xls')):
+        return None, None
+    records = frame = None
+    with timed(timings, 'parse', progress):
         if filename.endswith('.json'):
-            new_data = process_json(file)
-        elif filename.endswith('.csv'):
-            new_data = process_csv(file)
-        elif filename.endswith('.xlsx') or filename.endswith('.xls'):
-            new_data = process_excel(file)
+            records = process_json(file)
         elif filename.endswith('.xml'):
-            new_data = process_xml(file)
+            records = process_xml(file, record_path)
+        elif filename.endswith('.csv'):
+            frame = process_csv(file)
         else:
-            return jsonify({'message': 'Invalid file type. Please upload a JSON, CSV, XLSX, XLS, or XML file.'}), 400
-        # Return the new data for preview without merging
-        return jsonify({'message': 'File uploaded for preview', 'new_data': new_data}), 200
-    except Exception as e:
-        return jsonify({'message': f'Error processing file: {str(e)}'}), 500
+            frame = process_excel(file, sheets)
+
+    with timed(timings, 'normalize', progress):
+        if records is not None:
+            return records, normalize_records(records)
+        frame, errors = normalize_frame(frame, nest_customer=True if filename.endswith('.csv') else None)
+        return frame_to_records(frame), errors
 
 # # 5. Get Existing Data Schema
 # @app.route('/api/sales-schema', methods=['GET'])
@@ -108,118 +416,262 @@ def upload_preview():
 
 @app.route('/api/process-merge-mappings', methods=['POST'])
 def process_merge_with_mappings():
+    if run_as_job():
+        input_path = job_queue.input_path('.json')
+        with open(input_path, 'wb') as f:
+            f.write(request.get_data())
+        return submit_job('merge_mappings', {}, input_path)
     try:
-        data = request.json
-        new_data = data.get('new_data', [])
-        field_mappings = data.get('field_mappings', {}).get('mappings', [])
-        matching_fields = data.get('matching_fields', [])
-
-        if not new_data or not field_mappings:
-            return jsonify({
-                'message': 'Missing new data or field mappings',
-                'status': 'error'
-            }), 400
-
-        # Create a dictionary for easier access to mappings
-        mapping_dict = {mapping['existing']: mapping['new'] for mapping in field_mappings if mapping['new']}
-
-        # Transform the new data according to the mappings
-        transformed_data = []
-        for record in new_data:
-            transformed_record = {}
-
-            # Apply field mappings, creating nested objects as needed
-            for existing_field, new_field in mapping_dict.items():
-                if new_field in record:
-                    # Handle nested fields in existing_field
-                    if '.' in existing_field:
-                        parts = existing_field.split('.')
-                        current = transformed_record
-
-                        # Build the nested structure
-                        for i, part in enumerate(parts):
-                            if i == len(parts) - 1:
-                                # Last part is the actual field
-                                current[part] = record[new_field]
-                            else:
-                                # Create nested objects if they don't exist
-                                if part not in current:
-                                    current[part] = {}
-                                current = current[part]
-                    else:
-                        # Simple field, no nesting
-                        transformed_record[existing_field] = record[new_field]
-
-            # Only add records that have mapped values
-            if transformed_record:
-                transformed_data.append(transformed_record)
-
-        if not transformed_data:
-            return jsonify({
-                'message': 'No valid records after applying mappings',
+        result, status_code = merge_with_mappings(request.json)
+        return jsonify(result), status_code
+    except Exception as e:
+        return jsonify({
+            'message': f'Error processing merge: {str(e)}',
+            'status': 'error'
+        }), 500
+
+@metrics.track_operation('merge_mappings')
+def merge_with_mappings(data, progress=None):
+    new_data = data.get('new_data', [])
+    staging_id = data.get('staging_id')  # handle returned by a staged preview
+    field_mappings = data.get('field_mappings', {}).get('mappings', [])
+    matching_fields = data.get('matching_fields', [])
+    mode = data.get('mode', 'replace')  # 'replace' or 'upsert'
+
+    if staging_id:
+        if staging.get_staged_upload(tenant_db, staging_id) is None:
+            return {
+                'message': f'Staged upload not found or expired: {staging_id}',
                 'status': 'error'
-            }), 400
+            }, 404
+        new_data = staging.iter_staged_records(tenant_db, staging_id)
 
-        # Backup current data
-        backup_name = backup_sales_collection()
+    if not (new_data or staging_id) or not field_mappings:
+        return {
+            'message': 'Missing new data or field mappings',
+            'status': 'error'
+        }, 400
+
+    if not staging_id and not (isinstance(new_data, dict) or
+                               isinstance(new_data, list) and all(isinstance(r, dict) for r in new_data)):
+        return {
+            'message': 'new_data must be a list of records or an object of columns',
+            'status': 'error'
+        }, 400
+
+    if mode not in ('replace', 'upsert'):
+        return {
+            'message': f'Invalid merge mode: {mode}',
+            'status': 'error'
+        }, 400
+
+    if mode == 'upsert' and not matching_fields:
+        return {
+            'message': 'Upsert mode requires matching fields',
+            'status': 'error'
+        }, 400
 
-        # Get existing sales data
+    # Compile the mappings (with their casts and defaults) once for all records
+    try:
+        mapping = FieldMapping(field_mappings)
+    except (KeyError, ValueError) as e:
+        return {
+            'message': f'Invalid field mappings: {str(e)}',
+            'status': 'error'
+        }, 400
+
+    # Transform the new data according to the mappings. Columnar new_data
+    # ({field: [values]}) is transformed a column at a time. Upserts consume
+    # the records lazily so staged uploads are streamed from the staging collection.
+    timings = {}
+    coercion_errors = {}
+    if isinstance(new_data, dict):
+        with timed(timings, 'transform', progress):
+            try:
+                transformed_data = mapping.transform_columns(new_data, coercion_errors)
+            except ValueError as e:
+                return {
+                    'message': f'Invalid columnar data: {str(e)}',
+                    'status': 'error'
+                }, 400
+    else:
+        transformed_data = mapping.transform_records(new_data, coercion_errors)
+        if mode != 'upsert':
+            with timed(timings, 'transform', progress):
+                transformed_data = list(transformed_data)
+    first_record = next(iter(transformed_data), None)
+    if first_record is None:
+        return {
+            'message': 'No valid records after applying mappings',
+            'status': 'error'
+        }, 400
+    if mode == 'upsert':
+        transformed_data = chain([first_record], transformed_data)
+
+    # Backup current data
+    with timed(timings, 'backup', progress):
+        backup_name = backup_sales_collection()
+    if progress:
+        progress(backup_name=backup_name)
+
+    if mode == 'upsert':
+        # Only write the documents that were added or changed
+        with timed(timings, 'write', progress):
+            unique_index = indexes.ensure_matching_index(sales_collection, matching_fields)
+            delta = analytics.RollupDelta()
+            counts = upsert_merged_data(sales_collection, transformed_data, matching_fields, delta=delta)
+        with timed(timings, 'changeset', progress):
+            record_backup_changeset(backup_name, counts['changed_ids'])
+        with timed(timings, 'analytics', progress):
+            sales_changed(delta)
+        if staging_id:
+            staging.drop_staged_upload(tenant_db, staging_id)
+        return {
+            'message': 'Data merged successfully with field mappings',
+            'status': 'success',
+            'backup_name': backup_name,
+            'mode': mode,
+            'unique_index': unique_index,
+            'inserted_count': counts['inserted'],
+            'updated_count': counts['updated'],
+            'unchanged_count': counts['unchanged'],
+            'failed_count': counts['failed'],
+            'write_errors': counts['errors'],
+            'coercion_errors': coercion_errors,
+            'timings': timings
+        }, 200
+
+    # Get existing sales data
+    with timed(timings, 'fetch_existing', progress):
         existing_data = list(sales_collection.find())
         # Convert ObjectIds to strings for comparison
         for doc in existing_data:
             doc['_id'] = str(doc['_id'])
 
-        # Merge the data based only on matching fields
+    # Merge the data based only on matching fields
+    with timed(timings, 'merge', progress):
         merged_data = merge_with_existing_data(existing_data, transformed_data, matching_fields)
 
-        # Convert string IDs back to ObjectIds if they exist
-        for doc in merged_data:
-            if '_id' in doc and isinstance(doc['_id'], str):
-                try:
-                    doc['_id'] = ObjectId(doc['_id'])
-                except:
-                    # If conversion fails, remove the _id so MongoDB can assign a new one
-                    del doc['_id']
+    # Convert string IDs back to ObjectIds if they exist
+    for doc in merged_data:
+        if '_id' in doc and isinstance(doc['_id'], str):
+            try:
+                doc['_id'] = ObjectId(doc['_id'])
+            except:
+                # If conversion fails, remove the _id so MongoDB can assign a new one
+                del doc['_id']
 
-        # Clear existing collection and insert merged data
+    # Clear existing collection and insert merged data
+    with timed(timings, 'write', progress):
         sales_collection.delete_many({})
-        sales_collection.insert_many(merged_data)
-
-        return jsonify({
-            'message': 'Data merged successfully with field mappings',
-            'status': 'success',
-            'backup_name': backup_name,
-            'record_count': len(merged_data)
-        }), 200
-
-    except Exception as e:
-        return jsonify({
-            'message': f'Error processing merge: {str(e)}',
-            'status': 'error'
-        }), 500
+        insert_summary, written = insert_sales_batches(merged_data)
+
+    with timed(timings, 'changeset', progress):
+        changed_ids, deleted_ids = backups.changed_document_ids(existing_data, written)
+        record_backup_changeset(backup_name, changed_ids, deleted_ids)
+
+    # Most of the old and new contributions cancel out, only the difference is written
+    with timed(timings, 'analytics', progress):
+        delta = analytics.RollupDelta()
+        delta.add_all(existing_data, sign=-1)
+        delta.add_all(written)
+        sales_changed(delta)
+    if staging_id:
+        staging.drop_staged_upload(tenant_db, staging_id)
+
+    return {
+        'message': 'Data merged successfully with field mappings',
+        'status': 'success',
+        'backup_name': backup_name,
+        'record_count': len(written),
+        'failed_count': insert_summary['failed_count'],
+        'write_errors': insert_summary['errors'],
+        'coercion_errors': coercion_errors,
+        'timings': timings
+    }, 200
+
+def upsert_merged_data(collection, new_data, matching_fields, batch_size=UPSERT_BATCH_SIZE, delta=None):
+    """
+    Merge new records (any iterable, consumed one batch at a time) into the
+    collection with batched bulk_write upserts. Only documents that are added or actually change are written.
+    Returns counts of inserted, updated, unchanged and failed records, the
+    write errors of the batches that had any (like bulk_ingest.insert_in_batches)
+    and the ids of the documents that were written. When delta (an
+    analytics.RollupDelta) is given, the before and after versions of the
+    written documents are added to it.
+    """
+    key_extractor = compile_key_extractor(matching_fields)
+    build_filter = compile_key_filter(matching_fields)
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'failed': 0, 'errors': [], 'changed_ids': []}
 
-# Helper function to check if records match based on nested fields too
-def records_match(record1, record2, matching_fields):
-    for field in matching_fields:
-        # Handle nested fields
-        if '.' in field:
-            parts = field.split('.')
-            value1 = record1
-            value2 = record2
-
-            # Navigate to the nested value
-            for part in parts:
-                value1 = value1.get(part) if isinstance(value1, dict) else None
-                value2 = value2.get(part) if isinstance(value2, dict) else None
-
-            if value1 != value2:
-                return False
-        else:
-            # Simple field comparison
-            if record1.get(field) != record2.get(field):
-                return False
+    for number, records in enumerate(iter_batches(new_data, batch_size)):
+        # Collapse records that share a key so each document is written once per batch
+        batch = {}
+        for record in records:
+            key = key_extractor(record)
+            batch[key] = merge_records(batch[key], record) if key in batch else record
+
+        # Fetch the existing documents for this batch in one query
+        existing = {}
+        for doc in collection.find(existing_documents_query(matching_fields, build_filter, batch.values())):
+            existing.setdefault(key_extractor(doc), doc)
+
+        # Each operation keeps the old and new document, the delta and
+        # changed ids are only updated for the operations that succeed
+        operations, changes_made = [], []
+        for key, record in batch.items():
+            doc = existing.get(key)
+            if doc is None:
+                fields = {field: value for field, value in record.items() if field != '_id'}
+                operations.append(UpdateOne(build_filter(record), {'$set': fields}, upsert=True))
+                changes_made.append((None, fields))
+                continue
+            changes = diff_update(doc, record)
+            if changes:
+                operations.append(UpdateOne({'_id': doc['_id']}, {'$set': changes}))
+                changes_made.append((doc, merge_records(doc, record)))
+            else:
+                counts['unchanged'] += 1
+        if not operations:
+            continue
 
-    return True
+        try:
+            result = collection.bulk_write(operations, ordered=False).bulk_api_result
+        except BulkWriteError as e:
+            result = e.details
+        write_errors = result.get('writeErrors', [])
+        failed_indexes = {error['index'] for error in write_errors}
+        counts['inserted'] += result.get('nUpserted', 0)
+        counts['updated'] += result.get('nModified', 0)
+        counts['failed'] += len(failed_indexes)
+        counts['changed_ids'].extend(upserted['_id'] for upserted in result.get('upserted', []))
+        for i, (doc, new_doc) in enumerate(changes_made):
+            if i in failed_indexes:
+                continue
+            if doc is not None:
+                counts['changed_ids'].append(doc['_id'])
+            if delta is not None:
+                if doc is None:
+                    delta.add(new_doc)
+                else:
+                    delta.replace(doc, new_doc)
+        if write_errors:
+            counts['errors'].append({
+                'batch': number,
+                'offset': number * batch_size,
+                'failed_count': len(failed_indexes),
+                'errors': [{'code': error.get('code'), 'message': error.get('errmsg')}
+                           for error in write_errors[:bulk_ingest.BULK_MAX_ERRORS_PER_BATCH]]
+            })
+
+    return counts
+
+# Query selecting the documents that share a matching key with any of the records
+def existing_documents_query(matching_fields, build_filter, records):
+    if len(matching_fields) == 1:
+        field = matching_fields[0]
+        return {field: {'$in': [build_filter(record)[field] for record in records]}}
+    return {'$or': [build_filter(record) for record in records]}
 
 # Helper function to merge data based on matching fields
 # def merge_with_existing_data(existing_data, new_data, matching_fields):
@@ -273,81 +725,22 @@ def records_match(record1, record2, matching_fields):
 #     return merged_data
 
 
-def merge_with_existing_data(existing_data, new_data, matching_fields):
-    merged_data = []
-    processed_existing_data = set()
-
-    # Process each record in the new data
-    for new_record in new_data:
-        match_found = False
-
-        # Check against existing data
-        for i, existing_record in enumerate(existing_data):
-            # Only check records we haven't processed yet
-            if i in processed_existing_data:
-                continue
-
-            # Check if records match based on matching fields
-            if records_match(existing_record, new_record, matching_fields):
-                match_found = True
-                processed_existing_data.add(i)
-
-                # Create merged record by preserving structure
-                merged_record = {**existing_record}
-
-                # Update with new data at the field level
-                for field, value in new_record.items():
-                    if isinstance(value, dict) and field in merged_record and isinstance(merged_record[field], dict):
-                        # For nested objects, merge recursively
-                        merged_record[field] = {**merged_record[field], **value}
-                    else:
-                        # For simple fields or complete replacement of nested objects
-                        merged_record[field] = value
-
-                merged_data.append(merged_record)
-                break
-
-        # If no match found, add the new record as is
-        if not match_found:
-            merged_data.append(new_record)
-
-    # Add remaining existing records that weren't matched
-    for i, existing_record in enumerate(existing_data):
-        if i not in processed_existing_data:
-            merged_data.append(existing_record)
-
-    return merged_data
-
-# Update the existing sales-schema endpoint to include nested fields
+# Sales schema endpoint, including nested fields. 'schema' lists every field
+# path found in the collection; 'fields' adds how many documents have each
+# field, that share of the collection and the types seen. Served from the
+# schema registry (see schema_registry.py), recomputed only after writes.
 @app.route('/api/sales-schema', methods=['GET'])
+@sales_cache.cached
 def get_sales_schema():
-    sales = sales_collection.find_one()
-    if sales:
-        schema = get_schema_with_nested(sales)
-        return jsonify({'schema': schema}), 200
-    else:
-        return jsonify({'schema': []}), 200  # No data in the collection
-
-def get_schema_with_nested(document, prefix=""):
-    """Extract schema including nested fields"""
-    schema = []
-
-    for key, value in document.items():
-        # Skip MongoDB _id field
-        if key == '_id':
-            continue
+    schema = schema_registry.get_schema(tenant_db, sales_collection)
+    return jsonify(sales_schema_response(schema)), 200
 
-        # Handle nested objects (except arrays)
-        if isinstance(value, dict):
-            nested_schema = get_schema_with_nested(value, f"{key}.")
-            schema.extend(nested_schema)
-        else:
-            if prefix:
-                schema.append(f"{prefix}{key}")
-            else:
-                schema.append(key)
-
-    return schema
+def sales_schema_response(schema):
+    return {
+        'schema': schema_registry.field_names(schema),
+        'fields': schema['fields'],
+        'document_count': schema['document_count']
+    }
 
 
 def get_schema(document):
@@ -365,10 +758,10 @@ def merge_data():
 
     # Adjust new_data based on selected schema
     if selected_schema == 'original':
-        # Get original schema
-        sales = sales_collection.find_one()
-        if sales:
-            original_schema = set(sales.keys())
+        # Get original schema, the top-level fields found across the collection
+        schema = schema_registry.get_schema(tenant_db, sales_collection)
+        if schema['fields']:
+            original_schema = schema_registry.top_level_fields(schema) | {'_id'}
             for item in new_data:
                 # Remove keys not in original schema
                 keys_to_remove = set(item.keys()) - original_schema
@@ -381,98 +774,55 @@ def merge_data():
         # Optionally, update existing data to match new schema
         pass  # For simplicity, we won't modify existing data here
 
+    timings = {}
+
     # Trigger backup before merging
-    backup_name = backup_sales_collection()
+    with timed(timings, 'backup'):
+        backup_name = backup_sales_collection()
 
     # Insert the adjusted new data
-    sales_collection.insert_many(new_data)
+    with timed(timings, 'write'):
+        insert_summary, written = insert_sales_batches(new_data)
+
+    with timed(timings, 'changeset'):
+        record_backup_changeset(backup_name, [doc['_id'] for doc in written])
 
-    return jsonify({'message': 'Data merged successfully', 'backup_name': backup_name}), 200
+    with timed(timings, 'analytics'):
+        delta = analytics.RollupDelta()
+        delta.add_all(written)
+        sales_changed(delta)
+
+    return jsonify({'message': 'Data merged successfully', 'backup_name': backup_name,
+                    'inserted_count': insert_summary['inserted_count'],
+                    'failed_count': insert_summary['failed_count'],
+                    'write_errors': insert_summary['errors'], 'timings': timings}), 200
 
 def process_json(file):
     """ Process uploaded JSON file """
-    data = json.load(file.stream)
-    # Ensure numerical fields are correct types
-    for record in data:
-        record['sales_amount'] = float(record.get('sales_amount', 0))
-        record['units_sold'] = int(record.get('units_sold', 0))
-    return data
+    return json.load(file.stream)
 
 def process_csv(file):
-    """ Process uploaded CSV file """
+    """ Load uploaded CSV file into a DataFrame """
     try:
-        # Read the file content and decode it
-        file_contents = file.read().decode('utf-8', errors='ignore')
-        decoded_file = io.StringIO(file_contents)
-        csv_reader = csv.DictReader(decoded_file)
-        data = []
-        for row in csv_reader:
-            # Convert numerical fields safely
-            try:
-                row['sales_amount'] = float(row.get('sales_amount', 0))
-            except ValueError:
-                row['sales_amount'] = 0.0  # Default value or handle as needed
-            try:
-                row['units_sold'] = int(row.get('units_sold', 0))
-            except ValueError:
-                row['units_sold'] = 0  # Default value or handle as needed
-            # Nest 'location' and 'gender' under 'customer'
-            customer_info = {
-                'location': row.pop('location', None),
-                'gender': row.pop('gender', None)
-            }
-            row['customer'] = customer_info
-            data.append(row)
-        return data
+        return read_csv_frames(file.stream)
     except Exception as e:
         traceback.print_exc()
         raise Exception(f"Error processing CSV file: {str(e)}")
 
-def process_excel(file):
-    """ Process uploaded Excel file """
+def process_excel(file, sheets=None):
+    """ Load uploaded Excel file into a DataFrame, the selected sheets are stacked """
     try:
-        df = pd.read_excel(file)
-        # Ensure numerical fields are correct types
-        df['sales_amount'] = df['sales_amount'].astype(float)
-        df['units_sold'] = df['units_sold'].astype(int)
-        data = df.to_dict(orient='records')
-        return data
+        if not sheets:
+            return pd.read_excel(file)
+        sheet_names = None if sheets == 'all' else [name.strip() for name in sheets.split(',') if name.strip()]
+        return pd.concat(pd.read_excel(file, sheet_name=sheet_names).values(), ignore_index=True)
     except Exception as e:
         raise Exception(f"Error reading Excel file: {str(e)}")
 
-def process_xml(file):
+def process_xml(file, record_path=None):
     """ Process uploaded XML file """
     try:
-        content = file.read()
-        xml_dict = xmltodict.parse(content)
-
-        # Function to recursively find the list of records
-        def find_records(node):
-            if isinstance(node, list):
-                return node
-            elif isinstance(node, dict):
-                for key, value in node.items():
-                    records = find_records(value)
-                    if records is not None:
-                        return records
-            return None
-
-        records = find_records(xml_dict)
-        if records is None:
-            raise Exception("Could not find records in XML file")
-
-        data = []
-        for record in records:
-            # Convert OrderedDict to dict
-            record = dict(record)
-            # Convert numerical fields to appropriate types
-            record['sales_amount'] = float(record.get('sales_amount', 0))
-            record['units_sold'] = int(record.get('units_sold', 0))
-            # Process nested 'customer' data
-            if 'customer' in record:
-                record['customer'] = dict(record['customer'])
-            data.append(record)
-        return data
+        return list(iter_xml_records(file.stream, record_path))
     except Exception as e:
         raise Exception(f"Error processing XML file: {str(e)}")
 
@@ -483,8 +833,12 @@ def restore_backup():
     if not backup_collection_name:
         return jsonify({'error': 'No backup name provided'}), 400
     try:
-        restore_sales_collection(backup_collection_name)
-        return jsonify({'message': f'Restored from backup: {backup_collection_name}'}), 200
+        timings = {}
+        with timed(timings, 'restore'):
+            restore_sales_collection(backup_collection_name)
+        return jsonify({'message': f'Restored from backup: {backup_collection_name}', 'timings': timings}), 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 404
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -496,71 +850,463 @@ def upload_and_merge_data():
     file = request.files['file']
     if file.filename == '':
         return jsonify({'message': 'No file selected for uploading'}), 400
+    if run_as_job():
+        return submit_upload_job('upload', file)
     try:
-        filename = file.filename.lower()
-        if filename.endswith('.json'):
-            new_data = process_json(file)
-        elif filename.endswith('.csv'):
-            new_data = process_csv(file)
-        elif filename.endswith('.xlsx') or filename.endswith('.xls'):
-            new_data = process_excel(file)
-        elif filename.endswith('.xml'):
-            new_data = process_xml(file)
-        else:
-            return jsonify({'message': 'Invalid file type. Please upload a JSON, CSV, XLSX, XLS, or XML file.'}), 400
+        result, status_code = merge_upload(file, request.form)
+        return jsonify(result), status_code
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({'message': f'Error processing file: {str(e)}'}), 500
 
-        # Get existing sales data from the database
-        local_data_cursor = sales_collection.find()
-        local_data = list(local_data_cursor)
+# Modes: replace (default) sends the full existing documents to the merge
+# service and replaces sales with the result. delta sends only the _id and
+# matching_fields of the existing documents and applies the result as $set
+# updates by _id plus inserts, nothing is deleted. upsert skips the service.
+@metrics.track_operation('upload')
+def merge_upload(file, options, progress=None):
+    metrics.observe_payload('file', parallel_parse.stream_size(file.stream))
+    mode = options.get('mode') or 'replace'
+    if mode == 'upsert':
+        return upsert_upload(file, options, progress)
+    if mode not in ('replace', 'delta'):
+        return {'message': f'Invalid merge mode: {mode}'}, 400
+    matching_fields = form_matching_fields(options)
+    if mode == 'delta' and not matching_fields:
+        return {'message': 'Delta mode requires matching fields'}, 400
+
+    timings = {}
+    new_data, coercion_errors = read_upload(file, options, timings=timings, progress=progress)
+    if new_data is None:
+        return {'message': 'Invalid file type. Please upload a JSON, NDJSON, CSV, XLSX, XLS, or XML file.'}, 400
+
+    # Get existing sales data from the database, only the matching keys in delta mode
+    with timed(timings, 'fetch_existing', progress):
+        projection = {field: 1 for field in matching_fields} if mode == 'delta' else None
+        local_data = list(sales_collection.find({}, projection))
         # Convert ObjectId to string in local_data
         for doc in local_data:
             doc['_id'] = str(doc['_id'])
 
-        # Prepare payload for the merge request
-        payload = {
-            'local_data': local_data,
-            'new_data': new_data
-        }
-
-        # Retrieve the API token
-        api_token = os.environ.get('API_TOKEN')
+    # Send the merge request to the merge service (see merge_client.py)
+    with timed(timings, 'merge', progress):
+        try:
+            response = merge_client.request_merge(local_data, new_data,
+                                                  matching_fields if mode == 'delta' else None)
+        except merge_client.MergeServiceError as e:
+            return {'message': f'Merge failed: {str(e)}'}, 502
+    request_bytes = int(response.request.headers.get('Content-Length', 0))
+    metrics.observe_payload('merge_request', request_bytes)
+
+    if response.status_code == 200:
+        # Parse the merged data from the response
+        merged_data = response.json().get('merged_data')
+
+        if merged_data:
+            # Backup existing sales data
+            with timed(timings, 'backup', progress):
+                backup_name = backup_sales_collection()
+            if progress:
+                progress(backup_name=backup_name)
 
-        # Set the headers with the Authorization token
-        headers = {
-            'Authorization': f'Bearer {api_token}'
-        }
+            # Convert '_id' fields back to ObjectId
+            for doc in merged_data:
+                if '_id' in doc:
+                    doc['_id'] = ObjectId(doc['_id'])
 
-        # Send the merge request to the other server
-        merge_url = 'http://167.172.135.70:5000/merge'
+            if mode == 'delta':
+                result = apply_delta_merge(merged_data, timings, progress)
+            else:
+                result = replace_with_merged_data(local_data, merged_data, timings, progress)
+            with timed(timings, 'changeset', progress):
+                record_backup_changeset(backup_name, result.pop('changed_ids'), result.pop('deleted_ids'))
 
-        response = requests.post(merge_url, json=payload, headers=headers)
+            return {'message': 'Data merged successfully', 'backup_name': backup_name, 'mode': mode,
+                    **result, 'request_bytes': request_bytes,
+                    'coercion_errors': coercion_errors, 'timings': timings}, 200
+        else:
+            return {'message': 'Merge failed: No merged data received from the server'}, 500
+    else:
+        return {'message': f'Merge failed: {response.text}'}, response.status_code
 
-        if response.status_code == 200:
-            # Parse the merged data from the response
-            merged_data = response.json().get('merged_data')
+# Replace existing data in the database with the merged data
+def replace_with_merged_data(local_data, merged_data, timings, progress=None):
+    with timed(timings, 'write', progress):
+        sales_collection.delete_many({})
+        insert_summary, written = insert_sales_batches(merged_data)
+
+    with timed(timings, 'analytics', progress):
+        delta = analytics.RollupDelta()
+        delta.add_all(local_data, sign=-1)
+        delta.add_all(written)
+        sales_changed(delta)
+
+    changed_ids, deleted_ids = backups.changed_document_ids(local_data, written)
+    return {'failed_count': insert_summary['failed_count'], 'write_errors': insert_summary['errors'],
+            'changed_ids': changed_ids, 'deleted_ids': deleted_ids}
+
+# Apply the result of a delta merge: documents with an _id are updated in place
+# with only the fields that changed, documents without one are inserted
+def apply_delta_merge(merged_data, timings, progress=None):
+    existing = [doc for doc in merged_data if '_id' in doc]
+    new = [doc for doc in merged_data if '_id' not in doc]
+
+    with timed(timings, 'write', progress):
+        delta = analytics.RollupDelta()
+        counts = upsert_merged_data(sales_collection, existing, ['_id'], delta=delta)
+        insert_summary, written = insert_sales_batches(new)
+        delta.add_all(written)
+
+    with timed(timings, 'analytics', progress):
+        sales_changed(delta)
+
+    return {'inserted_count': insert_summary['inserted_count'], 'updated_count': counts['updated'],
+            'unchanged_count': counts['unchanged'], 'failed_count': counts['failed'] + insert_summary['failed_count'],
+            'write_errors': counts['errors'] + insert_summary['errors'],
+            'changed_ids': counts['changed_ids'] + [doc['_id'] for doc in written], 'deleted_ids': []}
+
+# Matching fields sent as a comma separated form field
+def form_matching_fields(options):
+    return [field.strip() for field in (options.get('matching_fields') or '').split(',') if field.strip()]
+
+# Upsert an uploaded file straight into sales, batch by batch, without the
+# remote merge service. Used by /api/upload with mode=upsert and a comma
+# separated matching_fields form field.
+def upsert_upload(file, options, progress=None):
+    matching_fields = form_matching_fields(options)
+    if not matching_fields:
+        return {'message': 'Upsert mode requires matching fields'}, 400
+
+    records, coercion_errors = read_upload(file, options, stream=True)
+    if records is None:
+        return {'message': 'Invalid file type. Please upload a JSON, NDJSON, CSV, XLSX, XLS, or XML file.'}, 400
+
+    timings = {}
+    with timed(timings, 'backup', progress):
+        backup_name = backup_sales_collection()
+    if progress:
+        progress(backup_name=backup_name)
+    with timed(timings, 'write', progress):
+        unique_index = indexes.ensure_matching_index(sales_collection, matching_fields)
+        delta = analytics.RollupDelta()
+        counts = upsert_merged_data(sales_collection, records, matching_fields, delta=delta)
+    with timed(timings, 'changeset', progress):
+        record_backup_changeset(backup_name, counts['changed_ids'])
+    with timed(timings, 'analytics', progress):
+        sales_changed(delta)
+
+    return {
+        'message': 'Data merged successfully',
+        'backup_name': backup_name,
+        'unique_index': unique_index,
+        'inserted_count': counts['inserted'],
+        'updated_count': counts['updated'],
+        'unchanged_count': counts['unchanged'],
+        'failed_count': counts['failed'],
+        'write_errors': counts['errors'],
+        'coercion_errors': coercion_errors,
+        'timings': timings
+    }, 200
+
+# 9. Background Jobs
+# /api/upload, /api/upload-preview and /api/process-merge-mappings run as a
+# background job when called with ?async=true. They answer 202 with a job id
+# right away; poll /api/jobs/<job_id> for status, progress and the result.
+def run_as_job():
+    return request.args.get('async', '').lower() in ('1', 'true', 'yes')
+
+def submit_job(job_type, params, input_path=None):
+    job_id = job_queue.submit(job_type, {**params, 'tenant': tenants.current_tenant()}, input_path)
+    return jsonify({
+        'message': 'Job submitted',
+        'job_id': str(job_id),
+        'status': 'queued',
+        'status_url': f'/api/jobs/{job_id}'
+    }), 202
+
+# Form fields of an upload that are kept with its job
+UPLOAD_OPTION_KEYS = ('mode', 'matching_fields', 'record_path', 'stage', 'sample_size', 'sheets', 'parallel')
+
+def submit_upload_job(job_type, file):
+    # The uploaded file only lives as long as the request, keep a copy for the job
+    input_path = job_queue.input_path(os.path.splitext(file.filename)[1])
+    file.save(input_path)
+    options = {key: request.form.get(key) for key in UPLOAD_OPTION_KEYS if key in request.form}
+    return submit_job(job_type, {'filename': file.filename, 'options': options}, input_path)
+
+def open_job_upload(job):
+    return FileStorage(stream=open(job['input_path'], 'rb'), filename=job['params']['filename'])
+
+def run_upload_preview_job(job, progress):
+    file = open_job_upload(job)
+    try:
+        return preview_upload(file, job['params']['options'], progress)
+    finally:
+        file.close()
 
-            if merged_data:
-                # Backup existing sales data
-                backup_name = backup_sales_collection()
+def run_upload_job(job, progress):
+    file = open_job_upload(job)
+    try:
+        return merge_upload(file, job['params']['options'], progress)
+    finally:
+        file.close()
+
+def run_merge_mappings_job(job, progress):
+    with open(job['input_path'], 'rb') as f:
+        data = json.load(f)
+    return merge_with_mappings(data, progress)
+
+def tenant_job(handler):
+    # Jobs run for the tenant that submitted them
+    def run(job, progress):
+        with tenants.use_tenant(job['params'].get('tenant')):
+            return handler(job, progress)
+    return run
+
+job_queue = JobQueue(tasks_collection, app)
+job_queue.register('upload_preview', tenant_job(run_upload_preview_job))
+job_queue.register('upload', tenant_job(run_upload_job))
+job_queue.register('merge_mappings', tenant_job(run_merge_mappings_job))
+
+@app.before_request
+def recover_jobs():
+    # Resume or fail the jobs left behind by a previous worker, once per process
+    if not job_queue.recovered:
+        job_queue.recover()
+
+@app.before_request
+def ensure_sales_indexes():
+    # Builds the filter and matching field indexes in the background, once per process
+    indexes.ensure_sales_indexes(sales_collection)
+
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    limit = min(request.args.get('limit', 50, type=int), 500)
+    jobs = job_queue.list(request.args.get('status'), limit, tenants.job_filter())
+    for job in jobs:
+        job['_id'] = str(job['_id'])
+    return jsonify({'jobs': jobs}), 200
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    try:
+        job = job_queue.get(ObjectId(job_id), tenants.job_filter())
+    except InvalidId:
+        return jsonify({'message': f'Invalid job id: {job_id}'}), 400
+    if job is None:
+        return jsonify({'message': f'Job not found: {job_id}'}), 404
+    job['_id'] = str(job['_id'])
+    return jsonify(job), 200
+
+# 10. Analytics
+# Precomputed sales_amount, units_sold and record count totals, kept up to date
+# by the write endpoints. GET /api/analytics returns the overall total and the
+# available dimensions; GET /api/analytics/<dimension> returns one row per value,
+# sorted by sort (sales_amount, units_sold, count or value) and capped by limit.
+ANALYTICS_SORT_FIELDS = {'sales_amount', 'units_sold', 'count', 'value'}
+
+@app.route('/api/analytics', methods=['GET'])
+@sales_cache.cached
+def get_analytics_summary():
+    total = analytics.get_rollups(analytics_collection, 'total', limit=1)
+    return jsonify({
+        'total': total[0] if total else {'value': 'all', 'sales_amount': 0, 'units_sold': 0, 'count': 0},
+        'dimensions': [dimension for dimension in analytics.ANALYTICS_DIMENSIONS if dimension != 'total']
+    }), 200
+
+@app.route('/api/analytics/<dimension>', methods=['GET'])
+@sales_cache.cached
+def get_analytics(dimension):
+    if dimension not in analytics.ANALYTICS_DIMENSIONS:
+        return jsonify({'message': f'Unknown analytics dimension: {dimension}'}), 404
+    sort = request.args.get('sort', 'sales_amount')
+    if sort not in ANALYTICS_SORT_FIELDS:
+        return jsonify({'message': f'Invalid sort field: {sort}'}), 400
+    limit = min(request.args.get('limit', 100, type=int), 10000)
+    rows = analytics.get_rollups(analytics_collection, dimension, sort, limit)
+    return jsonify({'dimension': dimension, 'rows': rows}), 200
+
+@app.route('/api/analytics/rebuild', methods=['POST'])
+def rebuild_analytics():
+    timings = {}
+    try:
+        with timed(timings, 'rebuild'):
+            analytics.rebuild_rollups(sales_collection, analytics_collection)
+    finally:
+        # A rebuild that failed halfway has still replaced some of the rows
+        sales_cache.bump()
+    return jsonify({'message': 'Analytics rebuilt', 'timings': timings}), 200
+
+
+# 11. Bulk Ingestion
+# POST /api/sales/bulk takes a JSON array, or NDJSON (one document per line,
+# Content-Type application/x-ndjson) which is read as it arrives and can be
+# sent chunked. Documents are written with unordered insert_many calls in
+# batches of batch_size, with at most BULK_MAX_IN_FLIGHT batches in flight
+# (see bulk_ingest.py). Failed documents are reported per batch (index counts
+# the documents that were accepted) and lines that are not JSON objects by
+# line number; neither stops the load. The response answers 207 when anything
+# failed and includes the throughput in inserted records per second.
+BULK_MAX_BATCH_SIZE = int(os.environ.get('BULK_MAX_BATCH_SIZE', 10000))
+NDJSON_MIMETYPES = {'application/x-ndjson', 'application/ndjson', 'application/jsonl', 'application/json-lines'}
+
+@app.route('/api/sales/bulk', methods=['POST'])
+def bulk_insert_sales():
+    batch_size = request.args.get('batch_size', bulk_ingest.BULK_BATCH_SIZE, type=int)
+    if not 0 < batch_size <= BULK_MAX_BATCH_SIZE:
+        return jsonify({'message': f'batch_size must be between 1 and {BULK_MAX_BATCH_SIZE}'}), 400
+
+    parse_errors = []
+    if request.mimetype in NDJSON_MIMETYPES:
+        records = iter_ndjson_records(request.stream, parse_errors)
+    else:
+        data = request.get_json(silent=True)
+        if not isinstance(data, list):
+            return jsonify({'message': 'Expected a JSON array or an application/x-ndjson body'}), 400
+        records = (record for record in data if isinstance(record, dict))
+        parse_errors = [{'index': i, 'message': 'Expected a JSON object'}
+                        for i, record in enumerate(data) if not isinstance(record, dict)]
 
-                # Replace existing data in the database with the merged data
-                sales_collection.delete_many({})
+    summary = insert_records(records, batch_size, parse_errors)
+    return jsonify(summary), 207 if summary['failed_count'] else 200
 
-                # Convert '_id' fields back to ObjectId
-                for doc in merged_data:
-                    if '_id' in doc:
-                        doc['_id'] = ObjectId(doc['_id'])
+def insert_records(records, batch_size, parse_errors, summary=None):
+    """
+    Bulk insert records into sales and update analytics, returns the summary
+    of the load. When reading the records fails partway (a truncated or
+    corrupt file, a client that went away) the error is raised, and summary,
+    when given, holds the counts of the documents that were inserted before it.
+    """
+    summary = {} if summary is None else summary
+    delta = analytics.RollupDelta()
 
-                sales_collection.insert_many(merged_data)
+    def add_to_delta(batch, failed_indexes):
+        for i, doc in enumerate(batch):
+            if i not in failed_indexes:
+                delta.add(doc)
 
-                return jsonify({'message': 'Data merged successfully', 'backup_name': backup_name}), 200
-            else:
-                return jsonify({'message': 'Merge failed: No merged data received from the server'}), 500
+    try:
+        bulk_ingest.insert_in_batches(sales_collection, records, batch_size, on_batch=add_to_delta,
+                                      summary=summary)
+    finally:
+        # Also after a failed read: whatever was inserted is in sales now
+        if summary.get('inserted_count'):
+            backups.invalidate_backup_chain(tenant_db)
+            sales_changed(delta)
+        summary['failed_count'] = summary.get('failed_count', 0) + len(parse_errors)
+        summary['parse_error_count'] = len(parse_errors)
+        summary['parse_errors'] = parse_errors[:bulk_ingest.BULK_MAX_ERRORS_PER_BATCH]
+    return summary
+
+
+# 12. Indexes
+# GET /api/indexes lists the indexes on sales with how often each was used
+# since the server started ($indexStats). GET /api/indexes/explain explains a
+# query: by default the GET /api/sales query for the same parameters, with
+# matching_fields (comma separated) the lookup an upsert merge on those fields
+# runs, using the keys of `sample` existing documents.
+EXPLAIN_MAX_SAMPLE = 1000
+
+@app.route('/api/indexes', methods=['GET'])
+def list_indexes():
+    try:
+        return jsonify({'indexes': indexes.index_report(sales_collection),
+                        'managed_fields': indexes.SALES_INDEX_FIELDS}), 200
+    except OperationFailure as e:
+        return jsonify({'message': f'Could not read index statistics: {str(e)}'}), 500
+
+@app.route('/api/indexes/explain', methods=['GET'])
+def explain_sales_query():
+    args = request.args.copy()
+    matching_fields = [field.strip() for field in args.pop('matching_fields', '').split(',') if field.strip()]
+    sample = min(args.get('sample', 100, type=int), EXPLAIN_MAX_SAMPLE)
+    args.pop('sample', None)
+    try:
+        if matching_fields:
+            build_filter = compile_key_filter(matching_fields)
+            records = list(sales_collection.find({}, {field: 1 for field in matching_fields}).limit(sample))
+            query = existing_documents_query(matching_fields, build_filter, records) if records else {}
+            explain = indexes.explain_query(sales_collection, query)
         else:
-            return jsonify({'message': f'Merge failed: {response.text}'}), response.status_code
+            query, projection, limit, _ = parse_sales_request(args)
+            sort = [('_id', 1)] if limit is not None or 'after' in args else None
+            explain = indexes.explain_query(sales_collection, query, projection, sort, limit)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    except OperationFailure as e:
+        return jsonify({'message': f'Explain failed: {str(e)}'}), 500
+    return jsonify({'explain': explain}), 200
+
+
+# 13. Metrics
+# Prometheus scrape endpoint: request latency and sizes per route, upload and
+# merge durations, stage timings, record counts and payload sizes (see metrics.py).
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+# 14. Export and Import
+# GET /api/sales/export?format=ndjson.gz|bson|bson.gz|parquet streams the sales
+# collection (or the documents matching the same filters and fields parameters
+# as GET /api/sales) as a download, encoded one cursor batch at a time (see
+# dumps.py). POST /api/sales/import loads such a file, sent as the 'file' form
+# field or as the request body, through the same batched insert path as
+# /api/sales/bulk. The format is taken from the format parameter or the file name.
+IMPORT_SPOOL_BYTES = int(os.environ.get('IMPORT_SPOOL_BYTES', 64 * 1024 * 1024))
+
+@app.route('/api/sales/export', methods=['GET'])
+def export_sales():
+    dump_format = request.args.get('format', 'ndjson.gz')
+    if dump_format not in dumps.FORMATS:
+        return jsonify({'message': f'Invalid format: {dump_format}, expected one of {", ".join(dumps.FORMATS)}'}), 400
+    try:
+        query = build_sales_query(request.args)
+        projection = build_projection(request.args.get('fields'))
+    except (InvalidId, ValueError) as e:
+        return jsonify({'message': f'Invalid query: {str(e)}'}), 400
+
+    filename = f"sales_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{dump_format}"
+    chunks = dumps.export_chunks(sales_collection, dump_format, query, projection)
+    return Response(stream_with_context(chunks), mimetype=dumps.FORMATS[dump_format],
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+@app.route('/api/sales/import', methods=['POST'])
+def import_sales():
+    batch_size = request.args.get('batch_size', bulk_ingest.BULK_BATCH_SIZE, type=int)
+    if not 0 < batch_size <= BULK_MAX_BATCH_SIZE:
+        return jsonify({'message': f'batch_size must be between 1 and {BULK_MAX_BATCH_SIZE}'}), 400
+
+    file = request.files.get('file')
+    dump_format = request.args.get('format') or dumps.detect_format(file.filename if file else None)
+    if dump_format not in dumps.FORMATS:
+        return jsonify({'message': f'Unknown import format, set format to one of {", ".join(dumps.FORMATS)}'}), 400
+
+    stream = file.stream if file else request.stream
+    if dump_format == 'parquet' and not file:
+        # Parquet is read from the footer, the request body has to be spooled first
+        stream = tempfile.SpooledTemporaryFile(max_size=IMPORT_SPOOL_BYTES)
+        shutil.copyfileobj(request.stream, stream)
+        stream.seek(0)
+
+    try:
+        result, status_code = import_dump(stream, dump_format, batch_size)
     except Exception as e:
-        traceback.print_exc()
-        return jsonify({'message': f'Error processing file: {str(e)}'}), 500
+        return jsonify({'message': f'Error importing {dump_format}: {str(e)}'}), 400
+    return jsonify(result), status_code
+
+@metrics.track_operation('import')
+def import_dump(stream, dump_format, batch_size):
+    metrics.observe_payload('file', parallel_parse.stream_size(stream))
+    parse_errors = []
+    summary = {'format': dump_format}
+    try:
+        insert_records(dumps.import_records(stream, dump_format, parse_errors), batch_size, parse_errors, summary)
+    except Exception as e:
+        # The documents read before the error stay inserted, report them with it
+        summary['message'] = f'Error importing {dump_format}: {str(e)}'
+        return summary, 400
+    return summary, 207 if summary['failed_count'] else 200
 
 
 @app.route('/api/clear-database', methods=['GET'])
@@ -574,6 +1320,9 @@ def clear_database():
 
         # Clear the sales collection
         sales_collection.delete_many({})
+        backups.invalidate_backup_chain(tenant_db)
+        analytics.clear_rollups(analytics_collection)
+        sales_changed()
 
         return jsonify({
             'message': f'Successfully cleared {record_count} records from the database',
@@ -585,5 +1334,7 @@ def clear_database():
             'message': f'Error clearing database: {str(e)}'
         }), 500
 
+# Development server only, production runs under Gunicorn (see gunicorn.conf.py)
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    app.run(debug=os.environ.get('FLASK_DEBUG', 'true').lower() in ('1', 'true', 'yes'),
+            host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
\ No newline at end of file
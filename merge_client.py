@@ -0,0 +1,113 @@
+"""
+Client for the remote merge service used by /api/upload.
+
+All calls share one requests.Session whose connection pool is reused between
+uploads. Requests have connect and read timeouts, and connection errors and
+502/503/504 answers are retried with exponential backoff. Read timeouts are
+not retried: the service may still be merging, and a retry would wait out
+MERGE_READ_TIMEOUT again, past the gunicorn worker timeout. The request body is
+serialized incrementally into a temporary file (gzip-compressed when
+MERGE_GZIP is set), so the payload is never held in memory as one big string
+and a retry can rewind and resend it.
+"""
+import gzip
+import json
+import os
+import tempfile
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+MERGE_SERVICE_URL = os.environ.get('MERGE_SERVICE_URL', 'http://167.172.135.70:5000/merge')
+MERGE_CONNECT_TIMEOUT = float(os.environ.get('MERGE_CONNECT_TIMEOUT', 5))
+MERGE_READ_TIMEOUT = float(os.environ.get('MERGE_READ_TIMEOUT', 300))
+MERGE_RETRIES = int(os.environ.get('MERGE_RETRIES', 3))
+# Base of the exponential backoff between retries, in seconds
+MERGE_BACKOFF_SECONDS = float(os.environ.get('MERGE_BACKOFF_SECONDS', 0.5))
+MERGE_POOL_SIZE = int(os.environ.get('MERGE_POOL_SIZE', 10))
+# Send request bodies with Content-Encoding: gzip, the service has to support it
+MERGE_GZIP = os.environ.get('MERGE_GZIP', '').lower() in ('1', 'true', 'yes')
+MERGE_GZIP_LEVEL = int(os.environ.get('MERGE_GZIP_LEVEL', 6))
+
+WRITE_BUFFER_BYTES = 64 * 1024
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class MergeServiceError(Exception):
+    """The merge service could not be reached or did not answer in time"""
+
+
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(
+                total=MERGE_RETRIES,
+                read=0,  # a read timeout fails right away, see above
+                backoff_factor=MERGE_BACKOFF_SECONDS,
+                status_forcelist=(502, 503, 504),
+                allowed_methods=frozenset({'POST'}),  # a merge has no side effects on the service
+                raise_on_status=False
+            )
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MERGE_POOL_SIZE, max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+        return _session
+
+
+def encode_payload(payload, gzip_body=MERGE_GZIP):
+    """Serialize payload as JSON into a rewound temporary file, returns (file, size in bytes)"""
+    body = tempfile.TemporaryFile()
+    target = gzip.GzipFile(fileobj=body, mode='wb', compresslevel=MERGE_GZIP_LEVEL) if gzip_body else body
+    buffer = []
+    buffered = 0
+    for chunk in json.JSONEncoder(default=str).iterencode(payload):
+        buffer.append(chunk)
+        buffered += len(chunk)
+        if buffered >= WRITE_BUFFER_BYTES:
+            target.write(''.join(buffer).encode())
+            buffer = []
+            buffered = 0
+    target.write(''.join(buffer).encode())
+    if gzip_body:
+        target.close()  # writes the gzip trailer, body stays open
+    size = body.tell()
+    body.seek(0)
+    return body, size
+
+
+def request_merge(local_data, new_data, matching_fields=None, url=None, api_token=None, gzip_body=None):
+    """
+    Send local and new data to the merge service and return the response.
+    matching_fields is passed along when local_data only holds the matching
+    key projections of the existing records (delta mode).
+    """
+    payload = {'local_data': local_data, 'new_data': new_data}
+    if matching_fields:
+        payload['matching_fields'] = matching_fields
+
+    url = url or MERGE_SERVICE_URL
+    gzip_body = MERGE_GZIP if gzip_body is None else gzip_body
+    body, size = encode_payload(payload, gzip_body)
+    headers = {
+        'Authorization': f"Bearer {api_token or os.environ.get('API_TOKEN')}",
+        'Content-Type': 'application/json',
+        'Content-Length': str(size)
+    }
+    if gzip_body:
+        headers['Content-Encoding'] = 'gzip'
+
+    try:
+        response = get_session().post(url, data=body, headers=headers,
+                                      timeout=(MERGE_CONNECT_TIMEOUT, MERGE_READ_TIMEOUT))
+    except requests.RequestException as e:
+        raise MergeServiceError(f'could not reach the merge service: {e}') from e
+    finally:
+        body.close()
+    return response
@@ -0,0 +1,161 @@
+from collections import deque
+
+
+# Helper function to turn a field value into something usable as a dict key.
+# Nested objects and arrays from MongoDB/JSON are not hashable, so they are
+# converted into tagged tuples that compare the same way the originals do.
+def freeze_value(value):
+    if isinstance(value, dict):
+        return (dict, frozenset((key, freeze_value(item)) for key, item in value.items()))
+    if isinstance(value, list):
+        return (list, tuple(freeze_value(item) for item in value))
+    return value
+
+
+def compile_field_getter(field):
+    """Build a getter for a (possibly dotted) field, splitting the path only once"""
+    if '.' not in field:
+        def get_simple(record):
+            return record.get(field) if isinstance(record, dict) else None
+        return get_simple
+
+    parts = tuple(field.split('.'))
+
+    def get_nested(record):
+        value = record
+        for part in parts:
+            value = value.get(part) if isinstance(value, dict) else None
+            if value is None:
+                return None
+        return value
+    return get_nested
+
+
+def compile_key_extractor(matching_fields):
+    """
+    Precompile matching_fields into a function that returns a hashable key
+    for a record. Missing fields map to None, same as records_match.
+    """
+    getters = [compile_field_getter(field) for field in matching_fields]
+
+    if len(getters) == 1:
+        getter = getters[0]
+
+        def extract_single(record):
+            return (freeze_value(getter(record)),)
+        return extract_single
+
+    def extract(record):
+        return tuple(freeze_value(getter(record)) for getter in getters)
+    return extract
+
+
+# Helper function to check if records match based on nested fields too
+def records_match(record1, record2, matching_fields):
+    for field in matching_fields:
+        getter = compile_field_getter(field)
+        if getter(record1) != getter(record2):
+            return False
+    return True
+
+
+def merge_records(existing_record, new_record):
+    """Merge a new record into an existing one, one level deep for nested objects"""
+    # Create merged record by preserving structure
+    merged_record = {**existing_record}
+
+    # Update with new data at the field level
+    for field, value in new_record.items():
+        if isinstance(value, dict) and field in merged_record and isinstance(merged_record[field], dict):
+            # For nested objects, merge recursively
+            merged_record[field] = {**merged_record[field], **value}
+        else:
+            # For simple fields or complete replacement of nested objects
+            merged_record[field] = value
+
+    return merged_record
+
+
+def build_key_index(records, key_extractor):
+    """
+    Index records by their matching key. Each key maps to a queue of record
+    positions in their original order, so duplicate keys are consumed first
+    come, first served.
+    """
+    index = {}
+    for i, record in enumerate(records):
+        key = key_extractor(record)
+        positions = index.get(key)
+        if positions is None:
+            index[key] = deque([i])
+        else:
+            positions.append(i)
+    return index
+
+
+def merge_with_existing_data(existing_data, new_data, matching_fields):
+    """
+    Merge new records into existing ones based on matching_fields.
+
+    Each new record is merged into the first existing record with the same key
+    that has not been matched yet; new records without a match are appended as
+    is, and unmatched existing records follow at the end in their original
+    order. The existing records are indexed once, so this runs in O(N + M)
+    instead of comparing every pair.
+    """
+    key_extractor = compile_key_extractor(matching_fields)
+    index = build_key_index(existing_data, key_extractor)
+
+    merged_data = []
+    processed_existing_data = set()
+
+    # Process each record in the new data
+    for new_record in new_data:
+        positions = index.get(key_extractor(new_record))
+        if positions:
+            i = positions.popleft()
+            processed_existing_data.add(i)
+            merged_data.append(merge_records(existing_data[i], new_record))
+        else:
+            # If no match found, add the new record as is
+            merged_data.append(new_record)
+
+    # Add remaining existing records that weren't matched
+    for i, existing_record in enumerate(existing_data):
+        if i not in processed_existing_data:
+            merged_data.append(existing_record)
+
+    return merged_data
+
+
+def compile_key_filter(matching_fields):
+    """
+    Precompile matching_fields into a function that builds the MongoDB filter
+    selecting the document with the same matching key as a record
+    """
+    getters = [(field, compile_field_getter(field)) for field in matching_fields]
+
+    def build_filter(record):
+        return {field: getter(record) for field, getter in getters}
+    return build_filter
+
+
+def diff_update(existing_record, new_record):
+    """
+    Return the $set document that turns existing_record into
+    merge_records(existing_record, new_record), containing only the fields that
+    actually change. An empty dict means the record is unchanged.
+    """
+    changes = {}
+    for field, value in new_record.items():
+        if field == '_id':
+            continue
+        current = existing_record.get(field)
+        if isinstance(value, dict) and isinstance(current, dict):
+            # Nested objects are merged one level deep, so set only the changed keys
+            for key, nested_value in value.items():
+                if key not in current or current[key] != nested_value:
+                    changes[f'{field}.{key}'] = nested_value
+        elif field not in existing_record or current != value:
+            changes[field] = value
+    return changes
@@ -0,0 +1,161 @@
+"""
+Prometheus metrics and request profiling.
+
+init_app registers request hooks that record the latency and the request
+and response sizes of every request per route. The timed() stages of
+uploads and merges are recorded per operation and stage, along with the
+record counts and payload sizes of each operation. render() produces the
+Prometheus text format for /api/metrics. When PROMETHEUS_MULTIPROC_DIR is
+set (gunicorn.conf.py does it) every worker writes its samples there and
+render() adds up all of them.
+
+With PROFILE_ENABLED set, a request with ?profile=true (or a random
+PROFILE_SAMPLE_RATE share of requests) runs under cProfile. The stats are
+written to PROFILE_DIR and the file name is sent in the X-Profile header.
+"""
+import contextvars
+import cProfile
+import functools
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from flask import g, request
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, generate_latest,
+                               multiprocess)
+
+PROFILE_ENABLED = os.environ.get('PROFILE_ENABLED', '').lower() in ('1', 'true', 'yes')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'rocketboard-profiles'))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+BYTE_BUCKETS = tuple(1024 * 4 ** power for power in range(11))  # 1 KiB to 1 GiB
+
+REQUEST_SECONDS = Histogram('rocketboard_request_duration_seconds', 'Request latency',
+                            ['method', 'route', 'status'], buckets=LATENCY_BUCKETS)
+REQUEST_BYTES = Histogram('rocketboard_request_size_bytes', 'Request body size',
+                          ['method', 'route'], buckets=BYTE_BUCKETS)
+RESPONSE_BYTES = Histogram('rocketboard_response_size_bytes', 'Response body size, streamed responses excluded',
+                           ['method', 'route'], buckets=BYTE_BUCKETS)
+OPERATION_SECONDS = Histogram('rocketboard_operation_duration_seconds',
+                              'Duration of uploads and merges, also when they run as jobs',
+                              ['operation', 'status'], buckets=LATENCY_BUCKETS)
+STAGE_SECONDS = Histogram('rocketboard_stage_duration_seconds', 'Duration of one stage of an operation',
+                          ['operation', 'stage'], buckets=LATENCY_BUCKETS)
+RECORDS = Counter('rocketboard_records', 'Records handled by operations', ['operation', 'outcome'])
+PAYLOAD_BYTES = Histogram('rocketboard_payload_size_bytes', 'Size of uploaded files and merge service requests',
+                          ['operation', 'kind'], buckets=BYTE_BUCKETS)
+
+# Result fields counted in rocketboard_records_total, the outcome label drops _count
+RECORD_COUNT_FIELDS = ('record_count', 'inserted_count', 'updated_count', 'unchanged_count', 'failed_count')
+
+_operation = contextvars.ContextVar('operation', default=None)
+# cProfile can only run one profiler per process at a time
+_profile_lock = threading.Lock()
+
+
+def current_operation():
+    operation = _operation.get()
+    if operation is None:
+        try:
+            return request.endpoint or 'unknown'
+        except RuntimeError:  # outside of a request
+            return 'unknown'
+    return operation
+
+
+def track_operation(name):
+    """Decorator for functions returning (result, status_code): times them and counts their records"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            token = _operation.set(name)
+            start = time.perf_counter()
+            status = 'error'
+            try:
+                result, status_code = func(*args, **kwargs)
+                status = str(status_code)
+                for field in RECORD_COUNT_FIELDS:
+                    if isinstance(result.get(field), int):
+                        RECORDS.labels(name, field[:-len('_count')]).inc(result[field])
+                return result, status_code
+            finally:
+                OPERATION_SECONDS.labels(name, status).observe(time.perf_counter() - start)
+                _operation.reset(token)
+        return wrapper
+    return decorator
+
+
+def observe_stage(stage, seconds):
+    STAGE_SECONDS.labels(current_operation(), stage).observe(seconds)
+
+
+def observe_payload(kind, size):
+    if size is not None:
+        PAYLOAD_BYTES.labels(current_operation(), kind).observe(size)
+
+
+def observe_request(method, route, status, seconds, request_bytes=None, response_bytes=None):
+    REQUEST_SECONDS.labels(method, route, str(status)).observe(seconds)
+    if request_bytes:
+        REQUEST_BYTES.labels(method, route).observe(request_bytes)
+    if response_bytes is not None:
+        RESPONSE_BYTES.labels(method, route).observe(response_bytes)
+
+
+def render():
+    """Return (body, content type) of the metrics in the Prometheus text format"""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+def wants_profile():
+    if not PROFILE_ENABLED:
+        return False
+    if request.args.get('profile', '').lower() in ('1', 'true', 'yes'):
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def start_request():
+    g.metrics_start = time.perf_counter()
+    if wants_profile() and _profile_lock.acquire(blocking=False):
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+def stop_profiler():
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        _profile_lock.release()
+    return profiler
+
+
+def finish_request(response):
+    profiler = stop_profiler()
+    if profiler is not None:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        filename = f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{request.endpoint or 'unmatched'}.prof"
+        profiler.dump_stats(os.path.join(PROFILE_DIR, filename))
+        response.headers['X-Profile'] = filename
+
+    start = g.pop('metrics_start', None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        observe_request(request.method, route, response.status_code, time.perf_counter() - start,
+                        request.content_length, None if response.is_streamed else response.content_length)
+    return response
+
+
+def init_app(app):
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    # Requests that fail before after_request runs must not keep the profiler
+    app.teardown_request(lambda exc: stop_profiler())
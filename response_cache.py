@@ -0,0 +1,191 @@
+"""
+Response cache for the read endpoints.
+
+Responses are kept per process in an LRU with a TTL and, when
+CACHE_REDIS_URL is set (needs the redis package), in a shared Redis cache
+as well. They are keyed by database (one per tenant), path, query parameters
+and the data version: a counter in that database that every write bumps
+through bump(). A write therefore makes every cached response of its tenant
+unreachable without deleting anything, and the old entries age out of the
+LRU and expire in Redis. Each process rereads a counter at most every
+CACHE_VERSION_CHECK_SECONDS, which bounds how long a write made by another
+worker can go unnoticed.
+
+Responses carry an ETag derived from the key and the version, so a client
+sending it back in If-None-Match gets a 304 without the view running at all.
+"""
+import functools
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response, make_response, request
+from pymongo import ReturnDocument
+
+CACHE_VERSIONS_COLLECTION = 'cache_versions'
+DATA_VERSION_ID = 'data'
+
+CACHE_ENABLED = os.environ.get('CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+CACHE_TTL_SECONDS = float(os.environ.get('CACHE_TTL_SECONDS', 300))
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 512))
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 64 * 1024 * 1024))
+# Larger responses are not stored, they still get an ETag
+CACHE_MAX_ENTRY_BYTES = int(os.environ.get('CACHE_MAX_ENTRY_BYTES', 4 * 1024 * 1024))
+CACHE_VERSION_CHECK_SECONDS = float(os.environ.get('CACHE_VERSION_CHECK_SECONDS', 1))
+CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL')
+
+
+def request_key(path, args):
+    """Cache key of a request, query parameters in a stable order"""
+    return path + '?' + '&'.join(f'{name}={value}' for name, value in sorted(args))
+
+
+def make_etag(key, version):
+    return hashlib.sha1(f'{version}:{key}'.encode()).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, db, enabled=CACHE_ENABLED, redis_url=CACHE_REDIS_URL):
+        self.db = db
+        self.enabled = enabled
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        # Database name: (data version, monotonic time it was read)
+        self.versions = {}
+        self.stats = {'hits': 0, 'misses': 0, 'not_modified': 0}
+        self.shared = None
+        if enabled and redis_url:
+            import redis
+            self.shared = redis.Redis.from_url(redis_url)
+            self.shared_prefix = 'response-cache:'
+
+    def versions_collection(self, db=None):
+        return (self.db if db is None else db)[CACHE_VERSIONS_COLLECTION]
+
+    def key(self, path, args, db=None):
+        """Cache key of a request, every database (tenant) has keys of its own"""
+        return f'{(self.db if db is None else db).name}:{request_key(path, args)}'
+
+    def set_version(self, db_name, version):
+        with self.lock:
+            # Versions only go up, a slow read must not undo a newer bump
+            version = max(version, self.versions.get(db_name, (0, 0))[0])
+            self.versions[db_name] = (version, time.monotonic())
+            return version
+
+    def fresh_version(self, db_name):
+        version, checked_at = self.versions.get(db_name, (None, 0))
+        return version if time.monotonic() - checked_at < CACHE_VERSION_CHECK_SECONDS else None
+
+    def current_version(self, db=None):
+        db = self.db if db is None else db
+        version = self.fresh_version(db.name)
+        if version is None:
+            doc = self.versions_collection(db).find_one({'_id': DATA_VERSION_ID})
+            version = self.set_version(db.name, doc['version'] if doc else 0)
+        return version
+
+    async def current_version_async(self, db):
+        """current_version reading the counter with an AsyncMongoClient database"""
+        version = self.fresh_version(db.name)
+        if version is None:
+            doc = await self.versions_collection(db).find_one({'_id': DATA_VERSION_ID})
+            version = self.set_version(db.name, doc['version'] if doc else 0)
+        return version
+
+    def bump(self, db=None):
+        """Called after every write, makes all cached responses of the database stale"""
+        db = self.db if db is None else db
+        doc = self.versions_collection(db).find_one_and_update(
+            {'_id': DATA_VERSION_ID},
+            {'$inc': {'version': 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        self.set_version(db.name, doc['version'])
+
+    def get(self, key, version):
+        """Return (body, mimetype) of a cached response, or None"""
+        versioned_key = f'{version}:{key}'
+        with self.lock:
+            entry = self.entries.get(versioned_key)
+            if entry is not None:
+                expires_at, body, mimetype = entry
+                if expires_at > time.monotonic():
+                    self.entries.move_to_end(versioned_key)
+                    self.stats['hits'] += 1
+                    return body, mimetype
+                self.discard(versioned_key)
+
+        if self.shared is not None:
+            value = self.shared.get(self.shared_prefix + versioned_key)
+            if value is not None:
+                mimetype, body = value.split(b'\n', 1)
+                self.store_local(versioned_key, body, mimetype.decode())
+                with self.lock:
+                    self.stats['hits'] += 1
+                return body, mimetype.decode()
+
+        with self.lock:
+            self.stats['misses'] += 1
+        return None
+
+    def put(self, key, version, body, mimetype):
+        if len(body) > CACHE_MAX_ENTRY_BYTES:
+            return
+        versioned_key = f'{version}:{key}'
+        self.store_local(versioned_key, body, mimetype)
+        if self.shared is not None:
+            self.shared.set(self.shared_prefix + versioned_key, mimetype.encode() + b'\n' + body,
+                            ex=max(1, int(CACHE_TTL_SECONDS)))
+
+    def store_local(self, versioned_key, body, mimetype):
+        with self.lock:
+            self.discard(versioned_key)
+            self.entries[versioned_key] = (time.monotonic() + CACHE_TTL_SECONDS, body, mimetype)
+            self.size += len(body)
+            while self.entries and (len(self.entries) > CACHE_MAX_ENTRIES or self.size > CACHE_MAX_BYTES):
+                self.discard(next(iter(self.entries)))
+
+    def discard(self, versioned_key):
+        # Caller holds the lock
+        entry = self.entries.pop(versioned_key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def not_modified(self):
+        with self.lock:
+            self.stats['not_modified'] += 1
+
+    def cached(self, view):
+        """Decorator for Flask GET views: serves 304s and cached bodies, stores 200 responses"""
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if not self.enabled:
+                return view(*args, **kwargs)
+
+            key = self.key(request.path, request.args.items(multi=True))
+            version = self.current_version()
+            etag = make_etag(key, version)
+            if request.if_none_match.contains(etag):
+                self.not_modified()
+                response = Response(status=304)
+            else:
+                entry = self.get(key, version)
+                if entry is not None:
+                    response = Response(entry[0], mimetype=entry[1])
+                else:
+                    response = make_response(view(*args, **kwargs))
+                    if response.status_code != 200:
+                        return response
+                    if not response.is_streamed:
+                        self.put(key, version, response.get_data(), response.mimetype)
+
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+
+        return wrapper
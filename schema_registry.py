@@ -0,0 +1,192 @@
+"""
+Cached schema of the sales collection.
+
+The schema is inferred over the whole collection (or a $sample of
+SCHEMA_SAMPLE_SIZE documents) by an aggregation that unwinds every document
+with $objectToArray, so heterogeneous data is described correctly: every
+field path is listed with the number of documents that have it and the types
+seen for it. Nested objects are expanded into dotted paths down to
+SCHEMA_MAX_DEPTH levels, one $project and $unwind per level.
+
+The result is stored in the schema registry collection, so every app process
+shares it and a lookup is a single find_one by _id. Writes call invalidate,
+which bumps the version; a computation only saves its result if the version
+did not change while it ran.
+"""
+import os
+from datetime import datetime
+
+SCHEMA_REGISTRY_COLLECTION = 'schema_registry'
+
+# Infer the schema from a random sample of this many documents, 0 uses all of them
+SCHEMA_SAMPLE_SIZE = int(os.environ.get('SCHEMA_SAMPLE_SIZE', 0))
+# Nested objects are expanded into dotted paths up to this many levels (a.b.c
+# is 3), deeper objects are listed as one object field. Field mappings accept
+# paths up to the same depth.
+SCHEMA_MAX_DEPTH = int(os.environ.get('SCHEMA_MAX_DEPTH', 5))
+# Field positions per level in the ordering key, it stays exact up to a depth of 5
+ORDER_BASE = 1000
+
+# BSON type names reported by $type, mapped to the names used by upload previews
+TYPE_NAMES = {
+    'double': 'number',
+    'int': 'number',
+    'long': 'number',
+    'decimal': 'number',
+    'bool': 'bool',
+    'string': 'string',
+    'null': 'null',
+    'missing': 'null',
+    'array': 'array',
+    'object': 'object',
+    'date': 'datetime',
+    'objectId': 'ObjectId'
+}
+
+
+def registry_collection(db):
+    return db[SCHEMA_REGISTRY_COLLECTION]
+
+
+def expand_objects(weight):
+    """
+    Stages replacing every {k, v} whose value is a non-empty object with its
+    dotted fields, one level deeper. Other values pass through unchanged.
+    """
+    expanded = {'$eq': [{'$type': '$entries'}, 'object']}
+    return [
+        {'$project': {'k': 1, 'v': 1, 'order': 1, 'entries': {'$cond': [
+            {'$eq': [{'$type': '$v'}, 'object']},
+            {'$map': {
+                'input': {'$objectToArray': '$v'},
+                'as': 'entry',
+                'in': {'k': {'$concat': ['$k', '.', '$$entry.k']}, 'v': '$$entry.v'}
+            }},
+            None
+        ]}}},
+        {'$unwind': {'path': '$entries', 'includeArrayIndex': 'index', 'preserveNullAndEmptyArrays': True}},
+        {'$project': {
+            'k': {'$cond': [expanded, '$entries.k', '$k']},
+            'v': {'$cond': [expanded, '$entries.v', '$v']},
+            'order': {'$add': ['$order', {'$multiply': [{'$ifNull': ['$index', 0]}, weight]}]}
+        }}
+    ]
+
+
+def schema_pipeline(sample_size=SCHEMA_SAMPLE_SIZE, max_depth=SCHEMA_MAX_DEPTH):
+    pipeline = [{'$sample': {'size': sample_size}}] if sample_size else []
+    # Fields are listed in order of first appearance, each level gets its own digits of order
+    pipeline += [
+        {'$project': {'_id': 0, 'fields': {'$objectToArray': '$$ROOT'}}},
+        {'$unwind': {'path': '$fields', 'includeArrayIndex': 'position'}},
+        {'$match': {'fields.k': {'$ne': '_id'}}},
+        {'$project': {'k': '$fields.k', 'v': '$fields.v',
+                      'order': {'$multiply': ['$position', ORDER_BASE ** (max_depth - 1)]}}}
+    ]
+    for level in range(1, max_depth):
+        pipeline += expand_objects(ORDER_BASE ** (max_depth - 1 - level))
+    pipeline += [
+        {'$group': {
+            '_id': {'field': '$k', 'type': {'$type': '$v'}},
+            'count': {'$sum': 1},
+            'order': {'$min': '$order'}
+        }},
+        {'$group': {
+            '_id': '$_id.field',
+            'count': {'$sum': '$count'},
+            'types': {'$push': '$_id.type'},
+            'order': {'$min': '$order'}
+        }},
+        {'$sort': {'order': 1, '_id': 1}}
+    ]
+    return pipeline
+
+
+def field_entry(entry, document_count):
+    return {
+        'field': entry['_id'],
+        'count': entry['count'],
+        'frequency': round(entry['count'] / document_count, 4) if document_count else 0,
+        'types': sorted({TYPE_NAMES.get(type_name, type_name) for type_name in entry['types']})
+    }
+
+
+def schema_entry(sales_collection, version, fields, document_count):
+    return {
+        '_id': sales_collection.name,
+        'version': version,
+        'fields': fields,
+        'document_count': document_count,
+        'computed_at': datetime.now()
+    }
+
+
+def save_query(sales_collection, cached, entry):
+    """(filter, update, upsert) that stores entry unless a write invalidated it in the meantime"""
+    if cached:
+        return {'_id': sales_collection.name, 'version': entry['version']}, {'$set': entry}, False
+    return {'_id': sales_collection.name}, {'$setOnInsert': entry}, True
+
+
+def compute_schema(sales_collection, sample_size=SCHEMA_SAMPLE_SIZE):
+    """Run the schema aggregation and return (fields, document_count)"""
+    document_count = sales_collection.estimated_document_count()
+    if sample_size:
+        document_count = min(document_count, sample_size)
+    fields = [field_entry(entry, document_count)
+              for entry in sales_collection.aggregate(schema_pipeline(sample_size), allowDiskUse=True)]
+    return fields, document_count
+
+
+def get_schema(db, sales_collection):
+    """Return the cached schema entry of sales, computing it on the first lookup after a write"""
+    registry = registry_collection(db)
+    cached = registry.find_one({'_id': sales_collection.name})
+    if cached and cached.get('fields') is not None:
+        return cached
+
+    fields, document_count = compute_schema(sales_collection)
+    entry = schema_entry(sales_collection, cached['version'] if cached else 0, fields, document_count)
+    query, update, upsert = save_query(sales_collection, cached, entry)
+    registry.update_one(query, update, upsert=upsert)
+    return entry
+
+
+async def compute_schema_async(sales_collection, sample_size=SCHEMA_SAMPLE_SIZE):
+    """compute_schema for an AsyncMongoClient collection"""
+    document_count = await sales_collection.estimated_document_count()
+    if sample_size:
+        document_count = min(document_count, sample_size)
+    cursor = await sales_collection.aggregate(schema_pipeline(sample_size), allowDiskUse=True)
+    fields = [field_entry(entry, document_count) async for entry in cursor]
+    return fields, document_count
+
+
+async def get_schema_async(db, sales_collection):
+    """get_schema for an AsyncMongoClient database, shares the same registry"""
+    registry = registry_collection(db)
+    cached = await registry.find_one({'_id': sales_collection.name})
+    if cached and cached.get('fields') is not None:
+        return cached
+
+    fields, document_count = await compute_schema_async(sales_collection)
+    entry = schema_entry(sales_collection, cached['version'] if cached else 0, fields, document_count)
+    query, update, upsert = save_query(sales_collection, cached, entry)
+    await registry.update_one(query, update, upsert=upsert)
+    return entry
+
+
+def invalidate(db, sales_collection):
+    registry_collection(db).update_one(
+        {'_id': sales_collection.name},
+        {'$inc': {'version': 1}, '$set': {'fields': None}},
+        upsert=True
+    )
+
+
+def field_names(schema):
+    return [entry['field'] for entry in schema['fields']]
+
+
+def top_level_fields(schema):
+    return {entry['field'].split('.', 1)[0] for entry in schema['fields']}
@@ -0,0 +1,132 @@
+"""
+Server-side staging of parsed uploads.
+
+A staged preview writes the parsed records into the staging collection in
+batches and returns a handle, the inferred schema and a small sample. The
+merge endpoint reads the records back by handle, so the full dataset does not
+have to travel to the client and back. Staged uploads expire after
+STAGING_TTL_SECONDS.
+"""
+import os
+import uuid
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING
+
+from ingestion import iter_batches
+from schema_registry import SCHEMA_MAX_DEPTH
+
+STAGING_COLLECTION = 'upload_staging'
+STAGED_UPLOADS_COLLECTION = 'staged_uploads'
+
+# How long a staged upload is kept if it is never merged
+STAGING_TTL_SECONDS = int(os.environ.get('STAGING_TTL_SECONDS', 24 * 3600))
+# Number of rows returned with a staged preview
+PREVIEW_SAMPLE_SIZE = int(os.environ.get('PREVIEW_SAMPLE_SIZE', 100))
+STAGING_BATCH_SIZE = int(os.environ.get('STAGING_BATCH_SIZE', 1000))
+
+_initialized_databases = set()
+
+
+def ensure_staging_indexes(db):
+    if db.name in _initialized_databases:
+        return
+    rows = db[STAGING_COLLECTION]
+    rows.create_index([('staging_id', ASCENDING), ('n', ASCENDING)])
+    rows.create_index([('created_at', ASCENDING)], expireAfterSeconds=STAGING_TTL_SECONDS)
+    db[STAGED_UPLOADS_COLLECTION].create_index([('expires_at', ASCENDING)], expireAfterSeconds=0)
+    _initialized_databases.add(db.name)
+
+
+def type_name(value):
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, (int, float)):
+        return 'number'
+    if isinstance(value, str):
+        return 'string'
+    if isinstance(value, list):
+        return 'array'
+    if isinstance(value, dict):
+        return 'object'
+    return type(value).__name__
+
+
+def collect_schema(record, schema, prefix='', depth=1):
+    """Count every (nested) field path and the types seen for it, down to SCHEMA_MAX_DEPTH levels"""
+    for key, value in record.items():
+        if key == '_id':
+            continue
+        path = f'{prefix}{key}'
+        if isinstance(value, dict) and value and depth < SCHEMA_MAX_DEPTH:
+            collect_schema(value, schema, f'{path}.', depth + 1)
+            continue
+        entry = schema.get(path)
+        if entry is None:
+            entry = schema[path] = {'count': 0, 'types': set()}
+        entry['count'] += 1
+        entry['types'].add(type_name(value))
+
+
+def stage_records(db, records, filename, coercion_errors=None, sample_size=PREVIEW_SAMPLE_SIZE):
+    """
+    Write records (any iterable) to the staging collection in batches while
+    inferring the schema. Returns the staged upload summary with a sample of
+    the first sample_size records.
+    """
+    ensure_staging_indexes(db)
+    rows = db[STAGING_COLLECTION]
+    staging_id = uuid.uuid4().hex
+    created_at = datetime.now()
+
+    schema = {}
+    sample = []
+    count = 0
+    for batch in iter_batches(records, STAGING_BATCH_SIZE):
+        documents = []
+        for record in batch:
+            collect_schema(record, schema)
+            if len(sample) < sample_size:
+                sample.append(dict(record))
+            documents.append({'staging_id': staging_id, 'n': count, 'created_at': created_at, 'record': record})
+            count += 1
+        rows.insert_many(documents, ordered=False)
+
+    summary = {
+        'staging_id': staging_id,
+        'filename': filename,
+        'record_count': count,
+        'schema': [
+            {'field': field, 'count': entry['count'], 'types': sorted(entry['types'])}
+            for field, entry in schema.items()
+        ],
+        'coercion_errors': coercion_errors or {},
+        'created_at': created_at,
+        'expires_at': created_at + timedelta(seconds=STAGING_TTL_SECONDS)
+    }
+    db[STAGED_UPLOADS_COLLECTION].insert_one({'_id': staging_id, **summary})
+    summary.pop('_id', None)
+    summary['sample'] = sample
+    return summary
+
+
+def get_staged_upload(db, staging_id):
+    """The staged upload summary, None when it is unknown or expired but not yet removed by the TTL monitor"""
+    return db[STAGED_UPLOADS_COLLECTION].find_one({'_id': staging_id, 'expires_at': {'$gt': datetime.now()}},
+                                                  {'_id': 0})
+
+
+def iter_staged_records(db, staging_id, batch_size=STAGING_BATCH_SIZE):
+    """Yield the staged records in their original order"""
+    cursor = (db[STAGING_COLLECTION]
+              .find({'staging_id': staging_id}, {'_id': 0, 'record': 1}, batch_size=batch_size)
+              .sort('n', ASCENDING))
+    for row in cursor:
+        yield row['record']
+
+
+def drop_staged_upload(db, staging_id):
+    db[STAGING_COLLECTION].delete_many({'staging_id': staging_id})
+    db[STAGED_UPLOADS_COLLECTION].delete_one({'_id': staging_id})
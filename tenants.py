@@ -0,0 +1,88 @@
+"""
+Tenant partitioning.
+
+Every tenant gets a database of its own, so sales, analytics, backups,
+staged uploads, the schema registry and the cache version all live apart.
+Whole-collection work (replace merges, backups, restores, analytics rebuilds,
+clearing the database) then only touches the data of the tenant it runs for,
+and its cost grows with that tenant's data instead of the total.
+
+Requests name their tenant in the TENANT_HEADER header or the tenant query
+parameter. Without one they use DEFAULT_TENANT, which maps to the database
+of MONGO_URI, so data from before partitioning stays where it is; with
+TENANT_REQUIRED set they are rejected instead. Any other tenant uses the
+database '<TENANT_DB_PREFIX>_<tenant>', the prefix defaults to the name of
+the MONGO_URI database. Tenant ids are case-insensitive and lowercased,
+since MongoDB refuses database names that differ only by case (Acme and acme
+are the same tenant). The current tenant is kept in a context variable;
+background jobs store it in their params and run with it set again.
+"""
+import contextvars
+import os
+import re
+from contextlib import contextmanager
+
+TENANT_HEADER = os.environ.get('TENANT_HEADER', 'X-Tenant-ID')
+DEFAULT_TENANT = os.environ.get('DEFAULT_TENANT', 'default').lower()
+TENANT_REQUIRED = os.environ.get('TENANT_REQUIRED', '').lower() in ('1', 'true', 'yes')
+TENANT_DB_PREFIX = os.environ.get('TENANT_DB_PREFIX')
+
+# Short enough to keep database names under MongoDB's 63 character limit
+TENANT_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,32}$')
+
+_tenant = contextvars.ContextVar('tenant', default=DEFAULT_TENANT)
+
+
+def current_tenant():
+    return _tenant.get()
+
+
+def set_tenant(tenant):
+    """Make tenant the current one, returns the token for reset_tenant"""
+    return _tenant.set(tenant or DEFAULT_TENANT)
+
+
+def reset_tenant(token):
+    _tenant.reset(token)
+
+
+@contextmanager
+def use_tenant(tenant):
+    token = set_tenant(tenant)
+    try:
+        yield
+    finally:
+        reset_tenant(token)
+
+
+def parse_tenant(headers, args):
+    """Tenant of a request from its header or query parameter. Raises ValueError with the message for the client."""
+    tenant = headers.get(TENANT_HEADER) or args.get('tenant')
+    if not tenant:
+        if TENANT_REQUIRED:
+            raise ValueError(f'Missing tenant, set the {TENANT_HEADER} header or the tenant parameter')
+        return DEFAULT_TENANT
+    if not TENANT_ID_PATTERN.match(tenant):
+        raise ValueError(f'Invalid tenant: {tenant}, use up to 32 letters, digits, _ or -')
+    return tenant.lower()
+
+
+def database_name(base_name, tenant=None):
+    tenant = (current_tenant() if tenant is None else tenant).lower()
+    if tenant == DEFAULT_TENANT:
+        return base_name
+    return f'{TENANT_DB_PREFIX or base_name}_{tenant}'
+
+
+def tenant_database(base_db, tenant=None):
+    """The database of a tenant, on the same client as base_db (the MONGO_URI database)"""
+    name = database_name(base_db.name, tenant)
+    return base_db if name == base_db.name else base_db.client[name]
+
+
+def job_filter(tenant=None):
+    """Query matching the jobs of a tenant, jobs from before partitioning belong to the default tenant"""
+    tenant = current_tenant() if tenant is None else tenant
+    if tenant == DEFAULT_TENANT:
+        return {'params.tenant': {'$in': [DEFAULT_TENANT, None]}}
+    return {'params.tenant': tenant}
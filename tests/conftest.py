@@ -0,0 +1,49 @@
+"""
+Shared fixtures. The app runs against mongomock, the same way
+benchmarks/bench_app.py drives it, so no MongoDB server is needed:
+
+    pip install pytest mongomock
+    python -m pytest tests
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+# main connects lazily, the URI only has to parse
+os.environ.setdefault('MONGO_URI', 'mongodb://127.0.0.1:1/test?serverSelectionTimeoutMS=200')
+
+
+@pytest.fixture
+def app_db(monkeypatch):
+    """The main module wired to a fresh mongomock database, returns (main, db)"""
+    import mongomock
+
+    import bench_app
+    import main
+
+    monkeypatch.setattr(mongomock.collection.Collection, 'aggregate', mongomock.collection.Collection.aggregate)
+    bench_app.emulate_merge_stage()
+    bench_app.emulate_missing_expressions()
+    # mongomock clients share their data, start from an empty server
+    client = mongomock.MongoClient()
+    for name in client.list_database_names():
+        client.drop_database(name)
+    db = client.test
+
+    class Mongo:
+        pass
+    mongo = Mongo()
+    mongo.db = db
+    monkeypatch.setattr(main, 'mongo', mongo)
+    monkeypatch.setattr(main.job_queue, 'tasks', db.tasks)
+    monkeypatch.setattr(main.job_queue, 'recovered', True)
+    # Cached responses and versions of the previous test's databases
+    monkeypatch.setattr(main.sales_cache, 'entries', type(main.sales_cache.entries)())
+    monkeypatch.setattr(main.sales_cache, 'size', 0)
+    monkeypatch.setattr(main.sales_cache, 'versions', {})
+    return main, db
@@ -0,0 +1,51 @@
+"""Rollups for documents without some dimension fields, and restores whose rebuild fails"""
+import analytics
+import backups
+
+
+def rollup_rows(collection):
+    return sorted((row['dimension'], str(row['value']), row['sales_amount'], row['units_sold'], row['count'])
+                  for row in collection.find())
+
+
+SALES = [
+    {'product': 'Widget', 'sales_amount': 10.0, 'units_sold': 1, 'date': '2024-01-02',
+     'customer': {'location': 'Austin', 'gender': 'F'}},
+    # A CSV upload without these columns nests them as None
+    {'product': None, 'sales_amount': 5.0, 'units_sold': 2, 'customer': {'location': None, 'gender': None}},
+    {'sales_amount': 1.0, 'units_sold': 3, 'date': ''}
+]
+
+
+def test_missing_dimensions_match_between_delta_and_rebuild(app_db):
+    main, db = app_db
+    db.sales.insert_many([dict(sale) for sale in SALES])
+
+    delta = analytics.RollupDelta()
+    delta.add_all(SALES)
+    delta.apply(db.delta_rollups)
+    analytics.rebuild_rollups(db.sales, db.analytics)
+
+    assert rollup_rows(db.analytics) == rollup_rows(db.delta_rollups)
+    assert db.analytics.count_documents({'value': None}) == 0
+    missing = db.analytics.find_one({'dimension': 'product', 'value': analytics.MISSING_VALUE})
+    assert (missing['count'], missing['units_sold']) == (2, 5)
+    assert db.analytics.find_one({'dimension': 'day', 'value': analytics.MISSING_VALUE})['count'] == 2
+
+
+def test_restore_survives_a_failed_rebuild(app_db, monkeypatch):
+    main, db = app_db
+    client = main.app.test_client()
+    db.sales.insert_many([dict(sale) for sale in SALES])
+    backup_name = backups.create_backup(db, db.sales)
+    db.sales.delete_many({})
+    version = main.sales_cache.current_version()
+
+    def fail(*args):
+        raise RuntimeError('rebuild failed')
+    monkeypatch.setattr(analytics, 'rebuild_rollups', fail)
+
+    response = client.post('/api/restore-backup', json={'backup_name': backup_name})
+    assert response.status_code == 200
+    assert db.sales.count_documents({}) == len(SALES)
+    assert main.sales_cache.current_version() != version
@@ -0,0 +1,70 @@
+"""Restoring delta backup points from their snapshot and changesets"""
+import backups
+
+
+def snapshot(collection):
+    return sorted((str(doc['_id']), doc['sku'], doc['units_sold']) for doc in collection.find())
+
+
+def merge(db, changes=(), inserts=(), deletes=()):
+    """Take a backup point, write like a merge does and record the changeset"""
+    name = backups.create_backup(db, db.sales)
+    changed_ids = []
+    for sku, units_sold in changes:
+        doc = db.sales.find_one_and_update({'sku': sku}, {'$set': {'units_sold': units_sold}})
+        changed_ids.append(doc['_id'])
+    for sku, units_sold in inserts:
+        changed_ids.append(db.sales.insert_one({'sku': sku, 'units_sold': units_sold}).inserted_id)
+    deleted_ids = [db.sales.find_one_and_delete({'sku': sku})['_id'] for sku in deletes]
+    backups.record_changeset(db, db.sales, name, changed_ids, deleted_ids)
+    return name
+
+
+def test_restore_delta_chain(app_db):
+    main, db = app_db
+    db.sales.insert_many([{'sku': 'A', 'units_sold': 1}, {'sku': 'B', 'units_sold': 2}])
+    db.sales.create_index('sku', name='sku_1')
+
+    states = {}
+    steps = [{'changes': [('A', 5)], 'inserts': [('C', 3)]},
+             {'deletes': ['B'], 'inserts': [('D', 4)]},
+             {'changes': [('C', 9), ('A', 6)], 'deletes': ['D']}]
+    for step in steps:
+        state = snapshot(db.sales)
+        states[merge(db, **step)] = state
+
+    metadata = {entry['name']: entry for entry in backups.list_backups(db)}
+    assert [metadata[name]['type'] for name in states] == ['full', 'delta', 'delta']
+
+    client = main.app.test_client()
+    for name, state in reversed(list(states.items())):
+        response = client.post('/api/restore-backup', json={'backup_name': name})
+        assert response.status_code == 200
+        assert snapshot(db.sales) == state
+        if metadata[name]['type'] == 'delta':
+            # The rebuilt collection is renamed over sales, with the sales indexes copied over
+            assert 'sku_1' in db.sales.index_information()
+    # Restores close the chain, so the next backup point is a full snapshot again
+    assert backups.list_backups(db)[0]['type'] == 'delta'
+    assert backups.metadata_collection(db).find_one({'name': merge(db)})['type'] == 'full'
+
+
+def test_backup_after_an_unrecorded_merge_is_full(app_db):
+    main, db = app_db
+    db.sales.insert_many([{'sku': 'A', 'units_sold': 1}])
+    merge(db, changes=[('A', 2)])
+    # A merge that failed before recording its changeset
+    backups.create_backup(db, db.sales)
+    db.sales.update_one({'sku': 'A'}, {'$set': {'units_sold': 3}})
+    later = merge(db, changes=[('A', 4)])
+
+    assert backups.metadata_collection(db).find_one({'name': later})['type'] == 'full'
+    response = main.app.test_client().post('/api/restore-backup', json={'backup_name': later})
+    assert response.status_code == 200
+    assert snapshot(db.sales)[0][1:] == ('A', 3)
+
+
+def test_unknown_backup(app_db):
+    main, db = app_db
+    response = main.app.test_client().post('/api/restore-backup', json={'backup_name': 'sales_backup_missing'})
+    assert response.status_code == 404
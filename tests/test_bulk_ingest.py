@@ -0,0 +1,93 @@
+"""Bulk ingestion through /api/sales/bulk and bulk_ingest.insert_in_batches"""
+import json
+import threading
+import time
+
+import pytest
+
+import analytics
+import bulk_ingest
+
+
+@pytest.fixture
+def client(app_db):
+    main, db = app_db
+    db.sales.create_index('order_id', unique=True)
+    analytics.rebuild_rollups(db.sales, db.analytics)
+    return main.app.test_client()
+
+
+def test_json_array(client, app_db):
+    main, db = app_db
+    data = [{'order_id': i, 'units_sold': 1} for i in range(7)] + [{'order_id': 3}, 'not an object']
+    response = client.post('/api/sales/bulk?batch_size=3', json=data)
+    assert response.status_code == 207
+    body = response.get_json()
+    assert (body['inserted_count'], body['failed_count'], body['batch_count']) == (7, 2, 3)
+    # The duplicate is reported by its position among the accepted documents
+    assert [error['index'] for batch in body['errors'] for error in batch['errors']] == [7]
+    assert body['parse_errors'] == [{'index': 8, 'message': 'Expected a JSON object'}]
+    assert db.sales.count_documents({}) == 7
+    assert db.analytics.find_one({'dimension': 'total'})['units_sold'] == 7
+
+
+def test_ndjson_stream(client, app_db):
+    main, db = app_db
+    lines = [json.dumps({'order_id': i}) for i in range(5)]
+    lines.insert(2, '{not json')
+    response = client.post('/api/sales/bulk', data='\n'.join(lines) + '\n', content_type='application/x-ndjson')
+    assert response.status_code == 207
+    body = response.get_json()
+    assert (body['inserted_count'], body['parse_error_count']) == (5, 1)
+    assert body['parse_errors'][0]['line'] == 3
+
+
+@pytest.mark.parametrize('query', ['batch_size=0', 'batch_size=100000'])
+def test_invalid_batch_size(client, query):
+    assert client.post(f'/api/sales/bulk?{query}', json=[{'order_id': 1}]).status_code == 400
+
+
+def test_invalid_body(client):
+    assert client.post('/api/sales/bulk', json={'order_id': 1}).status_code == 400
+
+
+class SlowCollection:
+    """Records how many insert_many calls run at the same time"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+        self.inserted = []
+
+    def insert_many(self, batch, ordered):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.01)
+        with self.lock:
+            self.running -= 1
+            self.inserted.extend(batch)
+
+        class Result:
+            inserted_ids = list(range(len(batch)))
+        return Result()
+
+
+def test_bounded_in_flight():
+    collection = SlowCollection()
+    read = []
+
+    def records():
+        for i in range(100):
+            read.append(i)
+            # The producer never runs more than max_in_flight batches ahead of the writes
+            assert len(read) - len(collection.inserted) <= 4 * 10 + 10
+            yield {'order_id': i}
+
+    batches = []
+    summary = bulk_ingest.insert_in_batches(collection, records(), batch_size=10, max_in_flight=4,
+                                            on_batch=lambda batch, failed: batches.append(batch[0]['order_id']))
+    assert summary['inserted_count'] == 100
+    assert 1 < collection.max_running <= 4
+    # on_batch is called in order
+    assert batches == list(range(0, 100, 10))
@@ -0,0 +1,100 @@
+"""Export and import round trips of the sales collection"""
+import io
+from datetime import datetime
+
+import bson
+import pyarrow.parquet as pq
+import pytest
+from bson.objectid import ObjectId
+from bson.raw_bson import RawBSONDocument
+
+import dumps
+
+SALES = [
+    {'_id': ObjectId(), 'transaction_id': 'T1', 'sales_amount': 12.5, 'units_sold': 3,
+     'date': datetime(2024, 1, 2, 3, 4, 5), 'customer': {'location': 'Austin', 'gender': 'F'}, 'tags': ['a', 'b']},
+    {'_id': ObjectId(), 'transaction_id': 'T2', 'sales_amount': 7.0, 'units_sold': 1,
+     'date': datetime(2024, 2, 3), 'customer': {'location': 'Boston'}, 'tags': []},
+    {'_id': ObjectId(), 'transaction_id': 'T3', 'sales_amount': 1.25, 'units_sold': 2,
+     'date': datetime(2024, 3, 4), 'customer': {'location': 'Chicago', 'gender': 'M'}, 'tags': ['c']},
+]
+
+
+def raw_cursor(collection, query=None, projection=None, batch_size=None):
+    # mongomock has no RawBSONDocument cursors, encode the decoded documents instead
+    return (RawBSONDocument(bson.encode(doc)) for doc in collection.find(query or {}, projection))
+
+
+@pytest.fixture
+def client(app_db, monkeypatch):
+    main, db = app_db
+    monkeypatch.setattr(dumps, 'raw_cursor', raw_cursor)
+    db.sales.insert_many([dict(sale) for sale in SALES])
+    return main.app.test_client()
+
+
+def export(client, dump_format, query=''):
+    response = client.get(f'/api/sales/export?format={dump_format}{query}')
+    assert response.status_code == 200
+    assert response.mimetype == dumps.FORMATS[dump_format]
+    return response.data
+
+
+def reimport(client, db, data, filename):
+    db.sales.delete_many({})
+    response = client.post('/api/sales/import?batch_size=2', content_type='multipart/form-data',
+                           data={'file': (io.BytesIO(data), filename)})
+    assert response.status_code == 200, response.get_json()
+    return sorted(db.sales.find(), key=lambda doc: doc['transaction_id'])
+
+
+@pytest.mark.parametrize('dump_format', ['ndjson.gz', 'bson', 'bson.gz'])
+def test_round_trip(client, app_db, dump_format):
+    main, db = app_db
+    data = export(client, dump_format)
+    assert reimport(client, db, data, f'sales.{dump_format}') == SALES
+
+
+def test_parquet_round_trip(client, app_db):
+    main, db = app_db
+    data = export(client, 'parquet')
+    assert data[:4] == b'PAR1'
+    assert reimport(client, db, data, 'sales.parquet') == SALES
+
+
+def test_parquet_row_groups(client, app_db):
+    main, db = app_db
+    # One row group per batch, read back a batch at a time
+    data = b''.join(dumps.export_chunks(db.sales, 'parquet', batch_size=2))
+    assert pq.ParquetFile(io.BytesIO(data)).num_row_groups == 2
+    restored = list(dumps.iter_parquet_records(io.BytesIO(data), batch_size=2))
+    assert sorted(restored, key=lambda doc: doc['transaction_id']) == SALES
+
+
+def test_parquet_mixed_types_become_strings(client, app_db):
+    main, db = app_db
+    db.sales.update_one({'transaction_id': 'T2'}, {'$set': {'units_sold': 'one'}})
+    restored = reimport(client, db, export(client, 'parquet'), 'sales.parquet')
+    assert [doc['units_sold'] for doc in restored] == ['3', 'one', '2']
+
+
+def test_filtered_export(client, app_db):
+    main, db = app_db
+    data = export(client, 'ndjson.gz', '&customer.location=Austin&fields=transaction_id')
+    assert [(doc['_id'], doc['transaction_id']) for doc in reimport(client, db, data, 'sales.ndjson.gz')] == \
+        [(SALES[0]['_id'], 'T1')]
+
+
+def test_corrupt_ndjson_line(client, app_db):
+    main, db = app_db
+    data = dumps.gzip_chunks(iter([b'{"transaction_id": "T9"}\n', b'{not json\n']))
+    response = client.post('/api/sales/import?format=ndjson.gz', data=b''.join(data))
+    assert response.status_code == 207
+    assert (response.get_json()['inserted_count'], response.get_json()['parse_error_count']) == (1, 1)
+
+
+def test_unknown_format(client):
+    assert client.get('/api/sales/export?format=csv').status_code == 400
+    response = client.post('/api/sales/import', content_type='multipart/form-data',
+                           data={'file': (io.BytesIO(b'x'), 'sales.csv')})
+    assert response.status_code == 400
@@ -0,0 +1,22 @@
+"""FieldMapping with dotted sources, as listed by the staged upload schema"""
+from field_mapping import FieldMapping
+
+MAPPINGS = [{'existing': 'location', 'new': 'customer.location'},
+            {'existing': 'tier', 'new': 'customer.tier', 'default': 'basic'},
+            {'existing': 'amount', 'new': 'amount', 'type': 'int'}]
+
+
+def test_dotted_source_rows():
+    rows = [{'customer': {'location': 'NY', 'tier': 'gold'}, 'amount': '3'},
+            {'customer.location': 'LA', 'amount': '4'},
+            {'customer': 'not an object'}]
+    assert list(FieldMapping(MAPPINGS).transform_records(rows)) == [
+        {'location': 'NY', 'tier': 'gold', 'amount': 3},
+        {'location': 'LA', 'tier': 'basic', 'amount': 4}]
+
+
+def test_dotted_source_columns():
+    columns = {'customer': [{'location': 'NY', 'tier': 'gold'}, {'location': 'LA'}], 'amount': ['1', '2']}
+    assert FieldMapping(MAPPINGS).transform_columns(columns) == [
+        {'location': 'NY', 'tier': 'gold', 'amount': 1},
+        {'location': 'LA', 'tier': 'basic', 'amount': 2}]
@@ -0,0 +1,37 @@
+"""Matching indexes become unique once duplicate keys are gone"""
+import pytest
+
+import indexes
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    monkeypatch.setattr(indexes, '_ensured', {})
+    monkeypatch.setattr(indexes, '_retry_unique_at', {})
+
+
+def unique_indexes(collection):
+    return [info['key'] for info in collection.index_information().values() if info.get('unique')]
+
+
+def test_unique_index_after_duplicates_are_removed(app_db, monkeypatch):
+    main, db = app_db
+    db.sales.insert_many([{'transaction_id': 1}, {'transaction_id': 1}, {'transaction_id': 2}])
+    assert indexes.ensure_matching_index(db.sales, ['transaction_id']) is False
+    assert unique_indexes(db.sales) == []
+
+    db.sales.delete_one({'transaction_id': 1})
+    # Not checked again before the retry interval is over
+    assert indexes.ensure_matching_index(db.sales, ['transaction_id']) is False
+
+    monkeypatch.setattr(indexes, '_retry_unique_at', {})
+    assert indexes.ensure_matching_index(db.sales, ['transaction_id']) is True
+    assert unique_indexes(db.sales) == [[('transaction_id', 1)]]
+
+
+def test_plain_index_is_upgraded(app_db):
+    main, db = app_db
+    db.sales.create_index([('transaction_id', 1)])
+    db.sales.insert_many([{'transaction_id': 1}, {'transaction_id': 2}])
+    assert indexes.ensure_matching_index(db.sales, ['transaction_id']) is True
+    assert unique_indexes(db.sales) == [[('transaction_id', 1)]]
@@ -0,0 +1,48 @@
+"""Coercion rules shared by the columnar stage (CSV, Excel) and the per-record one (JSON, XML)"""
+import pandas as pd
+import pytest
+
+from ingestion import normalize_frame, normalize_records
+
+# (sales_amount, units_sold) as uploaded -> as stored
+CASES = [
+    (('12.5', '3'), (12.5, 3)),
+    (('', '  '), (0.0, 0)),           # blanks get the default
+    (('7', '2.5'), (7.0, None)),      # fractions in int columns fail
+    (('nan', 'nan'), (None, None)),   # a 'nan' string is not a number
+    (('abc', '4.0'), (None, 4)),
+]
+EXPECTED_ERRORS = {'sales_amount': 2, 'units_sold': 2}
+
+
+def test_records():
+    records = [{'sales_amount': amount, 'units_sold': units} for (amount, units), _ in CASES]
+    records.append({})  # missing fields get the default too
+    errors = normalize_records(records)
+    assert [(r['sales_amount'], r['units_sold']) for r in records] == [stored for _, stored in CASES] + [(0.0, 0)]
+    assert errors == EXPECTED_ERRORS
+
+
+def test_records_keep_non_string_values():
+    records = [{'sales_amount': 3, 'units_sold': 2.0}, {'sales_amount': None, 'units_sold': True},
+               {'sales_amount': {'a': 1}, 'units_sold': float('nan')}]
+    errors = normalize_records(records)
+    assert [(r['sales_amount'], r['units_sold']) for r in records] == [(3.0, 2), (0.0, 1), (None, 0)]
+    assert errors == {'sales_amount': 1, 'units_sold': 0}
+
+
+def test_frame_applies_the_same_rules():
+    frame = pd.DataFrame([{'sales_amount': amount, 'units_sold': units} for (amount, units), _ in CASES],
+                         dtype=object)
+    frame, errors = normalize_frame(frame)
+    stored = list(zip(frame['sales_amount'].astype(object).where(frame['sales_amount'].notna(), None),
+                      frame['units_sold'].astype(object).where(frame['units_sold'].notna(), None)))
+    assert stored == [stored_values for _, stored_values in CASES]
+    assert errors == EXPECTED_ERRORS
+
+
+@pytest.mark.parametrize('value', ['1e3', ' 5 ', '-0'])
+def test_number_strings(value):
+    records = [{'sales_amount': value, 'units_sold': value}]
+    assert normalize_records(records) == {'sales_amount': 0, 'units_sold': 0}
+    assert records[0] == {'sales_amount': float(value), 'units_sold': int(float(value))}
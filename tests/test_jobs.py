@@ -0,0 +1,83 @@
+"""JobQueue sweeps against mongomock"""
+import contextlib
+import threading
+import time
+from datetime import datetime, timedelta
+
+import mongomock
+
+import jobs
+
+
+class App:
+    def app_context(self):
+        return contextlib.nullcontext()
+
+
+def make_queue(workers=1):
+    queue = jobs.JobQueue(mongomock.MongoClient().db.tasks, App(), workers=workers)
+    queue.recovered = True
+    return queue
+
+
+def make_stale(queue, job_id):
+    old = datetime.now() - timedelta(seconds=jobs.JOB_STALE_SECONDS + 1)
+    queue.tasks.update_one({'_id': job_id}, {'$set': {'updated_at': old}})
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_sweep_leaves_jobs_waiting_in_our_executor():
+    queue = make_queue(workers=2)
+    events = {name: threading.Event() for name in ('a', 'b', 'job')}
+    started = []
+
+    def handler(job, progress):
+        started.append(job['params']['name'])
+        events[job['params']['name']].wait(5)
+        return {'ok': True}, 200
+    queue.register('wait', handler)
+
+    # Both executor threads are busy, so job waits in the executor queue
+    queue.submit('wait', {'name': 'a'})
+    queue.submit('wait', {'name': 'b'})
+    job_id = queue.submit('wait', {'name': 'job'})
+    wait_for(lambda: len(started) == 2)
+    make_stale(queue, job_id)
+    queue.sweep()
+
+    # job starts on the first free thread, a duplicate run would take the second one
+    events['a'].set()
+    wait_for(lambda: 'job' in started)
+    events['b'].set()
+    wait_for(lambda: queue.tasks.count_documents({'status': 'succeeded'}) == 2)
+    queue.sweep()
+    assert queue.tasks.find_one({'_id': job_id})['status'] == 'running'
+
+    events['job'].set()
+    queue.executor.shutdown(wait=True)
+    assert started.count('job') == 1
+    assert queue.tasks.find_one({'_id': job_id})['status'] == 'succeeded'
+
+
+def test_sweep_fails_jobs_of_dead_workers_and_resubmits_lost_queued_ones():
+    queue = make_queue()
+    queue.register('quick', lambda job, progress: ({'ok': True}, 200))
+    now = datetime.now()
+    queue.tasks.insert_many([
+        # Running on this host in a process that no longer exists
+        {'_id': 'dead', 'type': 'quick', 'status': 'running', 'worker_id': f'{queue.host}:999999999',
+         'heartbeat_at': now, 'updated_at': now},
+        # Queued by a process of this host that died before running it
+        {'_id': 'orphan', 'type': 'quick', 'status': 'queued', 'host': queue.host, 'params': {},
+         'updated_at': now - timedelta(seconds=jobs.JOB_STALE_SECONDS + 1)}
+    ])
+    queue.sweep()
+    queue.executor.shutdown(wait=True)
+    assert queue.tasks.find_one({'_id': 'dead'})['status'] == 'failed'
+    assert queue.tasks.find_one({'_id': 'orphan'})['status'] == 'succeeded'
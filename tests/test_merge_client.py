@@ -0,0 +1,147 @@
+"""merge_client and /api/upload against benchmarks/merge_stub_server.py"""
+import gzip
+import io
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import merge_client
+from merge_stub_server import make_handler
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    # The session is built from the module settings, start each test with a new one
+    monkeypatch.setattr(merge_client, 'MERGE_BACKOFF_SECONDS', 0.01)
+    monkeypatch.setattr(merge_client, '_session', None)
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    """Start a merge stub in a thread, returns start(fail_first=0) giving its URL"""
+    servers = []
+
+    def start(fail_first=0, matching_fields=('transaction_id',)):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(list(matching_fields), fail_first))
+        server.RequestHandlerClass.log_message = lambda *args: None
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        url = f'http://127.0.0.1:{server.server_port}/merge'
+        monkeypatch.setattr(merge_client, 'MERGE_SERVICE_URL', url)
+        return url
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def unused_url():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    return f'http://127.0.0.1:{port}/merge'
+
+
+LOCAL = [{'_id': '1', 'transaction_id': 1, 'amount': 10}]
+NEW = [{'transaction_id': 1, 'amount': 15}, {'transaction_id': 2, 'amount': 20}]
+
+
+def test_merge_round_trip(stub):
+    stub()
+    response = merge_client.request_merge(LOCAL, NEW, ['transaction_id'])
+    assert response.status_code == 200
+    merged = response.json()['merged_data']
+    assert sorted(doc['transaction_id'] for doc in merged) == [1, 2]
+
+
+def test_retries_after_503(stub):
+    stub(fail_first=2)
+    response = merge_client.request_merge(LOCAL, NEW, ['transaction_id'])
+    assert response.status_code == 200
+    assert len(response.json()['merged_data']) == 2
+
+
+def test_gives_up_after_the_retries(stub):
+    stub(fail_first=merge_client.MERGE_RETRIES + 1)
+    response = merge_client.request_merge(LOCAL, NEW, ['transaction_id'])
+    assert response.status_code == 503
+
+
+def test_gzip_body(stub):
+    stub()
+    response = merge_client.request_merge(LOCAL, NEW, ['transaction_id'], gzip_body=True)
+    assert response.request.headers['Content-Encoding'] == 'gzip'
+    assert response.status_code == 200
+    assert len(response.json()['merged_data']) == 2
+
+
+def test_encode_payload_gzip():
+    body, size = merge_client.encode_payload({'local_data': LOCAL, 'new_data': NEW}, gzip_body=True)
+    data = body.read()
+    assert len(data) == size
+    assert json.loads(gzip.decompress(data)) == {'local_data': LOCAL, 'new_data': NEW}
+
+
+def test_unreachable_service():
+    with pytest.raises(merge_client.MergeServiceError):
+        merge_client.request_merge(LOCAL, NEW, url=unused_url())
+
+
+def test_read_timeout_is_not_retried(monkeypatch):
+    requests_seen = []
+
+    class SlowHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            requests_seen.append(self.path)
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            time.sleep(0.5)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SlowHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(merge_client, 'MERGE_READ_TIMEOUT', 0.1)
+    try:
+        with pytest.raises(merge_client.MergeServiceError):
+            merge_client.request_merge(LOCAL, NEW, url=f'http://127.0.0.1:{server.server_port}/merge')
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert len(requests_seen) == 1
+
+
+def upload(client, records, **form):
+    data = {'file': (io.BytesIO(json.dumps(records).encode()), 'sales.json'), **form}
+    return client.post('/api/upload', data=data, content_type='multipart/form-data')
+
+
+def test_upload_unreachable_service_is_502(app_db, monkeypatch):
+    main, db = app_db
+    monkeypatch.setattr(merge_client, 'MERGE_SERVICE_URL', unused_url())
+    response = upload(main.app.test_client(), NEW)
+    assert response.status_code == 502
+    assert response.get_json()['message'].startswith('Merge failed')
+
+
+def test_upload_delta_mode(app_db, stub):
+    main, db = app_db
+    stub()
+    db.sales.insert_many([{'transaction_id': 1, 'amount': 10, 'region': 'north'},
+                          {'transaction_id': 3, 'amount': 30, 'region': 'south'}])
+    response = upload(main.app.test_client(), NEW, mode='delta', matching_fields='transaction_id')
+    assert response.status_code == 200, response.get_json()
+    result = response.get_json()
+    assert (result['inserted_count'], result['updated_count']) == (1, 1)
+
+    sales = {doc['transaction_id']: doc for doc in db.sales.find({}, {'_id': 0})}
+    # Updated in place without losing the fields the service never saw, nothing deleted
+    assert (sales[1]['amount'], sales[1]['region']) == (15, 'north')
+    assert sales[2]['amount'] == 20
+    assert sales[3]['amount'] == 30
+    assert result['backup_name']
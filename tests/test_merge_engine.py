@@ -0,0 +1,25 @@
+"""Hash-indexed merge engine against the pairwise scan in benchmarks/bench_merge.py"""
+import pytest
+
+from bench_merge import make_records, make_upload, merge_with_existing_data_scan
+from merge_engine import merge_with_existing_data
+
+
+@pytest.mark.parametrize('matching_fields', [['transaction_id'], ['transaction_id', 'customer.location'],
+                                             ['product'], ['customer']])
+def test_matches_pairwise_scan(matching_fields):
+    existing = make_records(300, seed=1)
+    upload = make_upload(existing, 200, seed=2)
+    assert merge_with_existing_data(existing, upload, matching_fields) == \
+        merge_with_existing_data_scan(existing, upload, matching_fields)
+
+
+def test_duplicate_and_missing_keys():
+    existing = [{'sku': 'A', 'n': 1}, {'sku': 'A', 'n': 2}, {'n': 3}, {'sku': None, 'n': 4},
+                {'sku': {'id': 1, 'v': [1, 2]}, 'n': 5}]
+    upload = [{'sku': 'A', 'm': 1}, {'sku': 'A', 'm': 2}, {'sku': 'A', 'm': 3}, {'m': 4},
+              {'sku': {'v': [1, 2], 'id': 1}, 'm': 5}, {'sku': 1.0, 'm': 6}]
+    merged = merge_with_existing_data(existing, upload, ['sku'])
+    assert merged == merge_with_existing_data_scan(existing, upload, ['sku'])
+    # First come, first served: both A records are matched in order, the third is new
+    assert merged[:3] == [{'sku': 'A', 'n': 1, 'm': 1}, {'sku': 'A', 'n': 2, 'm': 2}, {'sku': 'A', 'm': 3}]
@@ -0,0 +1,26 @@
+"""/api/process-merge-mappings payload validation"""
+import pytest
+
+MAPPINGS = {'mappings': [{'existing': 'product', 'new': 'name'}, {'existing': 'units_sold', 'new': 'qty', 'type': 'int'}]}
+
+
+@pytest.fixture
+def client(app_db):
+    main, db = app_db
+    return main.app.test_client()
+
+
+@pytest.mark.parametrize('new_data', ['Widget', 5, ['Widget'], [{'name': 'Widget'}, 3],
+                                      {'name': 'Widget'}, {'name': ['Widget'], 'qty': 3}])
+def test_invalid_new_data(client, new_data):
+    response = client.post('/api/process-merge-mappings', json={'new_data': new_data, 'field_mappings': MAPPINGS})
+    assert response.status_code == 400
+    assert response.get_json()['status'] == 'error'
+
+
+def test_columnar_new_data(client, app_db):
+    main, db = app_db
+    new_data = {'name': ['Widget', 'Gadget'], 'qty': ['3', '5']}
+    response = client.post('/api/process-merge-mappings', json={'new_data': new_data, 'field_mappings': MAPPINGS})
+    assert response.status_code == 200
+    assert sorted((d['product'], d['units_sold']) for d in db.sales.find()) == [('Gadget', 5), ('Widget', 3)]
@@ -0,0 +1,49 @@
+"""Parallel parsing gives the same records and coercion errors as parsing in the request process"""
+import io
+import json
+from itertools import chain
+
+import parallel_parse
+from ingestion import iter_csv_records, iter_ndjson_records, iter_normalized_records
+
+
+def make_csv(rows):
+    lines = ['transaction_id,product,sales_amount,units_sold,location,gender,note']
+    for i in range(rows):
+        amount = ['12.50', '', 'abc', '7'][i % 4]
+        units = ['3', '2.5', ' ', '4'][i % 4]
+        # Quoted fields with line breaks must stay in one chunk
+        note = f'"line one\nline two {i}"' if i % 5 == 0 else f'note {i}'
+        lines.append(f'T{i},Widget,{amount},{units},Austin,F,{note}')
+    return ('\n'.join(lines) + '\n').encode()
+
+
+def make_ndjson(rows):
+    return ''.join(json.dumps({'transaction_id': f'T{i}', 'sales_amount': ['1.5', None, 'x'][i % 3],
+                               'units_sold': [2, '3', 1.5][i % 3]}) + '\n' for i in range(rows)).encode()
+
+
+def parse_parallel(filename, content):
+    errors = {}
+    batches = parallel_parse.iter_parallel_batches(filename, io.BytesIO(content), errors, workers=2,
+                                                   chunk_bytes=2048)
+    return list(chain.from_iterable(batches)), errors
+
+
+def test_csv_matches_serial():
+    content = make_csv(500)
+    serial_errors = {}
+    serial = list(iter_csv_records(io.BytesIO(content), serial_errors))
+    records, errors = parse_parallel('sales.csv', content)
+    assert len(records) == 500
+    assert records == serial
+    assert errors == serial_errors
+
+
+def test_ndjson_matches_serial():
+    content = make_ndjson(500)
+    serial_errors = {}
+    serial = list(iter_normalized_records(iter_ndjson_records(io.BytesIO(content)), serial_errors))
+    records, errors = parse_parallel('sales.ndjson', content)
+    assert records == serial
+    assert errors == serial_errors
@@ -0,0 +1,66 @@
+"""ETags, 304s and invalidation of cached read responses"""
+import pytest
+
+import response_cache
+import tenants
+
+
+@pytest.fixture
+def client(app_db):
+    main, db = app_db
+    db.sales.insert_many([{'transaction_id': 'T1', 'units_sold': 1}, {'transaction_id': 'T2', 'units_sold': 2}])
+    return main.app.test_client()
+
+
+def test_etag_and_not_modified(client, app_db):
+    main, db = app_db
+    first = client.get('/api/sales')
+    assert first.status_code == 200
+    etag = first.headers['ETag']
+    assert first.headers['Cache-Control'] == 'no-cache'
+
+    # The view does not run for a 304, even when the data changed underneath without a bump
+    db.sales.insert_one({'transaction_id': 'T3'})
+    again = client.get('/api/sales', headers={'If-None-Match': etag})
+    assert (again.status_code, again.headers['ETag'], again.data) == (304, etag, b'')
+    cached = client.get('/api/sales')
+    assert cached.data == first.data
+    assert main.sales_cache.stats['hits'] == 1
+
+    # Other parameters and other tenants have ETags of their own
+    assert client.get('/api/sales?units_sold=1').headers['ETag'] != etag
+    assert client.get('/api/sales', headers={tenants.TENANT_HEADER: 'acme'}).headers['ETag'] != etag
+
+
+def test_write_invalidates(client, app_db):
+    main, db = app_db
+    etag = client.get('/api/sales').headers['ETag']
+    response = client.post('/api/sales/bulk', json=[{'transaction_id': 'T3'}])
+    assert response.status_code == 200
+
+    fresh = client.get('/api/sales', headers={'If-None-Match': etag})
+    assert fresh.status_code == 200
+    assert fresh.headers['ETag'] != etag
+    assert sorted(sale['transaction_id'] for sale in fresh.get_json()) == ['T1', 'T2', 'T3']
+
+
+def test_other_worker_sees_the_bump(client, app_db, monkeypatch):
+    main, db = app_db
+    monkeypatch.setattr(response_cache, 'CACHE_VERSION_CHECK_SECONDS', 60)
+    etag = client.get('/api/sales').headers['ETag']
+    # Another worker process shares the version counter in the database, not the cache
+    response_cache.ResponseCache(db).bump()
+    db.sales.insert_one({'transaction_id': 'T3'})
+
+    # Until this worker rereads the counter
+    assert client.get('/api/sales', headers={'If-None-Match': etag}).status_code == 304
+    monkeypatch.setattr(response_cache, 'CACHE_VERSION_CHECK_SECONDS', 0)
+    fresh = client.get('/api/sales', headers={'If-None-Match': etag})
+    assert fresh.status_code == 200
+    assert len(fresh.get_json()) == 3
+
+
+def test_errors_are_not_cached(client, app_db):
+    main, db = app_db
+    assert client.get('/api/sales?limit=abc').status_code == 400
+    assert main.sales_cache.entries == {}
@@ -0,0 +1,31 @@
+"""GET /api/sales parameter validation"""
+import pytest
+
+
+@pytest.fixture
+def client(app_db):
+    main, db = app_db
+    db.sales.insert_many([{'product': 'Widget', 'customer': {'location': 'Austin'}, 'units_sold': 3},
+                          {'product': 'Gadget', 'customer': {'location': 'Boston'}, 'units_sold': 5}])
+    return main.app.test_client()
+
+
+@pytest.mark.parametrize('query', ['limit=abc', 'limit=-1', 'limit=0', 'limit=1.5'])
+def test_invalid_limit(client, query):
+    response = client.get(f'/api/sales?{query}')
+    assert response.status_code == 400
+    assert 'limit' in response.get_json()['message']
+
+
+@pytest.mark.parametrize('query', ['$where=1', 'customer.$ne=x', 'customer..location=x', '$or__in=a',
+                                   'fields=$product', 'fields=product,customer.'])
+def test_invalid_field_names(client, query):
+    response = client.get(f'/api/sales?{query}')
+    assert response.status_code == 400
+    assert 'Invalid field name' in response.get_json()['message']
+
+
+def test_valid_filters(client):
+    response = client.get('/api/sales?customer.location=Austin&units_sold__gte=1&fields=product&limit=10')
+    assert response.status_code == 200
+    assert [sale['product'] for sale in response.get_json()['sales']] == ['Widget']
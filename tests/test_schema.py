@@ -0,0 +1,45 @@
+"""Nested fields in the sales schema, the staged upload schema and field mappings share one depth"""
+import pytest
+
+import schema_registry
+import staging
+from field_mapping import FieldMapping
+
+SALES = [
+    {'a': 1, 'b': {'c': {'d': 'x', 'e': {'f': {'g': {'h': 1}}}}}, 'empty': {}},
+    {'a': 'two', 'b': {'c': {'d': None}, 'i': 3.5}}
+]
+
+
+def test_registry_expands_every_level_down_to_the_cap(app_db):
+    main, db = app_db
+    db.sales.insert_many([dict(sale) for sale in SALES])
+    fields, count = schema_registry.compute_schema(db.sales)
+    schema = {entry['field']: (entry['count'], entry['types']) for entry in fields}
+    assert count == 2
+    assert schema == {
+        'a': (2, ['number', 'string']),
+        'b.c.d': (2, ['null', 'string']),
+        # Five levels deep, below that the object is listed as it is
+        'b.c.e.f.g': (1, ['object']),
+        'b.i': (1, ['number']),
+        'empty': (1, ['object'])
+    }
+    assert [entry['field'] for entry in fields][:2] == ['a', 'b.c.d']
+
+
+def test_staging_lists_the_same_fields(app_db):
+    main, db = app_db
+    db.sales.insert_many([dict(sale) for sale in SALES])
+    registry = {entry['field']: set(entry['types']) for entry in schema_registry.compute_schema(db.sales)[0]}
+    staged = {}
+    for sale in SALES:
+        staging.collect_schema(sale, staged)
+    assert {field: entry['types'] for field, entry in staged.items()} == registry
+
+
+def test_field_mapping_uses_the_same_depth():
+    mapping = FieldMapping([{'existing': 'deep', 'new': 'b.c.e.f.g'}])
+    assert list(mapping.transform_records([SALES[0]])) == [{'deep': {'h': 1}}]
+    with pytest.raises(ValueError):
+        FieldMapping([{'existing': 'deeper', 'new': 'b.c.e.f.g.h'}])
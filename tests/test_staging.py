@@ -0,0 +1,65 @@
+"""Staged upload previews: staging, commit through the merge endpoint and expiry"""
+import io
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+import staging
+
+SALES = [{'order_id': i, 'product': 'Widget' if i % 2 else 'Gadget', 'customer': {'location': 'Austin'}}
+         for i in range(25)]
+MAPPINGS = {'mappings': [{'existing': 'order_id', 'new': 'order_id'},
+                         {'existing': 'product', 'new': 'product'},
+                         {'existing': 'location', 'new': 'customer.location'}]}
+
+
+@pytest.fixture
+def client(app_db, monkeypatch):
+    main, db = app_db
+    monkeypatch.setattr(staging, '_initialized_databases', set())
+    monkeypatch.setattr(staging, 'STAGING_BATCH_SIZE', 10)
+    return main.app.test_client()
+
+
+def stage(client):
+    response = client.post('/api/upload-preview', content_type='multipart/form-data', data={
+        'file': (io.BytesIO(json.dumps(SALES).encode()), 'sales.json'), 'stage': 'true', 'sample_size': '3'})
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def merge(client, staging_id):
+    return client.post('/api/process-merge-mappings', json={'staging_id': staging_id, 'field_mappings': MAPPINGS})
+
+
+def test_stage_and_commit(client, app_db):
+    main, db = app_db
+    summary = stage(client)
+    assert summary['record_count'] == len(SALES)
+    assert [(row['order_id'], row['customer']) for row in summary['sample']] == \
+        [(sale['order_id'], sale['customer']) for sale in SALES[:3]]
+    assert {'field': 'customer.location', 'count': len(SALES), 'types': ['string']} in summary['schema']
+    assert 'new_data' not in summary
+
+    response = merge(client, summary['staging_id'])
+    assert response.status_code == 200
+    assert [doc['order_id'] for doc in db.sales.find(sort=[('order_id', 1)])] == list(range(len(SALES)))
+    assert db.sales.find_one({'order_id': 1})['location'] == 'Austin'
+    # A committed upload is dropped and can not be merged twice
+    assert db[staging.STAGING_COLLECTION].count_documents({}) == 0
+    assert merge(client, summary['staging_id']).status_code == 404
+
+
+def test_expiry(client, app_db):
+    main, db = app_db
+    summary = stage(client)
+    rows = db[staging.STAGING_COLLECTION].index_information()
+    assert any(info.get('expireAfterSeconds') == staging.STAGING_TTL_SECONDS for info in rows.values())
+
+    # Past expires_at the handle is gone, even before the TTL monitor removes it
+    db[staging.STAGED_UPLOADS_COLLECTION].update_one(
+        {'_id': summary['staging_id']}, {'$set': {'expires_at': datetime.now() - timedelta(seconds=1)}})
+    response = merge(client, summary['staging_id'])
+    assert response.status_code == 404
+    assert db.sales.count_documents({}) == 0
@@ -0,0 +1,46 @@
+"""Tenant partitioning through the API"""
+import tenants
+
+
+def post_sales(client, tenant, sales):
+    response = client.post('/api/sales/bulk', json=sales, headers={tenants.TENANT_HEADER: tenant})
+    assert response.status_code == 200, response.get_json()
+
+
+def sale_ids(client, tenant=None):
+    headers = {tenants.TENANT_HEADER: tenant} if tenant else {}
+    response = client.get('/api/sales', headers=headers)
+    assert response.status_code == 200, response.get_json()
+    # Without a limit the sales come back as a plain list
+    return sorted(sale['transaction_id'] for sale in response.get_json())
+
+
+def test_tenants_only_see_their_own_sales(app_db):
+    main, db = app_db
+    client = main.app.test_client()
+    post_sales(client, 'acme', [{'transaction_id': 'A1'}, {'transaction_id': 'A2'}])
+    post_sales(client, 'globex', [{'transaction_id': 'G1'}])
+
+    assert sale_ids(client, 'acme') == ['A1', 'A2']
+    assert sale_ids(client, 'globex') == ['G1']
+    assert sale_ids(client) == []
+    assert db.sales.count_documents({}) == 0
+    assert db.client[f'{db.name}_acme'].sales.count_documents({}) == 2
+
+
+def test_tenant_ids_are_case_insensitive(app_db):
+    main, db = app_db
+    client = main.app.test_client()
+    post_sales(client, 'Acme', [{'transaction_id': 'A1'}])
+    assert sale_ids(client, 'ACME') == ['A1']
+    assert f'{db.name}_Acme' not in db.client.list_database_names()
+
+
+def test_invalid_tenant_is_rejected(app_db):
+    main, db = app_db
+    client = main.app.test_client()
+    for tenant in ('../admin', 'a' * 33, 'acme.sales'):
+        response = client.get('/api/sales', headers={tenants.TENANT_HEADER: tenant})
+        assert response.status_code == 400
+        assert 'Invalid tenant' in response.get_json()['message']
+    assert client.get('/api/sales?tenant=no%20spaces').status_code == 400
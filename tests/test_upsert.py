@@ -0,0 +1,84 @@
+"""Upsert merges through /api/process-merge-mappings and diff_update"""
+import pytest
+
+import analytics
+from merge_engine import diff_update, merge_records
+
+MAPPINGS = {'mappings': [{'existing': 'order_id', 'new': 'order_id', 'type': 'int'},
+                         {'existing': 'sku', 'new': 'sku'},
+                         {'existing': 'units_sold', 'new': 'units_sold', 'type': 'int'}]}
+
+
+@pytest.fixture
+def client(app_db):
+    main, db = app_db
+    db.sales.insert_many([{'order_id': 1, 'sku': 'A', 'units_sold': 3},
+                          {'order_id': 2, 'sku': 'B', 'units_sold': 5}])
+    return main.app.test_client()
+
+
+def upsert(client, new_data):
+    return client.post('/api/process-merge-mappings', json={
+        'new_data': new_data, 'field_mappings': MAPPINGS, 'matching_fields': ['order_id'], 'mode': 'upsert'})
+
+
+@pytest.mark.parametrize('existing, new, changes', [
+    ({'a': 1, 'b': 2}, {'a': 1}, {}),
+    ({'a': 1}, {'a': 2, 'c': None}, {'a': 2, 'c': None}),
+    ({'a': None}, {'a': None}, {}),
+    ({'_id': 1, 'c': {'x': 1, 'y': 2}}, {'_id': 2, 'c': {'x': 1, 'z': 3}}, {'c.z': 3}),
+    ({'c': 'flat'}, {'c': {'x': 1}}, {'c': {'x': 1}}),
+    ({'c': {'x': 1}}, {'c': [1]}, {'c': [1]}),
+])
+def test_diff_update(existing, new, changes):
+    assert diff_update(existing, new) == changes
+    # Applying the changes gives the same document as merge_records
+    applied = {**existing}
+    for field, value in changes.items():
+        parent, _, key = field.partition('.')
+        if key:
+            applied[parent] = {**applied[parent], key: value}
+        else:
+            applied[field] = value
+    new = {field: value for field, value in new.items() if field != '_id'}
+    assert applied == merge_records(existing, new)
+
+
+def test_upsert_counts_and_writes(client, app_db):
+    main, db = app_db
+    before = db.sales.find_one({'order_id': 2})
+    response = upsert(client, [{'order_id': '1', 'sku': 'A', 'units_sold': '4'},
+                               {'order_id': '2', 'sku': 'B', 'units_sold': '5'},
+                               {'order_id': '3', 'sku': 'C'},
+                               {'order_id': '3', 'units_sold': '7'}])
+    assert response.status_code == 200
+    body = response.get_json()
+    assert (body['inserted_count'], body['updated_count'], body['unchanged_count'], body['failed_count']) == \
+        (1, 1, 1, 0)
+    assert body['unique_index']
+    assert db.sales.find_one({'order_id': 2}) == before
+    # Records sharing a key within the upload are merged into one document
+    assert [(doc['order_id'], doc['sku'], doc['units_sold']) for doc in db.sales.find(sort=[('order_id', 1)])] == \
+        [(1, 'A', 4), (2, 'B', 5), (3, 'C', 7)]
+
+    # The backup changeset only holds the documents that were written
+    changeset = sorted(entry['doc']['order_id'] for entry in db.backup_changesets.find({'backup': body['backup_name']}))
+    assert changeset == [1, 3]
+
+
+def test_write_errors_are_reported(client, app_db):
+    main, db = app_db
+    db.sales.create_index('sku', unique=True)
+    analytics.rebuild_rollups(db.sales, db.analytics)
+    response = upsert(client, [{'order_id': 1, 'sku': 'A', 'units_sold': 4},
+                               {'order_id': 3, 'sku': 'B', 'units_sold': 1},
+                               {'order_id': 4, 'sku': 'C', 'units_sold': 2}])
+    assert response.status_code == 200
+    body = response.get_json()
+    assert (body['inserted_count'], body['updated_count'], body['failed_count']) == (1, 1, 1)
+    assert body['write_errors'][0]['failed_count'] == 1
+    assert body['write_errors'][0]['errors'][0]['code'] == 11000
+    assert sorted(doc['order_id'] for doc in db.sales.find()) == [1, 2, 4]
+    # The failed insert is left out of the rollups
+    total = db.analytics.find_one({'dimension': 'total'})
+    assert (total['count'], total['units_sold']) == (3, 11)
@@ -0,0 +1,51 @@
+"""Streaming XML record detection and parsing"""
+import io
+
+import pytest
+
+from ingestion import find_xml_record_path, iter_xml_records
+
+SALES_XML = b'''<?xml version="1.0"?>
+<export xmlns="urn:sales">
+  <meta><generated>2024-01-01</generated></meta>
+  <sales>
+    <sale id="1"><product>Widget</product><customer><location>Austin</location></customer>
+      <tags><tag>a</tag><tag>b</tag></tags></sale>
+    <sale id="2"><product>Gadget</product><sale>nested, not a record</sale><note> hi </note></sale>
+    <sale>plain</sale>
+  </sales>
+</export>'''
+
+EXPECTED = [
+    {'@id': '1', 'product': 'Widget', 'customer': {'location': 'Austin'}, 'tags': {'tag': ['a', 'b']}},
+    {'@id': '2', 'product': 'Gadget', 'sale': 'nested, not a record', 'note': 'hi'},
+    {'#text': 'plain'},
+]
+
+
+def test_find_record_path():
+    assert find_xml_record_path(io.BytesIO(SALES_XML)) == 'export/sales/sale'
+    # The shallowest repeated element wins, not the first one found deeper down
+    nested = b'<root><a><b/><b/></a><c/><c/></root>'
+    assert find_xml_record_path(io.BytesIO(nested)) == 'root/c'
+    assert find_xml_record_path(io.BytesIO(b'<root><sale/></root>')) is None
+
+
+@pytest.mark.parametrize('record_path', [None, 'sale', 'sales/sale', '/export/sales/sale/'])
+def test_iter_records(record_path):
+    assert list(iter_xml_records(io.BytesIO(SALES_XML), record_path)) == EXPECTED
+
+
+def test_no_records():
+    with pytest.raises(ValueError):
+        list(iter_xml_records(io.BytesIO(b'<root><sale/></root>')))
+
+
+def test_upload_preview(app_db):
+    main, db = app_db
+    response = main.app.test_client().post('/api/upload-preview', content_type='multipart/form-data', data={
+        'file': (io.BytesIO(SALES_XML), 'sales.xml'), 'record_path': 'sale'})
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['record_count'] == 3
+    assert [record['product'] for record in body['new_data'][:2]] == ['Widget', 'Gadget']